@@ -0,0 +1,640 @@
+import hashlib
+import heapq
+import importlib
+import importlib.util
+import math
+import os
+import pickle
+import re
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from os.path import basename, splitext
+
+# Mergeable aggregate states shared by every execution path. An aggregate
+# builds a per-group state with init/step (or step_many for a batch of values),
+# combines partial states with merge and turns a state into the reported value
+# with finalize. States are plain Python values so they pickle compactly and
+# can be persisted or shipped between processes.
+
+SKETCH_SIZE = 200  # KLL top compactor capacity; groups up to this size stay exact
+SKETCH_SHRINK = 2 / 3  # capacity ratio between a compactor and the one above it
+PARAMETER_PATTERN = re.compile(r"([A-Za-z]+?)(\d+)")
+HLL_PRECISION = 12  # 2**12 one-byte registers per group, about 1.6% standard error
+EXACT_DISTINCT_DOMAIN = 65536  # distinct values countdx codes at most, so a group's bitset stays under 8 KB
+SUMMARY_SLOTS = ("total", "count", "low", "high", "values")
+
+
+class Aggregate:
+    """Base aggregate; summary aggregates can also be built from a (total, count, low, high, values) run summary,
+    where count counts rows and values the non-null measure values among them"""
+
+    summary = ()  # run summary slots from_summary reads (SUMMARY_SLOTS); empty when it cannot build a state
+    invertible = False  # subtract(state, other) removes a merged partial state again
+    selective = False  # merge returns one of its two states, so the best of many states wins
+    columns = ()  # extra columns read; step then gets a tuple (attribute value, column values...)
+    companion = False  # True when the name may carry one more attribute (func_gv_attr_companion)
+    parameters = 0  # numeric name parts consumed by configure, e.g. k in topk_1_quant_3
+    instanced = False  # True when the instance holds data across states: every f list entry gets its own instance()
+
+    def configure(self, parameters):
+        """Instance for the given name parameters (strings of digits)"""
+        raise NotImplementedError
+
+    def instance(self):
+        """Fresh instance for one f list entry of an instanced aggregate"""
+        raise NotImplementedError
+
+    def init(self):
+        return None
+
+    def step(self, state, value):
+        raise NotImplementedError
+
+    def step_many(self, state, values):
+        step = self.step
+        for value in values:
+            state = step(state, value)
+        return state
+
+    def merge(self, state, other):
+        raise NotImplementedError
+
+    def subtract(self, state, other):
+        raise NotImplementedError
+
+    def finalize(self, state):
+        return state
+
+    def from_summary(self, total, count, low, high, values):
+        raise NotImplementedError
+
+    def serialize(self, state):
+        return pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+
+    def deserialize(self, data):
+        return pickle.loads(data)
+
+
+class Sum(Aggregate):
+    summary = ("total",)
+    invertible = True
+
+    def init(self):
+        return 0
+
+    def step(self, state, value):
+        return state if value is None else state + value
+
+    def step_many(self, state, values):
+        return state + sum(value for value in values if value is not None)
+
+    def merge(self, state, other):
+        return state + other
+
+    def subtract(self, state, other):
+        return state - other
+
+    def from_summary(self, total, count, low, high, values):
+        return total
+
+
+class Count(Aggregate):
+    """Rows matched by the grouping variable, nulls included"""
+
+    summary = ("count",)
+    invertible = True
+
+    def init(self):
+        return 0
+
+    def step(self, state, value):
+        return state + 1
+
+    def step_many(self, state, values):
+        return state + len(values)
+
+    def merge(self, state, other):
+        return state + other
+
+    def subtract(self, state, other):
+        return state - other
+
+    def from_summary(self, total, count, low, high, values):
+        return count
+
+
+class Avg(Aggregate):
+    """(sum, count) pair; an empty group reports 0"""
+
+    summary = ("total", "values")
+    invertible = True
+
+    def init(self):
+        return (0, 0)
+
+    def step(self, state, value):
+        return state if value is None else (state[0] + value, state[1] + 1)
+
+    def step_many(self, state, values):
+        values = [value for value in values if value is not None]
+        return (state[0] + sum(values), state[1] + len(values))
+
+    def merge(self, state, other):
+        return (state[0] + other[0], state[1] + other[1])
+
+    def subtract(self, state, other):
+        return (state[0] - other[0], state[1] - other[1])
+
+    def finalize(self, state):
+        return state[0] / state[1] if state[1] else 0
+
+    def from_summary(self, total, count, low, high, values):
+        return (total, values)
+
+
+class Min(Aggregate):
+    """Smallest value; an empty group reports inf"""
+
+    summary = ("low",)
+    selective = True
+
+    def init(self):
+        return float('inf')
+
+    def step(self, state, value):
+        return value if value is not None and value < state else state
+
+    def merge(self, state, other):
+        return other if other < state else state
+
+    def from_summary(self, total, count, low, high, values):
+        return self.init() if low is None else low
+
+
+class Max(Aggregate):
+    """Largest value; an empty group reports -inf"""
+
+    summary = ("high",)
+    selective = True
+
+    def init(self):
+        return float('-inf')
+
+    def step(self, state, value):
+        return value if value is not None and value > state else state
+
+    def merge(self, state, other):
+        return other if other > state else state
+
+    def from_summary(self, total, count, low, high, values):
+        return self.init() if high is None else high
+
+
+class Variance(Aggregate):
+    """Sample variance through Welford's (count, mean, M2) state, merged with Chan's formula"""
+
+    def init(self):
+        return (0, 0.0, 0.0)
+
+    def step(self, state, value):
+        if value is None:
+            return state
+        count, mean, m2 = state
+        count += 1
+        delta = float(value) - mean
+        mean += delta / count
+        return (count, mean, m2 + delta * (float(value) - mean))
+
+    def step_many(self, state, values):
+        values = [float(value) for value in values if value is not None]
+        if not values:
+            return state
+        mean = math.fsum(values) / len(values)
+        return self.merge(state, (len(values), mean, math.fsum((value - mean) ** 2 for value in values)))
+
+    def merge(self, state, other):
+        if not other[0]:
+            return state
+        if not state[0]:
+            return other
+        count = state[0] + other[0]
+        delta = other[1] - state[1]
+        return (count, state[1] + delta * other[0] / count, state[2] + other[2] + delta * delta * state[0] * other[0] / count)
+
+    def finalize(self, state):
+        return state[2] / (state[0] - 1) if state[0] > 1 else None
+
+
+class StdDev(Variance):
+    def finalize(self, state):
+        variance = Variance.finalize(self, state)
+        return None if variance is None else math.sqrt(variance)
+
+
+def exact_quantile(values, fraction):
+    """Continuous (interpolated) quantile of the values, like percentile_cont"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = fraction * (len(values) - 1)
+    low = int(rank)
+    if low + 1 >= len(values) or rank == low:
+        return values[low]
+    return values[low] + (values[low + 1] - values[low]) * (rank - low)
+
+
+class Quantile(Aggregate):
+    """Quantile from a KLL sketch (a list of compactors, level h items weigh 2**h); exact keeps every value"""
+
+    def __init__(self, fraction=None, exact=None):
+        self.fraction = fraction
+        self.exact = os.getenv("QUANTILE_MODE", "sketch") == "exact" if exact is None else exact
+        self.parameters = 1 if fraction is None else 0
+
+    def configure(self, parameters):
+        percent = int(parameters[0])
+        if percent > 100:
+            raise ValueError(f"Quantile p{parameters[0]} is out of range; use p0 to p100")
+        return Quantile(percent / 100, self.exact)
+
+    def init(self):
+        return [[]]
+
+    def capacity(self, state, level):
+        return max(2, int(SKETCH_SIZE * SKETCH_SHRINK ** (len(state) - 1 - level)))
+
+    def compress(self, state):
+        """Halve full compactors into the level above until every one fits"""
+        if self.exact:
+            return state
+        level = 0
+        while level < len(state):
+            items = state[level]
+            if len(items) >= self.capacity(state, level):
+                if level + 1 == len(state):
+                    state.append([])
+                items.sort()
+                # Odd sizes keep their largest item; the offset alternates with the level size
+                kept = [items.pop()] if len(items) % 2 else []
+                state[level + 1].extend(items[len(state[level + 1]) % 2::2])
+                state[level] = kept
+            level += 1
+        return state
+
+    def step(self, state, value):
+        if value is not None:
+            state[0].append(value)
+            if len(state[0]) >= SKETCH_SIZE and not self.exact:
+                self.compress(state)
+        return state
+
+    def step_many(self, state, values):
+        state[0].extend(value for value in values if value is not None)
+        return self.compress(state)
+
+    def merge(self, state, other):
+        for level, items in enumerate(other):
+            if level == len(state):
+                state.append([])
+            state[level].extend(items)
+        return self.compress(state)
+
+    def finalize(self, state):
+        if len(state) == 1:
+            # Never compacted: every value is still there
+            return exact_quantile(state[0], self.fraction)
+        weighted = sorted((value, 1 << level) for level, items in enumerate(state) for value in items)
+        target = self.fraction * (sum(weight for _, weight in weighted) - 1)
+        seen = 0
+        for value, weight in weighted:
+            seen += weight
+            if seen > target:
+                return value
+        return weighted[-1][0]
+
+
+@lru_cache(maxsize=1 << 16)
+def stable_hash(value):
+    """64-bit hash that is the same in every process (the built-in hash of str is salted)"""
+    return int.from_bytes(hashlib.blake2b(repr(value).encode(), digest_size=8).digest(), "big")
+
+
+class DistinctCount(Aggregate):
+    """Approximate count of distinct values from a HyperLogLog sketch of 2**precision registers"""
+
+    def __init__(self, precision=None):
+        self.precision = precision or int(os.getenv("HLL_PRECISION", HLL_PRECISION))
+        self.registers = 1 << self.precision
+        self.alpha = 0.7213 / (1 + 1.079 / self.registers)
+
+    def init(self):
+        return bytearray(self.registers)
+
+    def step(self, state, value):
+        if value is not None:
+            hashed = stable_hash(value)
+            index = hashed >> (64 - self.precision)
+            rank = 64 - self.precision - (hashed & ((1 << (64 - self.precision)) - 1)).bit_length() + 1
+            if rank > state[index]:
+                state[index] = rank
+        return state
+
+    def merge(self, state, other):
+        return bytearray(map(max, state, other))
+
+    def finalize(self, state):
+        estimate = self.alpha * self.registers ** 2 / math.fsum(2.0 ** -rank for rank in state)
+        zeros = state.count(0)
+        if estimate <= 2.5 * self.registers and zeros:
+            # Small range correction: linear counting over the empty registers
+            estimate = self.registers * math.log(self.registers / zeros)
+        return round(estimate)
+
+
+class ExactDistinctCount(Aggregate):
+    """Exact count of distinct values as a bitset over dictionary codes, for domains of up to domain values; the
+    codes belong to the instance, so each f list entry (one attribute) numbers its own domain"""
+
+    instanced = True
+
+    def __init__(self, domain=None):
+        self.domain = domain or int(os.getenv("COUNTDX_DOMAIN", EXACT_DISTINCT_DOMAIN))
+        self.codes = {}
+
+    def instance(self):
+        return ExactDistinctCount(self.domain)
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            if len(self.codes) >= self.domain:
+                raise ValueError(f"countdx domain exceeds {self.domain} distinct values; use countd or raise "
+                                 f"COUNTDX_DOMAIN")
+            code = self.codes[value] = len(self.codes)
+        return code
+
+    def init(self):
+        return 0
+
+    def step(self, state, value):
+        return state if value is None else state | (1 << self.code(value))
+
+    def merge(self, state, other):
+        return state | other
+
+    def finalize(self, state):
+        return bin(state).count("1")
+
+    def serialize(self, state):
+        # Codes are per process; persisted states carry the values themselves
+        values = [value for value, code in self.codes.items() if state >> code & 1]
+        return pickle.dumps(values, pickle.HIGHEST_PROTOCOL)
+
+    def deserialize(self, data):
+        return self.step_many(0, pickle.loads(data))
+
+
+class ArgExtreme(Aggregate):
+    """Companion attribute of the row with the largest (or smallest) attribute; ties keep the first or the later row"""
+
+    companion = True
+
+    def __init__(self, largest, later_wins):
+        self.largest = largest
+        self.later_wins = later_wins
+
+    def wins(self, candidate, best):
+        if candidate == best:
+            return self.later_wins
+        return candidate > best if self.largest else candidate < best
+
+    def step(self, state, value):
+        if value[0] is not None and (state is None or self.wins(value[0], state[0])):
+            return value
+        return state
+
+    def merge(self, state, other):
+        return self.step(state, other) if other is not None else state
+
+    def finalize(self, state):
+        return None if state is None else state[1]
+
+
+class Top(Aggregate):
+    """The k largest attribute values (or their companion attributes), kept in a bounded min-heap"""
+
+    companion = True
+
+    def __init__(self, k=None):
+        self.k = k
+        self.parameters = 1 if k is None else 0
+
+    def configure(self, parameters):
+        return Top(int(parameters[0]))
+
+    def init(self):
+        return [[], 0]
+
+    def push(self, heap, item):
+        if len(heap) < self.k:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    def step(self, state, value):
+        if value[0] is not None:
+            # Equal values keep the earlier row: later rows get smaller tie breakers
+            state[1] += 1
+            self.push(state[0], (value[0], -state[1], value[1]))
+        return state
+
+    def merge(self, state, other):
+        for value, order, companion in other[0]:
+            state[1] += 1
+            self.push(state[0], (value, -state[1], companion))
+        return state
+
+    def finalize(self, state):
+        return [companion for _, _, companion in sorted(state[0], reverse=True)]
+
+
+class Complement:
+    """States of an aggregate over the rows of an outer key minus those of one inner value: the outer total less
+    the inner part for invertible aggregates, the best state of another inner value for selective ones"""
+
+    def __init__(self, aggregate):
+        self.aggregate = aggregate
+        self.parts = {}
+        self.totals = {}
+
+    def add(self, outer, inner, state):
+        key = (outer, inner)
+        part = self.parts.get(key)
+        self.parts[key] = state if part is None else self.aggregate.merge(part, state)
+
+    def finish(self):
+        """Fold the parts into per outer key totals, or the two best (state, inner) entries"""
+        merge = self.aggregate.merge
+        for (outer, inner), state in self.parts.items():
+            if self.aggregate.invertible:
+                total = self.totals.get(outer)
+                self.totals[outer] = state if total is None else merge(total, state)
+                continue
+            best = self.totals.setdefault(outer, [])
+            if not best or merge(best[0][0], state) is state:
+                best.insert(0, (state, inner))
+            elif len(best) < 2 or merge(best[1][0], state) is state:
+                best[1:] = [(state, inner)]
+            del best[2:]
+        return self
+
+    def state(self, outer, inner):
+        aggregate = self.aggregate
+        total = self.totals.get(outer)
+        if total is None:
+            return aggregate.init()
+        if aggregate.invertible:
+            part = self.parts.get((outer, inner))
+            return total if part is None else aggregate.subtract(total, part)
+        for state, other in total:
+            if other != inner:
+                return state
+        return aggregate.init()
+
+
+class ThresholdIndex:
+    """Per key measure values ordered by a threshold column, with prefix sums, so the run summary of the rows on
+    one side of a threshold comes from a binary search instead of a scan"""
+
+    def __init__(self):
+        self.pairs = {}
+        self.index = {}
+
+    def add(self, key, column_value, measure_value):
+        if column_value is None:
+            return  # never on either side of a threshold
+        pairs = self.pairs.get(key)
+        if pairs is None:
+            pairs = self.pairs[key] = []
+        pairs.append((column_value, measure_value))
+
+    def finish(self):
+        """Sort every key's rows on the column and build prefix sums of the measure"""
+        for key, pairs in self.pairs.items():
+            pairs.sort(key=lambda pair: pair[0])
+            prefix, present = [0], [0]
+            for _, value in pairs:
+                prefix.append(prefix[-1] + (value if value is not None else 0))
+                present.append(present[-1] + (value is not None))
+            self.index[key] = ([column for column, _ in pairs], [value for _, value in pairs], prefix, present)
+        self.pairs = {}
+        return self
+
+    def summary(self, key, op, threshold):
+        """(total, count, low, high, values) run summary of the measure over rows whose column op threshold holds;
+        low and high assume the measure is the column itself"""
+        entry = self.index.get(key)
+        if entry is None:
+            return 0, 0, None, None, 0
+        columns, values, prefix, present = entry
+        if op == ">":
+            start, stop = bisect_right(columns, threshold), len(columns)
+        elif op == ">=":
+            start, stop = bisect_left(columns, threshold), len(columns)
+        elif op == "<":
+            start, stop = 0, bisect_left(columns, threshold)
+        else:
+            start, stop = 0, bisect_right(columns, threshold)
+        if start >= stop:
+            return 0, 0, None, None, 0
+        return (prefix[stop] - prefix[start], stop - start, values[start], values[stop - 1],
+                present[stop] - present[start])
+
+
+class Dispatch:
+    """Routes a row to the steps of the grouping variables whose conditions on one column its value passes,
+    through a table filled on first sight of each value; without a column every step gets every row"""
+
+    def __init__(self, column, routes):
+        self.column = column
+        self.routes = routes  # [(test on the column value, step)]
+        self.steps = tuple(step for _, step in routes)
+        self.table = {}
+
+    def __call__(self, row):
+        if self.column is None:
+            return self.steps
+        value = row.get(self.column)
+        steps = self.table.get(value)
+        if steps is None:
+            steps = self.table[value] = tuple(step for test, step in self.routes if test(value))
+        return steps
+
+
+AGGREGATES = {
+    "sum": Sum(), "count": Count(), "avg": Avg(), "min": Min(), "max": Max(),
+    "var": Variance(), "stddev": StdDev(), "median": Quantile(0.5),
+    "countd": DistinctCount(), "countdx": ExactDistinctCount(),
+    "argmax": ArgExtreme(True, False), "argmin": ArgExtreme(False, False),
+    "last": ArgExtreme(True, True), "first": ArgExtreme(False, False),
+    "p": Quantile(), "topk": Top(),
+}
+
+
+def aggregate_key(agg_func):
+    """Registry name of the aggregate an f list entry uses (topk_1_quant_3 -> topk3), None if unknown"""
+    parts = agg_func.split("_")
+    aggregate = lookup(parts[0]) if len(parts) >= 3 else None
+    if aggregate is None or len(parts) < 3 + aggregate.parameters:
+        return None
+    name = parts[0] + "".join(parts[3:3 + aggregate.parameters])
+    return name if lookup(name) is not None else None
+
+
+def input_columns(agg_func):
+    """Columns an f list entry reads: its attribute, the aggregate's extra columns and the companion attribute"""
+    name = aggregate_key(agg_func)
+    if name is None:
+        return []
+    parts = agg_func.split("_")
+    aggregate = lookup(name)
+    companion = parts[3 + lookup(parts[0]).parameters:][:1] or [parts[2]]
+    return [parts[2], *aggregate.columns] + (companion if aggregate.companion else [])
+
+
+def lookup(name):
+    """Aggregate registered under name; parameterized names such as p90 or topk3 are created on first use"""
+    if name not in AGGREGATES:
+        match = PARAMETER_PATTERN.fullmatch(name)
+        template = AGGREGATES.get(match.group(1)) if match else None
+        if template is None or template.parameters != 1:
+            return None
+        AGGREGATES[name] = template.configure([match.group(2)])
+    return AGGREGATES[name]
+
+
+_loaded_plugins = set()
+
+
+def register(name, aggregate):
+    """Make aggregate usable as name_<gv>_<attr> in the f list of Phi files"""
+    if not re.fullmatch(r"[A-Za-z][A-Za-z0-9]*", name):
+        raise ValueError(f"Aggregate name '{name}' must be alphanumeric (no underscores)")
+    if not isinstance(aggregate, Aggregate):
+        raise TypeError(f"Aggregate '{name}' must be an Aggregate instance")
+    AGGREGATES[name] = aggregate
+
+
+def load_plugins(spec=None):
+    """Import the comma separated plugin modules (module names or .py paths) that register aggregates"""
+    spec = os.getenv("AGGREGATE_PLUGINS", "") if spec is None else spec
+    for entry in (item.strip() for item in spec.split(",")):
+        if not entry or entry in _loaded_plugins:
+            continue
+        if entry.endswith(".py"):
+            module_spec = importlib.util.spec_from_file_location(splitext(basename(entry))[0], entry)
+            module_spec.loader.exec_module(importlib.util.module_from_spec(module_spec))
+        else:
+            importlib.import_module(entry)
+        _loaded_plugins.add(entry)
+    return spec
@@ -1,10 +1,20 @@
 
 import os
+import sys
 import psycopg2
 import psycopg2.extras
 from prettytable import PrettyTable
 from dotenv import load_dotenv
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from snapshot import Snapshot
+from fetch import fetch_snapshot, ordered_rows, stream_rows, summary_rows, STREAM_ITERSIZE
+from parallel import ParallelTable, run_slices
+from shards import ShardedTable, shard_dsns
+from aggregates import Complement, Dispatch, ThresholdIndex, load_plugins, lookup
+from ordering import order_rows
+from spill import grace_hash
+
 # DO NOT EDIT THIS FILE, IT IS GENERATED BY generator.py
 
 
@@ -15,245 +25,226 @@ def query():
     password = os.getenv('DB_PASSWORD', '1234')
     dbname = os.getenv('DB_NAME', 'sales')
 
+    # A local columnar snapshot replaces the database scan when SNAPSHOT_DIR points at one
+    snapshot_dir = os.getenv('SNAPSHOT_DIR')
+    snapshot = Snapshot.open(snapshot_dir) if snapshot_dir and os.path.isdir(snapshot_dir) else None
+
     conn = psycopg2.connect("dbname="+dbname+" user="+user+" password="+password,
                             cursor_factory=psycopg2.extras.DictCursor, host='127.0.0.1', port='5432')
     cur = conn.cursor()
-    
-    # For EMF queries, we need the whole sales table
-    if not 'emf-inputs/1.txt'.endswith('.sql'):
+
+    # Otherwise the referenced columns are pulled once through binary COPY; SCAN_MODE=cursor keeps the row cursor
+    # and SCAN_MODE=stream re-runs every pass on a server-side cursor, fetching SCAN_ITERSIZE rows at a time
+    scan_mode = os.getenv('SCAN_MODE', 'copy')
+    itersize = int(os.getenv('SCAN_ITERSIZE', STREAM_ITERSIZE))
+
+    # DB_SHARDS lists databases (dbname or host:port/dbname) that each hold part of the sales table
+    shards = os.getenv('DB_SHARDS')
+    if snapshot is None and shards:
+        snapshot = ShardedTable(shard_dsns(shards, user, password), 'sales', ['cust', 'quant', 'state'])
+
+    # Queries keyed on the whole group stream groups off rows clustered on it: a snapshot sorted that way or,
+    # when an index supports the order, a server-side cursor with ORDER BY in place of the fetch
+    ordered = ordered_rows(snapshot, conn, 'sales', ['cust'], ['cust', 'quant', 'state'], scan_mode, itersize)
+
+    # Queries that only need run summaries of their measures scan GROUP BY <other referenced columns> rows instead
+    summaries = summary_rows(snapshot, conn, 'sales', None, None)
+
+    # With SCAN_WORKERS > 1 keyed aggregates are split over block ranges, one process and connection per worker
+    workers = int(os.getenv('SCAN_WORKERS', '1'))
+    if snapshot is None and ordered is None and summaries is None and scan_mode == 'copy' and workers > 1:
+        dsn = "dbname="+dbname+" user="+user+" password="+password+" host=127.0.0.1 port=5432"
+        snapshot = ParallelTable(conn, dsn, 'sales', ['cust', 'quant', 'state'], workers)
+    if snapshot is None and ordered is None and summaries is None and scan_mode == 'copy':
+        snapshot = fetch_snapshot(conn, 'sales', ['cust', 'quant', 'state'])
+    if snapshot is None and ordered is None and summaries is None and scan_mode != 'stream':
         cur.execute("SELECT * FROM sales")
 
+    # EMF_WORKERS > 1 evaluates non-keyed EMF passes for disjoint slices of the group table in parallel
+    emf_workers = int(os.getenv('EMF_WORKERS', '1'))
+
+    # MEMORY_BUDGET (MB, 0 for unlimited) bounds the group table and the rows an ORDER BY sorts in memory;
+    # beyond it rows are spilled to temporary files
+    memory_budget = float(os.getenv('MEMORY_BUDGET', '0'))
+
+    def scan(conjuncts=()):
+        if summaries is not None:
+            return summaries
+        if snapshot is not None:
+            return snapshot.rows(conjuncts)
+        if scan_mode == 'stream':
+            return stream_rows(conn, 'sales', ['cust', 'quant', 'state'], conjuncts, itersize)
+        cur.scroll(0, mode='absolute')
+        return cur
+
+    def scan_groups(keys):
+        if snapshot is not None:
+            # Distinct group keys without reading whole rows, in order of first appearance in a local snapshot
+            return (dict(zip(keys, key)) for key in snapshot.count(keys, ()))
+        return scan()
+
     _global = []
     
+    aggregate_sum = lookup('sum')
+    aggregate_avg = lookup('avg')
+    aggregate_max = lookup('max')
+    aggregate_min = lookup('min')
+    aggregate_count = lookup('count')
+
     class QueryStruct:
         cust = ""
-        sum_1_quant = 0
-        avg_1_quant_sum = 0
-        avg_1_quant_count = 0
-        avg_1_quant = 0
-        max_1_quant = float('-inf')
-        min_1_quant = float('inf')
-        count_1_quant = 0
-        sum_2_quant = 0
-        avg_2_quant_sum = 0
-        avg_2_quant_count = 0
-        avg_2_quant = 0
-        max_2_quant = float('-inf')
-        min_2_quant = float('inf')
-        count_2_quant = 0
-
-    data = []
-
-    group_by_map = dict()
-
-    for row in cur:
-        key = (row.get('cust'))
-        if (not group_by_map.get(key)) and (group_by_map.get(key) != 0):
-            data.append(QueryStruct())
-            group_by_map[key] = len(data) - 1
-
-        pos = group_by_map.get(key)
-        data[pos].cust = row.get('cust')
-
-    cur.scroll(0, mode='absolute')
-
-    for row in cur:
-        for pos in range(len(data)):
-            cust = data[pos].cust
-            sum_1_quant = data[pos].sum_1_quant
-            avg_1_quant = data[pos].avg_1_quant
-            max_1_quant = data[pos].max_1_quant
-            min_1_quant = data[pos].min_1_quant
-            count_1_quant = data[pos].count_1_quant
-            sum_2_quant = data[pos].sum_2_quant
-            avg_2_quant = data[pos].avg_2_quant
-            max_2_quant = data[pos].max_2_quant
-            min_2_quant = data[pos].min_2_quant
-            count_2_quant = data[pos].count_2_quant
-
-            if row.get('state')=='NY' and row.get('cust')==cust:
-                data[pos].sum_1_quant += row.get('quant')
-    cur.scroll(0, mode='absolute')
-
-    for row in cur:
-        for pos in range(len(data)):
-            cust = data[pos].cust
-            sum_1_quant = data[pos].sum_1_quant
-            avg_1_quant = data[pos].avg_1_quant
-            max_1_quant = data[pos].max_1_quant
-            min_1_quant = data[pos].min_1_quant
-            count_1_quant = data[pos].count_1_quant
-            sum_2_quant = data[pos].sum_2_quant
-            avg_2_quant = data[pos].avg_2_quant
-            max_2_quant = data[pos].max_2_quant
-            min_2_quant = data[pos].min_2_quant
-            count_2_quant = data[pos].count_2_quant
-
-            if row.get('state')=='NY' and row.get('cust')==cust:
-                data[pos].avg_1_quant_sum += row.get('quant')
-                data[pos].avg_1_quant_count += 1
-
-                if data[pos].avg_1_quant_count != 0:
-                    data[pos].avg_1_quant = data[pos].avg_1_quant_sum / data[pos].avg_1_quant_count
-                else:
-                    data[pos].avg_1_quant = 'Infinity'
-    cur.scroll(0, mode='absolute')
-
-    for row in cur:
-        for pos in range(len(data)):
-            cust = data[pos].cust
-            sum_1_quant = data[pos].sum_1_quant
-            avg_1_quant = data[pos].avg_1_quant
-            max_1_quant = data[pos].max_1_quant
-            min_1_quant = data[pos].min_1_quant
-            count_1_quant = data[pos].count_1_quant
-            sum_2_quant = data[pos].sum_2_quant
-            avg_2_quant = data[pos].avg_2_quant
-            max_2_quant = data[pos].max_2_quant
-            min_2_quant = data[pos].min_2_quant
-            count_2_quant = data[pos].count_2_quant
-
-            if row.get('state')=='NY' and row.get('cust')==cust:
-                if row.get('quant') is not None:
-                    data[pos].max_1_quant = max(data[pos].max_1_quant, row.get('quant'))
-    cur.scroll(0, mode='absolute')
-
-    for row in cur:
-        for pos in range(len(data)):
-            cust = data[pos].cust
-            sum_1_quant = data[pos].sum_1_quant
-            avg_1_quant = data[pos].avg_1_quant
-            max_1_quant = data[pos].max_1_quant
-            min_1_quant = data[pos].min_1_quant
-            count_1_quant = data[pos].count_1_quant
-            sum_2_quant = data[pos].sum_2_quant
-            avg_2_quant = data[pos].avg_2_quant
-            max_2_quant = data[pos].max_2_quant
-            min_2_quant = data[pos].min_2_quant
-            count_2_quant = data[pos].count_2_quant
-
-            if row.get('state')=='NY' and row.get('cust')==cust:
-                if row.get('quant') is not None:
-                    data[pos].min_1_quant = min(data[pos].min_1_quant, row.get('quant'))
-    cur.scroll(0, mode='absolute')
-
-    for row in cur:
-        for pos in range(len(data)):
-            cust = data[pos].cust
-            sum_1_quant = data[pos].sum_1_quant
-            avg_1_quant = data[pos].avg_1_quant
-            max_1_quant = data[pos].max_1_quant
-            min_1_quant = data[pos].min_1_quant
-            count_1_quant = data[pos].count_1_quant
-            sum_2_quant = data[pos].sum_2_quant
-            avg_2_quant = data[pos].avg_2_quant
-            max_2_quant = data[pos].max_2_quant
-            min_2_quant = data[pos].min_2_quant
-            count_2_quant = data[pos].count_2_quant
-
-            if row.get('state')=='NY' and row.get('cust')==cust:
-                data[pos].count_1_quant += 1
-    cur.scroll(0, mode='absolute')
-
-    for row in cur:
-        for pos in range(len(data)):
-            cust = data[pos].cust
-            sum_1_quant = data[pos].sum_1_quant
-            avg_1_quant = data[pos].avg_1_quant
-            max_1_quant = data[pos].max_1_quant
-            min_1_quant = data[pos].min_1_quant
-            count_1_quant = data[pos].count_1_quant
-            sum_2_quant = data[pos].sum_2_quant
-            avg_2_quant = data[pos].avg_2_quant
-            max_2_quant = data[pos].max_2_quant
-            min_2_quant = data[pos].min_2_quant
-            count_2_quant = data[pos].count_2_quant
-
-            if row.get('state')=='CT' and row.get('cust')==cust:
-                data[pos].sum_2_quant += row.get('quant')
-    cur.scroll(0, mode='absolute')
-
-    for row in cur:
-        for pos in range(len(data)):
-            cust = data[pos].cust
-            sum_1_quant = data[pos].sum_1_quant
-            avg_1_quant = data[pos].avg_1_quant
-            max_1_quant = data[pos].max_1_quant
-            min_1_quant = data[pos].min_1_quant
-            count_1_quant = data[pos].count_1_quant
-            sum_2_quant = data[pos].sum_2_quant
-            avg_2_quant = data[pos].avg_2_quant
-            max_2_quant = data[pos].max_2_quant
-            min_2_quant = data[pos].min_2_quant
-            count_2_quant = data[pos].count_2_quant
-
-            if row.get('state')=='CT' and row.get('cust')==cust:
-                data[pos].avg_2_quant_sum += row.get('quant')
-                data[pos].avg_2_quant_count += 1
-
-                if data[pos].avg_2_quant_count != 0:
-                    data[pos].avg_2_quant = data[pos].avg_2_quant_sum / data[pos].avg_2_quant_count
-                else:
-                    data[pos].avg_2_quant = 'Infinity'
-    cur.scroll(0, mode='absolute')
-
-    for row in cur:
-        for pos in range(len(data)):
-            cust = data[pos].cust
-            sum_1_quant = data[pos].sum_1_quant
-            avg_1_quant = data[pos].avg_1_quant
-            max_1_quant = data[pos].max_1_quant
-            min_1_quant = data[pos].min_1_quant
-            count_1_quant = data[pos].count_1_quant
-            sum_2_quant = data[pos].sum_2_quant
-            avg_2_quant = data[pos].avg_2_quant
-            max_2_quant = data[pos].max_2_quant
-            min_2_quant = data[pos].min_2_quant
-            count_2_quant = data[pos].count_2_quant
-
-            if row.get('state')=='CT' and row.get('cust')==cust:
-                if row.get('quant') is not None:
-                    data[pos].max_2_quant = max(data[pos].max_2_quant, row.get('quant'))
-    cur.scroll(0, mode='absolute')
-
-    for row in cur:
-        for pos in range(len(data)):
-            cust = data[pos].cust
-            sum_1_quant = data[pos].sum_1_quant
-            avg_1_quant = data[pos].avg_1_quant
-            max_1_quant = data[pos].max_1_quant
-            min_1_quant = data[pos].min_1_quant
-            count_1_quant = data[pos].count_1_quant
-            sum_2_quant = data[pos].sum_2_quant
-            avg_2_quant = data[pos].avg_2_quant
-            max_2_quant = data[pos].max_2_quant
-            min_2_quant = data[pos].min_2_quant
-            count_2_quant = data[pos].count_2_quant
-
-            if row.get('state')=='CT' and row.get('cust')==cust:
-                if row.get('quant') is not None:
-                    data[pos].min_2_quant = min(data[pos].min_2_quant, row.get('quant'))
-    cur.scroll(0, mode='absolute')
-
-    for row in cur:
-        for pos in range(len(data)):
-            cust = data[pos].cust
-            sum_1_quant = data[pos].sum_1_quant
-            avg_1_quant = data[pos].avg_1_quant
-            max_1_quant = data[pos].max_1_quant
-            min_1_quant = data[pos].min_1_quant
-            count_1_quant = data[pos].count_1_quant
-            sum_2_quant = data[pos].sum_2_quant
-            avg_2_quant = data[pos].avg_2_quant
-            max_2_quant = data[pos].max_2_quant
-            min_2_quant = data[pos].min_2_quant
-            count_2_quant = data[pos].count_2_quant
-
-            if row.get('state')=='CT' and row.get('cust')==cust:
-                data[pos].count_2_quant += 1
-
-    # Apply HAVING clause if present
-
+        sum_1_quant = aggregate_sum.finalize(aggregate_sum.init())
+        avg_1_quant = aggregate_avg.finalize(aggregate_avg.init())
+        max_1_quant = aggregate_max.finalize(aggregate_max.init())
+        min_1_quant = aggregate_min.finalize(aggregate_min.init())
+        count_1_quant = aggregate_count.finalize(aggregate_count.init())
+        sum_2_quant = aggregate_sum.finalize(aggregate_sum.init())
+        avg_2_quant = aggregate_avg.finalize(aggregate_avg.init())
+        max_2_quant = aggregate_max.finalize(aggregate_max.init())
+        min_2_quant = aggregate_min.finalize(aggregate_min.init())
+        count_2_quant = aggregate_count.finalize(aggregate_count.init())
+
+        def __init__(self):
+            self.sum_1_quant_state = aggregate_sum.init()
+            self.avg_1_quant_state = aggregate_avg.init()
+            self.max_1_quant_state = aggregate_max.init()
+            self.min_1_quant_state = aggregate_min.init()
+            self.count_1_quant_state = aggregate_count.init()
+            self.sum_2_quant_state = aggregate_sum.init()
+            self.avg_2_quant_state = aggregate_avg.init()
+            self.max_2_quant_state = aggregate_max.init()
+            self.min_2_quant_state = aggregate_min.init()
+            self.count_2_quant_state = aggregate_count.init()
+
+    def step_1(obj, row):
+        obj.sum_1_quant_state = aggregate_sum.step(obj.sum_1_quant_state, row.get('quant'))
+        obj.avg_1_quant_state = aggregate_avg.step(obj.avg_1_quant_state, row.get('quant'))
+        obj.max_1_quant_state = aggregate_max.step(obj.max_1_quant_state, row.get('quant'))
+        obj.min_1_quant_state = aggregate_min.step(obj.min_1_quant_state, row.get('quant'))
+        obj.count_1_quant_state = aggregate_count.step(obj.count_1_quant_state, row.get('quant'))
+
+    def step_2(obj, row):
+        obj.sum_2_quant_state = aggregate_sum.step(obj.sum_2_quant_state, row.get('quant'))
+        obj.avg_2_quant_state = aggregate_avg.step(obj.avg_2_quant_state, row.get('quant'))
+        obj.max_2_quant_state = aggregate_max.step(obj.max_2_quant_state, row.get('quant'))
+        obj.min_2_quant_state = aggregate_min.step(obj.min_2_quant_state, row.get('quant'))
+        obj.count_2_quant_state = aggregate_count.step(obj.count_2_quant_state, row.get('quant'))
+
+    # Rows are routed on state to the grouping variables whose conditions they can pass
+    dispatch = Dispatch('state', [(lambda value: value == 'NY', step_1), (lambda value: value == 'CT', step_2)])
+
+    def evaluate(snapshot, scan, scan_groups):
+        data = []
+
+        group_by_map = dict()
+
+        for row in scan_groups(['cust']):
+            key = (row.get('cust'))
+            if (not group_by_map.get(key)) and (group_by_map.get(key) != 0):
+                data.append(QueryStruct())
+                group_by_map[key] = len(data) - 1
+
+            pos = group_by_map.get(key)
+            data[pos].cust = row.get('cust')
+
+        if snapshot is not None:
+            for key, (total, count, low, high, present) in snapshot.aggregate(['cust'], [('state', '==', 'NY')], 'quant', ['total', 'values', 'high', 'low', 'count']).items():
+                pos = group_by_map.get(key[0])
+                if pos is None:
+                    continue
+                data[pos].sum_1_quant_state = aggregate_sum.from_summary(total, count, low, high, present)
+                data[pos].avg_1_quant_state = aggregate_avg.from_summary(total, count, low, high, present)
+                data[pos].max_1_quant_state = aggregate_max.from_summary(total, count, low, high, present)
+                data[pos].min_1_quant_state = aggregate_min.from_summary(total, count, low, high, present)
+                data[pos].count_1_quant_state = aggregate_count.from_summary(total, count, low, high, present)
+
+        if snapshot is not None:
+            for key, (total, count, low, high, present) in snapshot.aggregate(['cust'], [('state', '==', 'CT')], 'quant', ['total', 'values', 'high', 'low', 'count']).items():
+                pos = group_by_map.get(key[0])
+                if pos is None:
+                    continue
+                data[pos].sum_2_quant_state = aggregate_sum.from_summary(total, count, low, high, present)
+                data[pos].avg_2_quant_state = aggregate_avg.from_summary(total, count, low, high, present)
+                data[pos].max_2_quant_state = aggregate_max.from_summary(total, count, low, high, present)
+                data[pos].min_2_quant_state = aggregate_min.from_summary(total, count, low, high, present)
+                data[pos].count_2_quant_state = aggregate_count.from_summary(total, count, low, high, present)
+
+        if snapshot is None:
+            # One pass steps every keyed grouping variable of the row's group
+            for row in scan():
+                pos = group_by_map.get((row.get('cust')))
+                if pos is not None:
+                    for step in dispatch(row):
+                        step(data[pos], row)
+
+        for obj in data:
+            obj.sum_1_quant = aggregate_sum.finalize(obj.sum_1_quant_state)
+
+        for obj in data:
+            obj.avg_1_quant = aggregate_avg.finalize(obj.avg_1_quant_state)
+
+        for obj in data:
+            obj.max_1_quant = aggregate_max.finalize(obj.max_1_quant_state)
+
+        for obj in data:
+            obj.min_1_quant = aggregate_min.finalize(obj.min_1_quant_state)
+
+        for obj in data:
+            obj.count_1_quant = aggregate_count.finalize(obj.count_1_quant_state)
+
+        for obj in data:
+            obj.sum_2_quant = aggregate_sum.finalize(obj.sum_2_quant_state)
+
+        for obj in data:
+            obj.avg_2_quant = aggregate_avg.finalize(obj.avg_2_quant_state)
+
+        for obj in data:
+            obj.max_2_quant = aggregate_max.finalize(obj.max_2_quant_state)
+
+        for obj in data:
+            obj.min_2_quant = aggregate_min.finalize(obj.min_2_quant_state)
+
+        for obj in data:
+            obj.count_2_quant = aggregate_count.finalize(obj.count_2_quant_state)
+
+
+        # Apply HAVING clause if present
+
+        return data
+
+    # Every grouping variable is keyed on the group: rows clustered on it are aggregated one group at a time
+    def finish(obj):
+        obj.sum_1_quant = aggregate_sum.finalize(obj.sum_1_quant_state)
+        obj.avg_1_quant = aggregate_avg.finalize(obj.avg_1_quant_state)
+        obj.max_1_quant = aggregate_max.finalize(obj.max_1_quant_state)
+        obj.min_1_quant = aggregate_min.finalize(obj.min_1_quant_state)
+        obj.count_1_quant = aggregate_count.finalize(obj.count_1_quant_state)
+        obj.sum_2_quant = aggregate_sum.finalize(obj.sum_2_quant_state)
+        obj.avg_2_quant = aggregate_avg.finalize(obj.avg_2_quant_state)
+        obj.max_2_quant = aggregate_max.finalize(obj.max_2_quant_state)
+        obj.min_2_quant = aggregate_min.finalize(obj.min_2_quant_state)
+        obj.count_2_quant = aggregate_count.finalize(obj.count_2_quant_state)
+        return True
+
+    def stream_groups(rows):
+        obj, current = None, None
+        for row in rows:
+            key = (row.get('cust'))
+            if obj is None or key != current:
+                if obj is not None and finish(obj):
+                    yield obj
+                obj, current = QueryStruct(), key
+                obj.cust = row.get('cust')
+            for step in dispatch(row):
+                step(obj, row)
+        if obj is not None and finish(obj):
+            yield obj
+
+    if ordered is not None:
+        data = stream_groups(ordered)
+    else:
+        # Above MEMORY_BUDGET the group table is built one hash partition of the rows at a time
+        data = grace_hash(evaluate, snapshot, scan, scan_groups, ['cust'], ['cust'], QueryStruct(), memory_budget)
 
     operations_dict = {'cust': {'found': False}, 'sum_1_quant': {'found': False}, 'avg_1_quant': {'found': False}, 'max_1_quant': {'found': False}, 'min_1_quant': {'found': False}, 'count_1_quant': {'found': False}, 'sum_2_quant': {'found': False}, 'avg_2_quant': {'found': False}, 'max_2_quant': {'found': False}, 'min_2_quant': {'found': False}, 'count_2_quant': {'found': False}}
     table = PrettyTable()
@@ -283,4 +274,3 @@ def query():
 
 if "__main__" == __name__:
     print(query())
-    
\ No newline at end of file
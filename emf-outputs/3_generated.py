@@ -1,10 +1,20 @@
 
 import os
+import sys
 import psycopg2
 import psycopg2.extras
 from prettytable import PrettyTable
 from dotenv import load_dotenv
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from snapshot import Snapshot
+from fetch import fetch_snapshot, ordered_rows, stream_rows, summary_rows, STREAM_ITERSIZE
+from parallel import ParallelTable, run_slices
+from shards import ShardedTable, shard_dsns
+from aggregates import Complement, Dispatch, ThresholdIndex, load_plugins, lookup
+from ordering import order_rows
+from spill import grace_hash
+
 # DO NOT EDIT THIS FILE, IT IS GENERATED BY generator.py
 
 
@@ -15,65 +25,139 @@ def query():
     password = os.getenv('DB_PASSWORD', '1234')
     dbname = os.getenv('DB_NAME', 'sales')
 
+    # A local columnar snapshot replaces the database scan when SNAPSHOT_DIR points at one
+    snapshot_dir = os.getenv('SNAPSHOT_DIR')
+    snapshot = Snapshot.open(snapshot_dir) if snapshot_dir and os.path.isdir(snapshot_dir) else None
+
     conn = psycopg2.connect("dbname="+dbname+" user="+user+" password="+password,
                             cursor_factory=psycopg2.extras.DictCursor, host='127.0.0.1', port='5432')
     cur = conn.cursor()
-    
-    # For EMF queries, we need the whole sales table
-    if not 'emf-inputs/3.txt'.endswith('.sql'):
+
+    # Otherwise the referenced columns are pulled once through binary COPY; SCAN_MODE=cursor keeps the row cursor
+    # and SCAN_MODE=stream re-runs every pass on a server-side cursor, fetching SCAN_ITERSIZE rows at a time
+    scan_mode = os.getenv('SCAN_MODE', 'copy')
+    itersize = int(os.getenv('SCAN_ITERSIZE', STREAM_ITERSIZE))
+
+    # DB_SHARDS lists databases (dbname or host:port/dbname) that each hold part of the sales table
+    shards = os.getenv('DB_SHARDS')
+    if snapshot is None and shards:
+        snapshot = ShardedTable(shard_dsns(shards, user, password), 'sales', ['prod', 'month', 'year', 'quant'])
+
+    # Queries keyed on the whole group stream groups off rows clustered on it: a snapshot sorted that way or,
+    # when an index supports the order, a server-side cursor with ORDER BY in place of the fetch
+    ordered = ordered_rows(snapshot, conn, 'sales', None, ['prod', 'month', 'year', 'quant'], scan_mode, itersize)
+
+    # Queries that only need run summaries of their measures scan GROUP BY <other referenced columns> rows instead
+    summaries = summary_rows(snapshot, conn, 'sales', ['prod', 'month', 'year'], {'quant': ['total']})
+
+    # With SCAN_WORKERS > 1 keyed aggregates are split over block ranges, one process and connection per worker
+    workers = int(os.getenv('SCAN_WORKERS', '1'))
+    if snapshot is None and ordered is None and summaries is None and scan_mode == 'copy' and workers > 1:
+        dsn = "dbname="+dbname+" user="+user+" password="+password+" host=127.0.0.1 port=5432"
+        snapshot = ParallelTable(conn, dsn, 'sales', ['prod', 'month', 'year', 'quant'], workers)
+    if snapshot is None and ordered is None and summaries is None and scan_mode == 'copy':
+        snapshot = fetch_snapshot(conn, 'sales', ['prod', 'month', 'year', 'quant'])
+    if snapshot is None and ordered is None and summaries is None and scan_mode != 'stream':
         cur.execute("SELECT * FROM sales")
 
+    # EMF_WORKERS > 1 evaluates non-keyed EMF passes for disjoint slices of the group table in parallel
+    emf_workers = int(os.getenv('EMF_WORKERS', '1'))
+
+    # MEMORY_BUDGET (MB, 0 for unlimited) bounds the group table and the rows an ORDER BY sorts in memory;
+    # beyond it rows are spilled to temporary files
+    memory_budget = float(os.getenv('MEMORY_BUDGET', '0'))
+
+    def scan(conjuncts=()):
+        if summaries is not None:
+            return summaries
+        if snapshot is not None:
+            return snapshot.rows(conjuncts)
+        if scan_mode == 'stream':
+            return stream_rows(conn, 'sales', ['prod', 'month', 'year', 'quant'], conjuncts, itersize)
+        cur.scroll(0, mode='absolute')
+        return cur
+
+    def scan_groups(keys):
+        if snapshot is not None:
+            # Distinct group keys without reading whole rows, in order of first appearance in a local snapshot
+            return (dict(zip(keys, key)) for key in snapshot.count(keys, ()))
+        return scan()
+
     _global = []
     
+    aggregate_sum = lookup('sum')
+
     class QueryStruct:
         prod = ""
         month = ""
         year = ""
-        sum_1_quant = 0
-        sum_2_quant = 0
-
-    data = []
-
-    group_by_map = dict()
-
-    for row in cur:
-        key = (row.get('prod'), row.get('month'), row.get('year'))
-        if (not group_by_map.get(key)) and (group_by_map.get(key) != 0):
-            data.append(QueryStruct())
-            group_by_map[key] = len(data) - 1
-
-        pos = group_by_map.get(key)
-        data[pos].prod = row.get('prod')
-        data[pos].month = row.get('month')
-        data[pos].year = row.get('year')
-
-    cur.scroll(0, mode='absolute')
-
-    for row in cur:
-        for pos in range(len(data)):
-            prod = data[pos].prod
-            month = data[pos].month
-            year = data[pos].year
-            sum_1_quant = data[pos].sum_1_quant
-            sum_2_quant = data[pos].sum_2_quant
-
-            if row.get('prod')==prod and row.get('month')==month and row.get('year')==year:
-                data[pos].sum_1_quant += row.get('quant')
-    cur.scroll(0, mode='absolute')
-
-    for row in cur:
-        for pos in range(len(data)):
-            prod = data[pos].prod
-            month = data[pos].month
-            year = data[pos].year
-            sum_1_quant = data[pos].sum_1_quant
-            sum_2_quant = data[pos].sum_2_quant
-
-            if row.get('prod')==prod and row.get('year')==year:
-                data[pos].sum_2_quant += row.get('quant')
-
-    # Apply HAVING clause if present
-
+        sum_1_quant = aggregate_sum.finalize(aggregate_sum.init())
+        sum_2_quant = aggregate_sum.finalize(aggregate_sum.init())
+
+        def __init__(self):
+            self.sum_1_quant_state = aggregate_sum.init()
+            self.sum_2_quant_state = aggregate_sum.init()
+
+    def step_1(obj, row):
+        obj.sum_1_quant_state = aggregate_sum.merge(obj.sum_1_quant_state, aggregate_sum.from_summary(*row.get('quant')))
+
+    dispatch = Dispatch(None, [(lambda value: True, step_1)])
+
+    def evaluate(snapshot, scan, scan_groups):
+        data = []
+
+        group_by_map = dict()
+
+        for row in scan_groups(['prod', 'month', 'year']):
+            key = (row.get('prod'), row.get('month'), row.get('year'))
+            if (not group_by_map.get(key)) and (group_by_map.get(key) != 0):
+                data.append(QueryStruct())
+                group_by_map[key] = len(data) - 1
+
+            pos = group_by_map.get(key)
+            data[pos].prod = row.get('prod')
+            data[pos].month = row.get('month')
+            data[pos].year = row.get('year')
+
+        if snapshot is not None:
+            for key, (total, count, low, high, present) in snapshot.aggregate(['prod', 'month', 'year'], [], 'quant', ['total']).items():
+                pos = group_by_map.get(key)
+                if pos is None:
+                    continue
+                data[pos].sum_1_quant_state = aggregate_sum.from_summary(total, count, low, high, present)
+
+        if snapshot is None:
+            # One pass steps every keyed grouping variable of the row's group
+            for row in scan():
+                pos = group_by_map.get((row.get('prod'), row.get('month'), row.get('year')))
+                if pos is not None:
+                    for step in dispatch(row):
+                        step(data[pos], row)
+
+        for obj in data:
+            obj.sum_1_quant = aggregate_sum.finalize(obj.sum_1_quant_state)
+
+        if snapshot is not None:
+            coarse_sum_2_quant = {key: aggregate_sum.from_summary(*state) for key, state in snapshot.aggregate(['prod', 'year'], [], 'quant', ['total']).items()}
+        else:
+            coarse_sum_2_quant = {}
+            for row in scan():
+                key = (row.get('prod'), row.get('year'),)
+                state = coarse_sum_2_quant.get(key)
+                coarse_sum_2_quant[key] = aggregate_sum.merge(aggregate_sum.init() if state is None else state, aggregate_sum.from_summary(*row.get('quant')))
+        for obj in data:
+            state = coarse_sum_2_quant.get((obj.prod, obj.year,))
+            obj.sum_2_quant_state = aggregate_sum.init() if state is None else state
+        for obj in data:
+            obj.sum_2_quant = aggregate_sum.finalize(obj.sum_2_quant_state)
+
+
+        # Apply HAVING clause if present
+
+        return data
+
+    # Above MEMORY_BUDGET the group table is built one hash partition of the rows at a time
+    data = grace_hash(evaluate, snapshot, scan, scan_groups, ['prod', 'year'], ['prod', 'month', 'year'], QueryStruct(), memory_budget)
 
     operations_dict = {'prod': {'found': False}, 'month': {'found': False}, 'year': {'found': False}, 'sum_1_quant / sum_2_quant': {'operator': '/', 'operand1': 'sum_1_quant', 'operand2': 'sum_2_quant', 'found': True}}
     table = PrettyTable()
@@ -103,4 +187,3 @@ def query():
 
 if "__main__" == __name__:
     print(query())
-    
\ No newline at end of file
@@ -1,10 +1,20 @@
 
 import os
+import sys
 import psycopg2
 import psycopg2.extras
 from prettytable import PrettyTable
 from dotenv import load_dotenv
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from snapshot import Snapshot
+from fetch import fetch_snapshot, ordered_rows, stream_rows, summary_rows, STREAM_ITERSIZE
+from parallel import ParallelTable, run_slices
+from shards import ShardedTable, shard_dsns
+from aggregates import Complement, Dispatch, ThresholdIndex, load_plugins, lookup
+from ordering import order_rows
+from spill import grace_hash
+
 # DO NOT EDIT THIS FILE, IT IS GENERATED BY generator.py
 
 
@@ -15,89 +25,143 @@ def query():
     password = os.getenv('DB_PASSWORD', '1234')
     dbname = os.getenv('DB_NAME', 'sales')
 
+    # A local columnar snapshot replaces the database scan when SNAPSHOT_DIR points at one
+    snapshot_dir = os.getenv('SNAPSHOT_DIR')
+    snapshot = Snapshot.open(snapshot_dir) if snapshot_dir and os.path.isdir(snapshot_dir) else None
+
     conn = psycopg2.connect("dbname="+dbname+" user="+user+" password="+password,
                             cursor_factory=psycopg2.extras.DictCursor, host='127.0.0.1', port='5432')
     cur = conn.cursor()
-    
-    # For EMF queries, we need the whole sales table
-    if not 'emf-inputs/6.txt'.endswith('.sql'):
+
+    # Otherwise the referenced columns are pulled once through binary COPY; SCAN_MODE=cursor keeps the row cursor
+    # and SCAN_MODE=stream re-runs every pass on a server-side cursor, fetching SCAN_ITERSIZE rows at a time
+    scan_mode = os.getenv('SCAN_MODE', 'copy')
+    itersize = int(os.getenv('SCAN_ITERSIZE', STREAM_ITERSIZE))
+
+    # DB_SHARDS lists databases (dbname or host:port/dbname) that each hold part of the sales table
+    shards = os.getenv('DB_SHARDS')
+    if snapshot is None and shards:
+        snapshot = ShardedTable(shard_dsns(shards, user, password), 'sales', ['prod', 'year', 'month', 'quant'])
+
+    # Queries keyed on the whole group stream groups off rows clustered on it: a snapshot sorted that way or,
+    # when an index supports the order, a server-side cursor with ORDER BY in place of the fetch
+    ordered = ordered_rows(snapshot, conn, 'sales', None, ['prod', 'year', 'month', 'quant'], scan_mode, itersize)
+
+    # Queries that only need run summaries of their measures scan GROUP BY <other referenced columns> rows instead
+    summaries = summary_rows(snapshot, conn, 'sales', None, None)
+
+    # With SCAN_WORKERS > 1 keyed aggregates are split over block ranges, one process and connection per worker
+    workers = int(os.getenv('SCAN_WORKERS', '1'))
+    if snapshot is None and ordered is None and summaries is None and scan_mode == 'copy' and workers > 1:
+        dsn = "dbname="+dbname+" user="+user+" password="+password+" host=127.0.0.1 port=5432"
+        snapshot = ParallelTable(conn, dsn, 'sales', ['prod', 'year', 'month', 'quant'], workers)
+    if snapshot is None and ordered is None and summaries is None and scan_mode == 'copy':
+        snapshot = fetch_snapshot(conn, 'sales', ['prod', 'year', 'month', 'quant'])
+    if snapshot is None and ordered is None and summaries is None and scan_mode != 'stream':
         cur.execute("SELECT * FROM sales")
 
+    # EMF_WORKERS > 1 evaluates non-keyed EMF passes for disjoint slices of the group table in parallel
+    emf_workers = int(os.getenv('EMF_WORKERS', '1'))
+
+    # MEMORY_BUDGET (MB, 0 for unlimited) bounds the group table and the rows an ORDER BY sorts in memory;
+    # beyond it rows are spilled to temporary files
+    memory_budget = float(os.getenv('MEMORY_BUDGET', '0'))
+
+    def scan(conjuncts=()):
+        if summaries is not None:
+            return summaries
+        if snapshot is not None:
+            return snapshot.rows(conjuncts)
+        if scan_mode == 'stream':
+            return stream_rows(conn, 'sales', ['prod', 'year', 'month', 'quant'], conjuncts, itersize)
+        cur.scroll(0, mode='absolute')
+        return cur
+
+    def scan_groups(keys):
+        if snapshot is not None:
+            # Distinct group keys without reading whole rows, in order of first appearance in a local snapshot
+            return (dict(zip(keys, key)) for key in snapshot.count(keys, ()))
+        return scan()
+
     _global = []
     
+    aggregate_avg = lookup('avg')
+    aggregate_sum = lookup('sum')
+
     class QueryStruct:
         prod = ""
         year = ""
         month = ""
-        avg_1_quant_sum = 0
-        avg_1_quant_count = 0
-        avg_1_quant = 0
-        sum_2_quant = 0
-        sum_3_quant = 0
-
-    data = []
-
-    group_by_map = dict()
-
-    for row in cur:
-        key = (row.get('prod'), row.get('year'), row.get('month'))
-        if (not group_by_map.get(key)) and (group_by_map.get(key) != 0):
-            data.append(QueryStruct())
-            group_by_map[key] = len(data) - 1
-
-        pos = group_by_map.get(key)
-        data[pos].prod = row.get('prod')
-        data[pos].year = row.get('year')
-        data[pos].month = row.get('month')
-
-    cur.scroll(0, mode='absolute')
-
-    for row in cur:
-        for pos in range(len(data)):
-            prod = data[pos].prod
-            year = data[pos].year
-            month = data[pos].month
-            avg_1_quant = data[pos].avg_1_quant
-            sum_2_quant = data[pos].sum_2_quant
-            sum_3_quant = data[pos].sum_3_quant
-
-            if row.get('year')==year:
-                data[pos].avg_1_quant_sum += row.get('quant')
-                data[pos].avg_1_quant_count += 1
-
-                if data[pos].avg_1_quant_count != 0:
-                    data[pos].avg_1_quant = data[pos].avg_1_quant_sum / data[pos].avg_1_quant_count
-                else:
-                    data[pos].avg_1_quant = 'Infinity'
-    cur.scroll(0, mode='absolute')
-
-    for row in cur:
-        for pos in range(len(data)):
-            prod = data[pos].prod
-            year = data[pos].year
-            month = data[pos].month
-            avg_1_quant = data[pos].avg_1_quant
-            sum_2_quant = data[pos].sum_2_quant
-            sum_3_quant = data[pos].sum_3_quant
-
-            if row.get('prod')==prod and row.get('year')==year and row.get('month')==month and row.get('quant')>avg_1_quant:
-                data[pos].sum_2_quant += row.get('quant')
-    cur.scroll(0, mode='absolute')
-
-    for row in cur:
-        for pos in range(len(data)):
-            prod = data[pos].prod
-            year = data[pos].year
-            month = data[pos].month
-            avg_1_quant = data[pos].avg_1_quant
-            sum_2_quant = data[pos].sum_2_quant
-            sum_3_quant = data[pos].sum_3_quant
-
-            if row.get('prod')==prod and row.get('year')==year:
-                data[pos].sum_3_quant += row.get('quant')
-
-    # Apply HAVING clause if present
-
+        avg_1_quant = aggregate_avg.finalize(aggregate_avg.init())
+        sum_2_quant = aggregate_sum.finalize(aggregate_sum.init())
+        sum_3_quant = aggregate_sum.finalize(aggregate_sum.init())
+
+        def __init__(self):
+            self.avg_1_quant_state = aggregate_avg.init()
+            self.sum_2_quant_state = aggregate_sum.init()
+            self.sum_3_quant_state = aggregate_sum.init()
+
+    def evaluate(snapshot, scan, scan_groups):
+        data = []
+
+        group_by_map = dict()
+
+        for row in scan_groups(['prod', 'year', 'month']):
+            key = (row.get('prod'), row.get('year'), row.get('month'))
+            if (not group_by_map.get(key)) and (group_by_map.get(key) != 0):
+                data.append(QueryStruct())
+                group_by_map[key] = len(data) - 1
+
+            pos = group_by_map.get(key)
+            data[pos].prod = row.get('prod')
+            data[pos].year = row.get('year')
+            data[pos].month = row.get('month')
+
+
+        if snapshot is not None:
+            coarse_avg_1_quant = {key: aggregate_avg.from_summary(*state) for key, state in snapshot.aggregate(['year'], [], 'quant', ['total', 'values']).items()}
+        else:
+            coarse_avg_1_quant = {}
+            for row in scan():
+                key = (row.get('year'),)
+                state = coarse_avg_1_quant.get(key)
+                coarse_avg_1_quant[key] = aggregate_avg.step(aggregate_avg.init() if state is None else state, row.get('quant'))
+        for obj in data:
+            state = coarse_avg_1_quant.get((obj.year,))
+            obj.avg_1_quant_state = aggregate_avg.init() if state is None else state
+        for obj in data:
+            obj.avg_1_quant = aggregate_avg.finalize(obj.avg_1_quant_state)
+
+        threshold_sum_2_quant = ThresholdIndex()
+        for row in scan():
+            threshold_sum_2_quant.add((row.get('prod'), row.get('year'), row.get('month'),), row.get('quant'), row.get('quant'))
+        threshold_sum_2_quant.finish()
+        for obj in data:
+            obj.sum_2_quant_state = aggregate_sum.from_summary(*threshold_sum_2_quant.summary((obj.prod, obj.year, obj.month,), '>', obj.avg_1_quant))
+        for obj in data:
+            obj.sum_2_quant = aggregate_sum.finalize(obj.sum_2_quant_state)
+
+        if snapshot is not None:
+            coarse_sum_3_quant = {key: aggregate_sum.from_summary(*state) for key, state in snapshot.aggregate(['prod', 'year'], [], 'quant', ['total']).items()}
+        else:
+            coarse_sum_3_quant = {}
+            for row in scan():
+                key = (row.get('prod'), row.get('year'),)
+                state = coarse_sum_3_quant.get(key)
+                coarse_sum_3_quant[key] = aggregate_sum.step(aggregate_sum.init() if state is None else state, row.get('quant'))
+        for obj in data:
+            state = coarse_sum_3_quant.get((obj.prod, obj.year,))
+            obj.sum_3_quant_state = aggregate_sum.init() if state is None else state
+        for obj in data:
+            obj.sum_3_quant = aggregate_sum.finalize(obj.sum_3_quant_state)
+
+
+        # Apply HAVING clause if present
+
+        return data
+
+    # Above MEMORY_BUDGET the group table is built one hash partition of the rows at a time
+    data = grace_hash(evaluate, snapshot, scan, scan_groups, ['year'], ['prod', 'year', 'month'], QueryStruct(), memory_budget)
 
     operations_dict = {'prod': {'found': False}, 'year': {'found': False}, 'month': {'found': False}, 'sum_2_quant': {'found': False}, 'sum_3_quant': {'found': False}, 'avg_1_quant': {'found': False}}
     table = PrettyTable()
@@ -127,4 +191,3 @@ def query():
 
 if "__main__" == __name__:
     print(query())
-    
\ No newline at end of file
@@ -1,10 +1,20 @@
 
 import os
+import sys
 import psycopg2
 import psycopg2.extras
 from prettytable import PrettyTable
 from dotenv import load_dotenv
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from snapshot import Snapshot
+from fetch import fetch_snapshot, ordered_rows, stream_rows, summary_rows, STREAM_ITERSIZE
+from parallel import ParallelTable, run_slices
+from shards import ShardedTable, shard_dsns
+from aggregates import Complement, Dispatch, ThresholdIndex, load_plugins, lookup
+from ordering import order_rows
+from spill import grace_hash
+
 # DO NOT EDIT THIS FILE, IT IS GENERATED BY generator.py
 
 
@@ -15,56 +25,150 @@ def query():
     password = os.getenv('DB_PASSWORD', '1234')
     dbname = os.getenv('DB_NAME', 'sales')
 
+    # A local columnar snapshot replaces the database scan when SNAPSHOT_DIR points at one
+    snapshot_dir = os.getenv('SNAPSHOT_DIR')
+    snapshot = Snapshot.open(snapshot_dir) if snapshot_dir and os.path.isdir(snapshot_dir) else None
+
     conn = psycopg2.connect("dbname="+dbname+" user="+user+" password="+password,
                             cursor_factory=psycopg2.extras.DictCursor, host='127.0.0.1', port='5432')
     cur = conn.cursor()
-    cur.execute("SELECT * FROM sales")
+
+    # Otherwise the referenced columns are pulled once through binary COPY; SCAN_MODE=cursor keeps the row cursor
+    # and SCAN_MODE=stream re-runs every pass on a server-side cursor, fetching SCAN_ITERSIZE rows at a time
+    scan_mode = os.getenv('SCAN_MODE', 'copy')
+    itersize = int(os.getenv('SCAN_ITERSIZE', STREAM_ITERSIZE))
+
+    # DB_SHARDS lists databases (dbname or host:port/dbname) that each hold part of the sales table
+    shards = os.getenv('DB_SHARDS')
+    if snapshot is None and shards:
+        snapshot = ShardedTable(shard_dsns(shards, user, password), 'sales', ['prod', 'price'])
+
+    # Queries keyed on the whole group stream groups off rows clustered on it: a snapshot sorted that way or,
+    # when an index supports the order, a server-side cursor with ORDER BY in place of the fetch
+    ordered = ordered_rows(snapshot, conn, 'sales', ['prod'], ['prod', 'price'], scan_mode, itersize)
+
+    # Queries that only need run summaries of their measures scan GROUP BY <other referenced columns> rows instead
+    summaries = summary_rows(snapshot, conn, 'sales', None, None)
+
+    # With SCAN_WORKERS > 1 keyed aggregates are split over block ranges, one process and connection per worker
+    workers = int(os.getenv('SCAN_WORKERS', '1'))
+    if snapshot is None and ordered is None and summaries is None and scan_mode == 'copy' and workers > 1:
+        dsn = "dbname="+dbname+" user="+user+" password="+password+" host=127.0.0.1 port=5432"
+        snapshot = ParallelTable(conn, dsn, 'sales', ['prod', 'price'], workers)
+    if snapshot is None and ordered is None and summaries is None and scan_mode == 'copy':
+        snapshot = fetch_snapshot(conn, 'sales', ['prod', 'price'])
+    if snapshot is None and ordered is None and summaries is None and scan_mode != 'stream':
+        cur.execute("SELECT * FROM sales")
+
+    # EMF_WORKERS > 1 evaluates non-keyed EMF passes for disjoint slices of the group table in parallel
+    emf_workers = int(os.getenv('EMF_WORKERS', '1'))
+
+    # MEMORY_BUDGET (MB, 0 for unlimited) bounds the group table and the rows an ORDER BY sorts in memory;
+    # beyond it rows are spilled to temporary files
+    memory_budget = float(os.getenv('MEMORY_BUDGET', '0'))
+
+    def scan(conjuncts=()):
+        if summaries is not None:
+            return summaries
+        if snapshot is not None:
+            return snapshot.rows(conjuncts)
+        if scan_mode == 'stream':
+            return stream_rows(conn, 'sales', ['prod', 'price'], conjuncts, itersize)
+        cur.scroll(0, mode='absolute')
+        return cur
+
+    def scan_groups(keys):
+        if snapshot is not None:
+            # Distinct group keys without reading whole rows, in order of first appearance in a local snapshot
+            return (dict(zip(keys, key)) for key in snapshot.count(keys, ()))
+        return scan()
 
     _global = []
     
+    aggregate_min = lookup('min')
+    aggregate_max = lookup('max')
+
     class QueryStruct:
         prod = ""
-        min_1_price = float('inf')
-        max_1_price = float('-inf')
-
-    data = []
-
-    group_by_map = dict()
-
-    for row in cur:
-        key = (row.get('prod'))
-        if (not group_by_map.get(key)) and (group_by_map.get(key) != 0):
-            data.append(QueryStruct())
-            group_by_map[key] = len(data) - 1
-
-        pos = group_by_map.get(key)
-        data[pos].prod = row.get('prod')
-
-    cur.scroll(0, mode='absolute')
-
-    for row in cur:
-        for pos in range(len(data)):
-            prod = data[pos].prod
-            min_1_price = data[pos].min_1_price
-            max_1_price = data[pos].max_1_price
-
-            if row.get('prod')==prod:
-                if row.get('price') is not None:
-                    data[pos].min_1_price = min(data[pos].min_1_price, row.get('price'))
-    cur.scroll(0, mode='absolute')
-
-    for row in cur:
-        for pos in range(len(data)):
-            prod = data[pos].prod
-            min_1_price = data[pos].min_1_price
-            max_1_price = data[pos].max_1_price
-
-            if row.get('prod')==prod:
-                if row.get('price') is not None:
-                    data[pos].max_1_price = max(data[pos].max_1_price, row.get('price'))
-
-    # Apply HAVING clause if present
-
+        min_1_price = aggregate_min.finalize(aggregate_min.init())
+        max_1_price = aggregate_max.finalize(aggregate_max.init())
+
+        def __init__(self):
+            self.min_1_price_state = aggregate_min.init()
+            self.max_1_price_state = aggregate_max.init()
+
+    def step_1(obj, row):
+        obj.min_1_price_state = aggregate_min.step(obj.min_1_price_state, row.get('price'))
+        obj.max_1_price_state = aggregate_max.step(obj.max_1_price_state, row.get('price'))
+
+    dispatch = Dispatch(None, [(lambda value: True, step_1)])
+
+    def evaluate(snapshot, scan, scan_groups):
+        data = []
+
+        group_by_map = dict()
+
+        for row in scan_groups(['prod']):
+            key = (row.get('prod'))
+            if (not group_by_map.get(key)) and (group_by_map.get(key) != 0):
+                data.append(QueryStruct())
+                group_by_map[key] = len(data) - 1
+
+            pos = group_by_map.get(key)
+            data[pos].prod = row.get('prod')
+
+        if snapshot is not None:
+            for key, (total, count, low, high, present) in snapshot.aggregate(['prod'], [], 'price', ['low', 'high']).items():
+                pos = group_by_map.get(key[0])
+                if pos is None:
+                    continue
+                data[pos].min_1_price_state = aggregate_min.from_summary(total, count, low, high, present)
+                data[pos].max_1_price_state = aggregate_max.from_summary(total, count, low, high, present)
+
+        if snapshot is None:
+            # One pass steps every keyed grouping variable of the row's group
+            for row in scan():
+                pos = group_by_map.get((row.get('prod')))
+                if pos is not None:
+                    for step in dispatch(row):
+                        step(data[pos], row)
+
+        for obj in data:
+            obj.min_1_price = aggregate_min.finalize(obj.min_1_price_state)
+
+        for obj in data:
+            obj.max_1_price = aggregate_max.finalize(obj.max_1_price_state)
+
+
+        # Apply HAVING clause if present
+
+        return data
+
+    # Every grouping variable is keyed on the group: rows clustered on it are aggregated one group at a time
+    def finish(obj):
+        obj.min_1_price = aggregate_min.finalize(obj.min_1_price_state)
+        obj.max_1_price = aggregate_max.finalize(obj.max_1_price_state)
+        return True
+
+    def stream_groups(rows):
+        obj, current = None, None
+        for row in rows:
+            key = (row.get('prod'))
+            if obj is None or key != current:
+                if obj is not None and finish(obj):
+                    yield obj
+                obj, current = QueryStruct(), key
+                obj.prod = row.get('prod')
+            for step in dispatch(row):
+                step(obj, row)
+        if obj is not None and finish(obj):
+            yield obj
+
+    if ordered is not None:
+        data = stream_groups(ordered)
+    else:
+        # Above MEMORY_BUDGET the group table is built one hash partition of the rows at a time
+        data = grace_hash(evaluate, snapshot, scan, scan_groups, ['prod'], ['prod'], QueryStruct(), memory_budget)
 
     operations_dict = {'prod': {'found': False}, 'min_1_price': {'found': False}, 'max_1_price': {'found': False}}
     table = PrettyTable()
@@ -94,4 +198,3 @@ def query():
 
 if "__main__" == __name__:
     print(query())
-    
\ No newline at end of file
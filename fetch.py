@@ -0,0 +1,264 @@
+from array import array
+from datetime import date
+from decimal import Decimal
+from itertools import count
+from struct import Struct
+
+from snapshot import Column, PlainColumn, PlainInts, Snapshot
+
+# Columnar fetch path: COPY (SELECT ...) TO STDOUT in binary format, decoded in
+# large chunks straight into typed column buffers. No per-row tuples or dicts
+# are built; the buffers are wrapped as an in-memory Snapshot.
+
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+COPY_CHUNK = 8 * 1024 * 1024  # bytes buffered before a decode pass
+STREAM_ITERSIZE = 10000  # rows per round trip of a server-side cursor
+SQL_OPERATORS = {"==": "=", "!=": "<>", ">=": ">=", "<=": "<=", ">": ">", "<": "<"}
+POSTGRES_EPOCH = date(2000, 1, 1).toordinal()
+
+# type oid -> (decoder kind, struct)
+INT_TYPES = {20: Struct(">q"), 21: Struct(">h"), 23: Struct(">i")}
+FLOAT_TYPES = {700: Struct(">f"), 701: Struct(">d")}
+TEXT_TYPES = {19, 25, 1042, 1043}
+DATE_TYPE = 1082
+NUMERIC_TYPE = 1700
+BOOL_TYPE = 16
+SUPPORTED_TYPES = set(INT_TYPES) | set(FLOAT_TYPES) | TEXT_TYPES | {DATE_TYPE, NUMERIC_TYPE, BOOL_TYPE}
+NUMERIC_TYPES = set(INT_TYPES) | set(FLOAT_TYPES) | {NUMERIC_TYPE}
+
+INT16 = Struct(">h")
+INT32 = Struct(">i")
+NUMERIC_HEADER = Struct(">hhHh")
+
+_cursor_ids = count()  # server-side cursor names must be unique per connection
+
+
+def decode_numeric(view, pos):
+    ndigits, weight, sign, dscale = NUMERIC_HEADER.unpack_from(view, pos)
+    if sign == 0xC000:
+        return Decimal("NaN")
+    value = 0
+    for digit in Struct(f">{ndigits}h").unpack_from(view, pos + 8):
+        value = value * 10000 + digit
+    number = Decimal(f"{'-' if sign == 0x4000 else ''}{value}E{(weight - ndigits + 1) * 4}")
+    return number.quantize(Decimal(1).scaleb(-dscale))
+
+
+class BinaryCopyDecoder:
+    """File-like sink for COPY ... TO STDOUT (FORMAT binary) filling one typed buffer per column"""
+
+    def __init__(self, type_oids):
+        self.type_oids = type_oids
+        self.buffers = [array('q') if oid in INT_TYPES or oid == DATE_TYPE
+                        else array('d') if oid in FLOAT_TYPES else [] for oid in type_oids]
+        self.nulls = [[] for _ in type_oids]
+        self.row_count = 0
+        self._pending = bytearray()
+        self._header_done = False
+        self._finished = False
+
+    def write(self, data):
+        self._pending += data
+        if len(self._pending) >= COPY_CHUNK:
+            self.decode()
+
+    def close(self):
+        self.decode()
+        if not self._finished:
+            raise ValueError("Binary COPY stream ended without a trailer")
+
+    def decode(self):
+        """Decode every complete tuple in the pending bytes and drop them"""
+        view = memoryview(self._pending)
+        size = len(view)
+        pos = 0
+        if not self._header_done:
+            if size < 19:
+                return
+            if bytes(view[:11]) != COPY_SIGNATURE:
+                raise ValueError("Not a binary COPY stream")
+            pos = 19 + INT32.unpack_from(view, 15)[0]
+            self._header_done = True
+
+        buffers, nulls, oids = self.buffers, self.nulls, self.type_oids
+        unpack_int16, unpack_int32 = INT16.unpack_from, INT32.unpack_from
+        rows = self.row_count
+        while pos + 2 <= size:
+            (fields,) = unpack_int16(view, pos)
+            if fields == -1:
+                pos += 2
+                self._finished = True
+                break
+            field = pos + 2
+            done = 0
+            while done < fields:
+                if field + 4 > size:
+                    break
+                (length,) = unpack_int32(view, field)
+                field += 4
+                if length > 0 and field + length > size:
+                    break
+                oid = oids[done]
+                target = buffers[done]
+                if length < 0:
+                    nulls[done].append(rows)
+                    target.append(0 if isinstance(target, array) else None)
+                elif oid in INT_TYPES:
+                    target.append(INT_TYPES[oid].unpack_from(view, field)[0])
+                elif oid in TEXT_TYPES:
+                    target.append(str(view[field:field + length], "utf-8"))
+                elif oid == DATE_TYPE:
+                    target.append(unpack_int32(view, field)[0] + POSTGRES_EPOCH)
+                elif oid in FLOAT_TYPES:
+                    target.append(FLOAT_TYPES[oid].unpack_from(view, field)[0])
+                elif oid == NUMERIC_TYPE:
+                    target.append(decode_numeric(view, field))
+                else:
+                    target.append(view[field] != 0)
+                field += max(length, 0)
+                done += 1
+            if done < fields:
+                # Tuple split across chunks: undo its fields and wait for more data
+                for i in range(done):
+                    buffers[i].pop()
+                    if nulls[i] and nulls[i][-1] == rows:
+                        nulls[i].pop()
+                break
+            rows += 1
+            pos = field
+        self.row_count = rows
+        view.release()
+        del self._pending[:pos]
+
+    def columns(self, names):
+        """Wrap the buffers as snapshot columns; strings are dictionary encoded, nullable columns kept plain"""
+        columns = []
+        for name, oid, buffer, nulls in zip(names, self.type_oids, self.buffers, self.nulls):
+            if nulls:
+                # null slots hold 0, which is not a valid ordinal; they are overwritten below
+                values = [date.fromordinal(value or 1) for value in buffer] if oid == DATE_TYPE else list(buffer)
+                for row in nulls:
+                    values[row] = None
+                columns.append(PlainColumn(name, values))
+            elif oid in INT_TYPES:
+                columns.append(Column(name, "int", PlainInts(buffer)))
+            elif oid == DATE_TYPE:
+                columns.append(Column(name, "date", PlainInts(buffer)))
+            elif oid in TEXT_TYPES:
+                dictionary = sorted(set(buffer))
+                lookup = {value: code for code, value in enumerate(dictionary)}
+                columns.append(Column(name, "str", PlainInts(array('q', map(lookup.__getitem__, buffer))), dictionary))
+            else:
+                columns.append(PlainColumn(name, list(buffer)))
+        return columns
+
+
+def table_columns(connection, table, columns=None):
+    """[(name, type oid)] of the table columns among columns (all of them for None)"""
+    cursor = connection.cursor()
+    cursor.execute(f"SELECT * FROM {table} LIMIT 0")
+    available = [(desc[0], desc[1]) for desc in cursor.description]
+    cursor.close()
+    if columns is not None:
+        available = [item for item in available if item[0] in columns] or available[:1]
+    return available
+
+
+def where_clause(connection, conjuncts):
+    """SQL condition (literals inlined) for row-only (column, op, value) conjuncts, '' for none"""
+    if not conjuncts:
+        return ""
+    cursor = connection.cursor()
+    condition = cursor.mogrify(" AND ".join(f"{column} {SQL_OPERATORS[op]} %s" for column, op, _ in conjuncts),
+                               [value for _, _, value in conjuncts])
+    cursor.close()
+    return condition.decode("utf-8")
+
+
+def stream_rows(connection, table, columns=None, conjuncts=(), itersize=STREAM_ITERSIZE, order_by=()):
+    """Rows of one pass through a server-side cursor; row-only conjuncts become the WHERE clause"""
+    names = [name for name, _ in table_columns(connection, table, columns)]
+    where = where_clause(connection, conjuncts)
+    cursor = connection.cursor(name=f"scan_{next(_cursor_ids)}")
+    cursor.itersize = itersize
+    try:
+        cursor.execute(f"SELECT {', '.join(names)} FROM {table}" + (f" WHERE {where}" if where else "")
+                       + (f" ORDER BY {', '.join(order_by)}" if order_by else ""))
+        yield from cursor
+    finally:
+        cursor.close()
+
+
+def index_order(connection, table, keys):
+    """Leading columns of a btree index on table that are exactly the columns in keys, in the index's order (the
+    ORDER BY it can serve); None when no index leads with them"""
+    cursor = connection.cursor()
+    cursor.execute("SELECT array(SELECT a.attname FROM unnest(i.indkey) WITH ORDINALITY AS k(attnum, n) "
+                   "LEFT JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum ORDER BY k.n) "
+                   "FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid JOIN pg_am am ON am.oid = c.relam "
+                   "WHERE i.indrelid = %s::regclass AND am.amname = 'btree'", (table,))
+    indexes = [row[0] for row in cursor]
+    cursor.close()
+    return next((names[:len(keys)] for names in indexes if set(names[:len(keys)]) == set(keys)), None)
+
+
+def ordered_rows(snapshot, connection, table, keys, columns, scan_mode, itersize=STREAM_ITERSIZE):
+    """Rows clustered on keys when a sorted snapshot or a supporting index yields them cheaply, else None"""
+    if not keys:
+        return None
+    if snapshot is not None:
+        return snapshot.rows() if isinstance(snapshot, Snapshot) and snapshot.clustered_on(keys) else None
+    order = None if scan_mode == 'cursor' else index_order(connection, table, keys)
+    if order is None:
+        return None
+    # Grouping only needs equal keys to be adjacent, so the rows follow the index's column order
+    return stream_rows(connection, table, columns, (), itersize, order)
+
+
+def fetch_snapshot(connection, table, columns=None, where=""):
+    """In-memory snapshot of the given (existing) columns of table, streamed through binary COPY"""
+    available = table_columns(connection, table, columns)
+    cursor = connection.cursor()
+    names = [name for name, _ in available]
+    # Types without a binary decoder here are fetched as text
+    select_list = ", ".join(name if oid in SUPPORTED_TYPES else f"{name}::text" for name, oid in available)
+    decoder = BinaryCopyDecoder([oid if oid in SUPPORTED_TYPES else 25 for _, oid in available])
+    query = f"SELECT {select_list} FROM {table}" + (f" WHERE {where}" if where else "")
+    cursor.copy_expert(f"COPY ({query}) TO STDOUT (FORMAT binary)", decoder, COPY_CHUNK)
+    decoder.close()
+    cursor.close()
+    return Snapshot(decoder.columns(names), decoder.row_count)
+
+
+def summary_states(measure, type_oid, slots=None):
+    """SELECT list of a [total, count, low, high, values] run summary of measure computing only the slots read (all
+    for None); sums are taken of numeric columns only, unread sums and counts are 0 and unread extremes NULL"""
+    slots = ("total", "count", "low", "high", "values") if slots is None else slots
+    total = f"coalesce(sum({measure}), 0)" if "total" in slots and type_oid in NUMERIC_TYPES else "0"
+    low = f"min({measure})" if "low" in slots else "NULL"
+    high = f"max({measure})" if "high" in slots else "NULL"
+    values = f"count({measure})" if "values" in slots else "0"
+    return f"{total}, count(*), {low}, {high}, {values}"
+
+
+def summary_rows(snapshot, connection, table, keys, measures):
+    """Dict rows, one per distinct combination of keys, holding a [total, count, low, high, values] run summary per
+    measure ({measure: slots read}); the GROUP BY is pushed into the query without a snapshot. None when no keys
+    are given"""
+    if not keys:
+        return None
+    if snapshot is not None:
+        partials = [snapshot.aggregate(keys, (), measure, slots) for measure, slots in measures.items()]
+        return [dict(zip(keys, key), **{measure: partial[key] for measure, partial in zip(measures, partials)})
+                for key in partials[0]]
+
+    types = dict(table_columns(connection, table, list(measures)))
+    states = ", ".join(summary_states(measure, types.get(measure), slots) for measure, slots in measures.items())
+    key_list = ", ".join(keys)
+    cursor = connection.cursor()
+    cursor.execute(f"SELECT {key_list}, {states} FROM {table} GROUP BY {key_list}")
+    width = len(keys)
+    rows = [dict(zip(keys, row[:width]), **{measure: list(row[width + 5 * i:width + 5 * i + 5])
+                                             for i, measure in enumerate(measures)}) for row in cursor]
+    cursor.close()
+    return rows
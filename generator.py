@@ -2,15 +2,41 @@ import subprocess
 from sys import argv, stderr, stdout, exit
 import re
 import os
+import ast
+import operator
 from os.path import exists, basename, join
 from os import makedirs
 from itertools import combinations_with_replacement as cmb
+from textwrap import indent
+
+from aggregates import aggregate_key, input_columns, load_plugins, lookup
 
 # Configuration constants
 LOGGER_PREFIX = "GENERATOR"
+COMPARISONS = {"==": operator.eq, "!=": operator.ne, ">=": operator.ge, "<=": operator.le, ">": operator.gt, "<": operator.lt}
 USE_EXTENDED_MODE = True
 INDENT = "    "
 
+# Result projection of the generated code, one output row per group
+PROJECTION_CODE = """    for obj in data:
+        temp = []
+
+        for j in table.field_names:
+            if not operations_dict[j]['found']:
+                temp.append(getattr(obj, j))
+            else:
+                if not (operations_dict[j]['operand1'].isnumeric() or operations_dict[j]['operand2'].isnumeric()):
+                    value = eval(f"{getattr(obj, operations_dict[j]['operand1'])} {operations_dict[j]['operator']} {getattr(obj, operations_dict[j]['operand2'])}") # Use the template string
+                    temp.append(value)
+                else:
+                    is_1_int = True if operations_dict[j]['operand1'].isnumeric() else False
+                    is_2_int = True if operations_dict[j]['operand2'].isnumeric() else False
+                    int_expr_str = f"{operations_dict[j]['operand1']} {operations_dict[j]['operator']} {getattr(obj, operations_dict[j]['operand2'])}" if is_1_int else f"{getattr(obj, operations_dict[j]['operand1'])} {operations_dict[j]['operator']} {operations_dict[j]['operand2']}"
+                    value = eval(int_expr_str) # Evaluate the constructed expression string
+                    temp.append(value)
+        table.add_row(temp)
+"""
+
 
 class Logger:
     @staticmethod
@@ -44,17 +70,32 @@ class InputParser:
         keyword_map = {
             "s:": "s", "n:": "n", "v:": "v", 
             "f:": "f", "p:": "p", "g:": "g",
+            "o:": "o", "l:": "l",
             "(S)": "s", "(n)": "n", "(V)": "v", 
             "([F])": "f", "([C])": "p", "(G)": "g"
         }
         
-        result = {"s": [], "n": [], "v": [], "f": [], "p": [], "g": ""}
+        result = {"s": [], "n": [], "v": [], "f": [], "p": [], "g": "", "o": [], "l": None}
         active_section = None
 
         # Check if file is in EMF format (with parentheses)
         is_emf_format = any("(" in line for line in content)
         
         if is_emf_format:
+            # Optional trailing (O) order by and (L) limit sections follow (G)
+            for j, line in enumerate(content):
+                if line.strip() in ("(O)", "(L)"):
+                    marker = None
+                    for trailing in content[j:]:
+                        if trailing.strip() in ("(O)", "(L)"):
+                            marker = trailing.strip()
+                        elif trailing.strip() and marker == "(O)":
+                            result["o"] = InputParser.parse_order(trailing)
+                        elif trailing.strip() and marker == "(L)":
+                            result["l"] = InputParser.parse_limit(trailing)
+                    content = content[:j]
+                    break
+
             # Process EMF format 
             key_place = {}
             keyword = ["(S)", "(n)", "(V)", "([F])", "([C])", "(G)"]
@@ -150,6 +191,10 @@ class InputParser:
                     result[active_section].append(clean_line)
                 elif active_section == "g":
                     result[active_section] = clean_line
+                elif active_section == "o":
+                    result[active_section] = InputParser.parse_order(clean_line)
+                elif active_section == "l":
+                    result[active_section] = InputParser.parse_limit(clean_line)
         
         # Handle n as if it's a list of strings
         if isinstance(result["n"], list):
@@ -157,11 +202,52 @@ class InputParser:
                 result["n"] = len(result["n"])
         
         return result
+
+    @staticmethod
+    def parse_order(text):
+        """Parse an order by list like 'sum_1_quant desc, cust' into [(attribute, descending)]"""
+        order = []
+        for item in text.split(","):
+            words = item.split()
+            if not words:
+                continue
+            if len(words) > 2 or (len(words) == 2 and words[1].lower() not in ("asc", "desc")):
+                Logger.output(LOGGER_PREFIX, f"Invalid order by item: '{item.strip()}'", True)
+                exit(1)
+            order.append((words[0], len(words) == 2 and words[1].lower() == "desc"))
+        return order
+
+    @staticmethod
+    def parse_limit(text):
+        """Parse a limit, None when empty"""
+        text = text.strip()
+        if not text:
+            return None
+        if not text.isdigit():
+            Logger.output(LOGGER_PREFIX, f"Invalid limit: '{text}'", True)
+            exit(1)
+        return int(text)
+
+    @staticmethod
+    def parse_columns(text):
+        """Parse a comma separated column list, skipping empty entries"""
+        return [item.strip() for item in text.split(",") if item.strip()]
+
+    @staticmethod
+    def parse_block_size(text):
+        """Parse a snapshot block size, None when empty"""
+        text = text.strip()
+        if not text:
+            return None
+        if not text.isdigit() or int(text) == 0:
+            Logger.output(LOGGER_PREFIX, f"Invalid block size: '{text}'", True)
+            exit(1)
+        return int(text)
     
     @staticmethod
     def get_parameters_from_user():
         """Interactively collect query parameters from user input"""
-        result = {"s": [], "n": 0, "v": [], "f": [], "p": [], "g": ""}
+        result = {"s": [], "n": 0, "v": [], "f": [], "p": [], "g": "", "o": [], "l": None}
         
         # Get select attributes (s)
         s_input = input("Enter select attributes (comma-separated): ")
@@ -192,6 +278,12 @@ class InputParser:
         # Get having clause (g)
         g_input = input("Enter having clause (optional, press Enter to skip): ")
         result["g"] = g_input
+
+        # Get order by and limit (o, l)
+        o_input = input("Enter order by attributes, each optionally followed by asc/desc (optional, press Enter to skip): ")
+        result["o"] = InputParser.parse_order(o_input)
+        l_input = input("Enter limit (optional, press Enter to skip): ")
+        result["l"] = InputParser.parse_limit(l_input)
         
         return result
 
@@ -230,7 +322,194 @@ class PredicateManager:
         return " and ".join(processed_conditions)
 
 
+class PredicateAnalyzer:
+    CONJUNCT_PATTERN = re.compile(r"^(\d+)\.(\w+)\s*(==|!=|>=|<=|>|<)\s*(.+)$")
+
+    @staticmethod
+    def analyze(predicate, gv_num, grouping_attrs):
+        """Split a grouping variable predicate into row-only, correlated and residual conjuncts"""
+        analysis = {"row": [], "eq": {}, "neq": {}, "theta": []}
+        predicate = predicate.strip()
+
+        if not USE_EXTENDED_MODE:
+            # MF queries are implicitly correlated on every grouping attribute
+            analysis["eq"] = {attr: attr for attr in grouping_attrs}
+
+        if not predicate or predicate == "True":
+            return analysis
+        if re.search(r"\b(or|not)\b", predicate):
+            analysis["theta"].append(predicate)
+            return analysis
+
+        for piece in re.split(r"\s+and\s+", predicate):
+            match = PredicateAnalyzer.CONJUNCT_PATTERN.match(piece.strip())
+            if not match or match.group(1) != str(gv_num):
+                analysis["theta"].append(piece.strip())
+                continue
+
+            _, column, op, rhs = match.groups()
+            rhs = rhs.strip()
+            try:
+                analysis["row"].append((column, op, ast.literal_eval(rhs)))
+            except (ValueError, SyntaxError):
+                if rhs in grouping_attrs and op == "==":
+                    analysis["eq"][rhs] = column
+                elif rhs in grouping_attrs and op == "!=":
+                    analysis["neq"][rhs] = column
+                else:
+                    analysis["theta"].append(piece.strip())
+
+        return analysis
+
+    @staticmethod
+    def referenced_columns(grouping_attrs, aggregates, predicates):
+        """Sales columns a query reads: grouping attributes, aggregated attributes and predicate columns"""
+        columns = list(grouping_attrs)
+        for agg in aggregates:
+            columns += input_columns(agg)
+        for predicate in predicates:
+            columns += re.findall(r"\b\d+\.([A-Za-z_]\w*)", predicate)
+        return list(dict.fromkeys(columns))
+
+    @staticmethod
+    def is_keyed(analysis, grouping_attrs):
+        """True when the grouping variable is a plain hash aggregation on the full group key"""
+        return (not analysis["theta"] and not analysis["neq"]
+                and set(analysis["eq"]) == set(grouping_attrs))
+
+    @staticmethod
+    def ordered_keys(grouping_attrs, aggregates, predicates):
+        """Group key a sort-based streaming plan can run on (every grouping variable keyed on each attribute
+        by the same column, so a row only reaches its own group), None when some grouping variable is not or no
+        aggregate is computed from rows at all"""
+        qualified = False
+        for agg in aggregates:
+            parts = agg.split("_")
+            if len(parts) < 3 or aggregate_key(agg) is None:
+                continue
+            try:
+                predicate = predicates[int(parts[1])] if int(parts[1]) < len(predicates) else "True"
+            except ValueError:
+                predicate = "True"
+            analysis = PredicateAnalyzer.analyze(predicate, parts[1], grouping_attrs)
+            if not PredicateAnalyzer.is_keyed(analysis, grouping_attrs) or \
+                    any(analysis["eq"][attr] != attr for attr in grouping_attrs):
+                return None
+            qualified = True
+        return (list(grouping_attrs) or None) if qualified else None
+
+    @staticmethod
+    def conditions_code(conjuncts, subject):
+        """Python test of row-only conjuncts, subject(column) reading a column; NULL passes no comparison, as in SQL"""
+        tests, guarded = [], set()
+        for column, op, literal in conjuncts:
+            # None == literal is already False; the other operators would raise or match NULL
+            if op != "==" and column not in guarded:
+                guarded.add(column)
+                tests.append(f"{subject(column)} is not None")
+            tests.append(f"{subject(column)} {op} {literal!r}")
+        return " and ".join(tests)
+
+    @staticmethod
+    def conjunct_implies(conjunct, other):
+        """True when every value passing conjunct passes other (same column only)"""
+        column, op, value = conjunct
+        other_column, other_op, bound = other
+        if column != other_column:
+            return False
+        if conjunct == other:
+            return True
+        try:
+            if op == "==":
+                return bool(COMPARISONS[other_op](value, bound))
+            if op in ("<", "<="):
+                if other_op in ("<", "<="):
+                    return value < bound or (value == bound and (op == "<" or other_op == "<="))
+                return other_op == "!=" and (bound > value or (bound == value and op == "<"))
+            if op in (">", ">="):
+                if other_op in (">", ">="):
+                    return value > bound or (value == bound and (op == ">" or other_op == ">="))
+                return other_op == "!=" and (bound < value or (bound == value and op == ">"))
+        except TypeError:
+            pass
+        return False
+
+    @staticmethod
+    def implies(conjuncts, others):
+        """True when rows passing all of conjuncts pass all of others"""
+        return all(any(PredicateAnalyzer.conjunct_implies(conjunct, other) for conjunct in conjuncts)
+                   for other in others)
+
+    @staticmethod
+    def subsumption_parents(row_conjuncts):
+        """{index: parent index} nesting each conjunct list under the strongest non-empty list it implies
+        (equivalent lists nest under the earlier one), so its test only runs for rows that passed the parent"""
+        implies = PredicateAnalyzer.implies
+        parents = {}
+        for i, conjuncts in enumerate(row_conjuncts):
+            candidates = [j for j, others in enumerate(row_conjuncts)
+                          if j != i and others and implies(conjuncts, others)
+                          and (j < i or not implies(others, conjuncts))]
+            if candidates:
+                # the strongest candidate implies the most other candidates
+                parents[i] = max(candidates, key=lambda j: (sum(implies(row_conjuncts[j], row_conjuncts[k])
+                                                                for k in candidates), -j))
+        return parents
+
+    @staticmethod
+    def dispatch_column(row_conjuncts):
+        """Column that the row-only conditions of most grouping variables (at least two) test, so rows can be
+        routed on its value; None when no column is shared"""
+        counts = {}
+        for conjuncts in row_conjuncts:
+            for column in dict.fromkeys(column for column, _, _ in conjuncts):
+                counts[column] = counts.get(column, 0) + 1
+        column = max(counts, key=counts.get, default=None)
+        return column if column is not None and counts[column] >= 2 else None
+
+    @staticmethod
+    def summary_columns(grouping_attrs, aggregates, predicates):
+        """(keys, {measure: slots read}) when every aggregate can be built from [total, count, low, high, values] run
+        summaries of measures no predicate or grouping attribute reads, and some grouping variable is not keyed (keyed
+        ones already use hash or streaming plans); rows can then be pre-aggregated on keys. None otherwise"""
+        measures, keyed = {}, True
+        for agg in aggregates:
+            parts = agg.split("_")
+            func_type = aggregate_key(agg) if len(parts) >= 3 else None
+            if func_type is None:
+                continue
+            if not lookup(func_type).summary or len(input_columns(agg)) != 1:
+                return None
+            slots = measures.setdefault(parts[2], [])
+            slots.extend(slot for slot in lookup(func_type).summary if slot not in slots)
+            try:
+                predicate = predicates[int(parts[1])] if int(parts[1]) < len(predicates) else "True"
+            except ValueError:
+                predicate = "True"
+            keyed = keyed and PredicateAnalyzer.is_keyed(PredicateAnalyzer.analyze(predicate, parts[1], grouping_attrs),
+                                                         grouping_attrs)
+        read = set(grouping_attrs)
+        for predicate in predicates:
+            read.update(re.findall(r"\b\d+\.([A-Za-z_]\w*)", predicate))
+        if keyed or not measures or read.intersection(measures):
+            return None
+        keys = [column for column in PredicateAnalyzer.referenced_columns(grouping_attrs, aggregates, predicates)
+                if column not in measures]
+        return keys, measures
+
+
 class SchemaManager:
+    @staticmethod
+    def get_db_params():
+        """Database connection parameters from the environment"""
+        return {
+            'user': os.getenv('DB_USER', 'postgres'),
+            'password': os.getenv('DB_PASSWORD', '1234'),
+            'host': os.getenv('DB_HOST', 'localhost'),
+            'port': os.getenv('DB_PORT', '5432'),
+            'database': os.getenv('DB_NAME', 'sales')
+        }
+
     @staticmethod
     def get_schema_info(db_params):
         """Get database schema information"""
@@ -263,6 +542,112 @@ class SchemaManager:
             return []
 
 
+class SnapshotBuilder:
+    @staticmethod
+    def build(db_params, path, sort_by, block_size=None, partition_by=None):
+        """Dump the sales table into a local encoded snapshot, clustered on sort_by"""
+        import psycopg2
+        from snapshot import Snapshot, PartitionedSnapshot, BLOCK_SIZE
+
+        try:
+            connection = psycopg2.connect(
+                user=db_params['user'], password=db_params['password'], host=db_params['host'],
+                port=db_params['port'], database=db_params['database']
+            )
+            cursor = connection.cursor()
+            cursor.execute("SELECT * FROM sales")
+            names = [desc[0] for desc in cursor.description]
+            rows = cursor.fetchall()
+            cursor.close()
+            connection.close()
+        except Exception as error:
+            Logger.output(LOGGER_PREFIX, f"Error reading sales table for snapshot: {error}", True)
+            exit(1)
+
+        SnapshotBuilder.check_columns(names, sort_by, partition_by)
+        if partition_by:
+            try:
+                snapshot = PartitionedSnapshot.from_rows(names, rows, partition_by, sort_by, block_size or BLOCK_SIZE)
+            except ValueError as error:
+                Logger.output(LOGGER_PREFIX, f"Error partitioning snapshot: {error}", True)
+                exit(1)
+            snapshot.write(path)
+            Logger.output(LOGGER_PREFIX, f"Snapshot of {snapshot.row_count} rows in {len(snapshot.partitions)} "
+                                         f"partitions by {', '.join(partition_by)} saved to '{path}'")
+            return
+
+        snapshot = Snapshot.from_rows(names, rows, sort_by, block_size or BLOCK_SIZE)
+        snapshot.write(path)
+        encodings = ", ".join(f"{name}={column.encoding}" for name, column in snapshot.columns.items())
+        Logger.output(LOGGER_PREFIX, f"Snapshot of {snapshot.row_count} rows in blocks of {snapshot.block_size} "
+                                     f"saved to '{path}' ({encodings})")
+
+
+    @staticmethod
+    def check_columns(names, sort_by, partition_by):
+        """Exit with an error when a sort or partition column is not a column of the table"""
+        for kind, columns in (("sort", sort_by), ("partition", partition_by or [])):
+            unknown = [column for column in columns if column not in names]
+            if unknown:
+                Logger.output(LOGGER_PREFIX, f"Unknown {kind} column(s) {', '.join(unknown)}; the sales table has "
+                                             f"{', '.join(names)}", True)
+                exit(1)
+
+    @staticmethod
+    def index(path, names):
+        """Add bitmap indexes on low-cardinality columns of an existing snapshot"""
+        from snapshot import Snapshot
+
+        try:
+            snapshot = Snapshot.open(path)
+        except Exception as error:
+            Logger.output(LOGGER_PREFIX, f"Error opening snapshot '{path}': {error}", True)
+            exit(1)
+
+        indexed = snapshot.build_bitmaps(names)
+        snapshot.write(path)
+        Logger.output(LOGGER_PREFIX, f"Bitmap indexes on {', '.join(indexed) or 'no columns'} saved to '{path}'")
+        skipped = [name for name in names if name not in indexed]
+        if skipped:
+            Logger.output(LOGGER_PREFIX, f"Not indexed (missing or too many distinct values): {', '.join(skipped)}", True)
+
+
+class DataLoader:
+    @staticmethod
+    def load(db_params, input_path, snapshot_path=None):
+        """Bulk load an INSERT script or a CSV file through COPY, optionally writing a snapshot"""
+        import time
+        import psycopg2
+        from loader import BulkLoader
+        from snapshot import Snapshot
+
+        started = time.time()
+        try:
+            connection = psycopg2.connect(
+                user=db_params['user'], password=db_params['password'], host=db_params['host'],
+                port=db_params['port'], database=db_params['database']
+            )
+            loader = BulkLoader(connection, "sales" if snapshot_path else None)
+            with open(input_path, 'r') as file:
+                if input_path.endswith('.csv'):
+                    loader.load_csv(file, "sales")
+                else:
+                    for statement, error in loader.load_script(file):
+                        Logger.output(LOGGER_PREFIX, f"Statement '{statement}' failed: {str(error).strip()}", True)
+            loader.finish()
+            connection.close()
+        except Exception as error:
+            Logger.output(LOGGER_PREFIX, f"Error while loading '{input_path}': {error}", True)
+            exit(1)
+
+        Logger.output(LOGGER_PREFIX, f"Loaded {loader.loaded} rows from '{input_path}' in {time.time() - started:.2f}s")
+
+        if snapshot_path and loader.snapshot_names:
+            snapshot = Snapshot.from_rows(loader.snapshot_names, loader.snapshot_rows)
+            snapshot.write(snapshot_path)
+            Logger.output(LOGGER_PREFIX, f"Snapshot of {snapshot.row_count} rows saved to '{snapshot_path}'")
+
+
 class SqlQueryGenerator:
     @staticmethod
     def generate_sql_query_code(sql_query):
@@ -303,7 +688,101 @@ class SqlQueryGenerator:
 
 class CodeGenerator:
     @staticmethod
-    def generate_query_structure(s, n, v, f, p, g, schema=None):
+    def aggregate_variable(agg_func):
+        """Generated variable holding the aggregate of an f list entry; instanced aggregates get one per entry"""
+        func_type = aggregate_key(agg_func)
+        return f"aggregate_{agg_func}" if lookup(func_type).instanced else f"aggregate_{func_type}"
+
+    @staticmethod
+    def generate_snapshot_aggregates(snapshot_aggs, collected_aggs, p, v):
+        """Generate code answering keyed aggregates directly from the encoded snapshot"""
+        code = ""
+        # Single attribute groups are keyed by the bare value, not a 1-tuple
+        key_lookup = "key" if len(v) > 1 else "key[0]"
+        for (gv_num, names), agg_funcs in collected_aggs.items():
+            # Aggregates without a run summary form step through each group's values in one batch
+            analysis = PredicateAnalyzer.analyze(p[int(gv_num)], gv_num, v)
+            keys = [analysis["eq"][attr] for attr in v]
+            code += (f"    if snapshot is not None:\n"
+                     f"        for key, values in snapshot.collect({keys}, {analysis['row']}, {list(names)}).items():\n"
+                     f"            pos = group_by_map.get({key_lookup})\n"
+                     f"            if pos is None:\n"
+                     f"                continue\n")
+            for agg_func in agg_funcs:
+                agg_var = CodeGenerator.aggregate_variable(agg_func)
+                state = f"data[pos].{agg_func}_state"
+                code += f"            {state} = {agg_var}.step_many({state}, values)\n"
+            code += "\n"
+
+        for (gv_num, agg_attr), agg_funcs in snapshot_aggs.items():
+            analysis = PredicateAnalyzer.analyze(p[int(gv_num)], gv_num, v)
+            keys = [analysis["eq"][attr] for attr in v]
+            if all(agg_func.split("_")[0] == "count" for agg_func in agg_funcs):
+                # Counts alone are bitmap popcounts on indexed snapshots
+                code += (f"    if snapshot is not None:\n"
+                         f"        for key, count in snapshot.count({keys}, {analysis['row']}).items():\n"
+                         f"            total, low, high, present = 0, None, None, 0\n")
+            else:
+                # Only the run summary slots these aggregates read are computed where that costs a query
+                slots = list(dict.fromkeys(slot for agg_func in agg_funcs for slot in lookup(aggregate_key(agg_func)).summary))
+                code += (f"    if snapshot is not None:\n"
+                         f"        for key, (total, count, low, high, present) in snapshot.aggregate({keys}, {analysis['row']}, '{agg_attr}', {slots}).items():\n")
+            code += (f"            pos = group_by_map.get({key_lookup})\n"
+                     f"            if pos is None:\n"
+                     f"                continue\n")
+            for agg_func in agg_funcs:
+                agg_var = CodeGenerator.aggregate_variable(agg_func)
+                code += f"            data[pos].{agg_func}_state = {agg_var}.from_summary(total, count, low, high, present)\n"
+            code += "\n"
+        return code
+
+    @staticmethod
+    def generate_dispatch(gv_steps, key_code):
+        """Generate per grouping variable step functions, the dispatch routing rows to them and the fused pass"""
+        if not gv_steps:
+            return "", ""
+        gv_nums = list(gv_steps)
+        conjunct_lists = [gv_steps[gv_num]["row"] for gv_num in gv_nums]
+        # A grouping variable whose conditions imply another's is only tested inside the weaker one's step
+        parents = PredicateAnalyzer.subsumption_parents(conjunct_lists)
+        children = {}
+        for i, parent in parents.items():
+            children.setdefault(parent, []).append(i)
+
+        def body(i, settled):
+            """Step lines of grouping variable i and its nested ones, for rows already passing settled"""
+            conditions = PredicateAnalyzer.conditions_code([conjunct for conjunct in conjunct_lists[i]
+                                                            if conjunct not in settled], lambda name: f"row.get('{name}')")
+            lines = "".join(f"{line}\n" for line in gv_steps[gv_nums[i]]["lines"])
+            for child in children.get(i, []):
+                lines += body(child, settled + [conjunct for conjunct in conjunct_lists[i] if conjunct not in settled])
+            return f"if {conditions}:\n{indent(lines, '    ')}" if conditions else lines
+
+        roots = [i for i in range(len(gv_nums)) if i not in parents]
+        column = PredicateAnalyzer.dispatch_column([conjunct_lists[i] for i in roots])
+        code = ""
+        routes = []
+        for i in roots:
+            # Conditions on the dispatch column are settled by the routing table; the rest stay in the step
+            tests = [conjunct for conjunct in conjunct_lists[i] if conjunct[0] == column]
+            code += f"    def step_{gv_nums[i]}(obj, row):\n{indent(body(i, tests), '        ')}\n"
+            test = PredicateAnalyzer.conditions_code(tests, lambda name: "value") or "True"
+            routes.append(f"(lambda value: {test}, step_{gv_nums[i]})")
+        comment = (f"    # Rows are routed on {column} to the grouping variables whose conditions they can pass\n"
+                   if column else "")
+        code += comment + f"    dispatch = Dispatch({column!r}, [{', '.join(routes)}])\n\n"
+
+        fused = (f"    if snapshot is None:\n"
+                 f"        # One pass steps every keyed grouping variable of the row's group\n"
+                 f"        for row in scan():\n"
+                 f"            pos = group_by_map.get({key_code})\n"
+                 f"            if pos is not None:\n"
+                 f"                for step in dispatch(row):\n"
+                 f"                    step(data[pos], row)\n")
+        return code, fused
+
+    @staticmethod
+    def generate_query_structure(s, n, v, f, p, g, schema=None, order=(), limit=None):
         """Generate query processing code structure with EMF logic"""
         sql_dtypes_maps = {"character varying": "''", "character": "''", "integer": 0, "numeric": 0.0}
         mf_dtypes = {}
@@ -335,6 +814,8 @@ class CodeGenerator:
         
         # Initialize structure code
         struct_init_code = ""
+        state_init_code = ""
+        aggregate_binds = {}
         struct_attr_list = "["
         
         # v
@@ -348,22 +829,21 @@ class CodeGenerator:
             if len(func_parts) < 3:
                 continue
                 
-            func_type = func_parts[0]
+            func_type = aggregate_key(agg_func)
             struct_attr_list += f"'{agg_func}', "
             
-            # agg
-            if func_type == "sum" or func_type == "count":
-                struct_init_code += f"""        {agg_func} = 0\n"""
-            elif func_type == "avg":
-                sum_attr = f"{agg_func}_sum"
-                count_attr = f"{agg_func}_count"
-                struct_init_code += f"""        {sum_attr} = 0\n        {count_attr} = 0\n        {agg_func} = 0\n"""
-            elif func_type == "max":
-                struct_init_code += f"""        {agg_func} = float('-inf')\n"""
-            elif func_type == "min":
-                struct_init_code += f"""        {agg_func} = float('inf')\n"""
+            # agg: the reported value starts as the finalized empty state, the state is per instance
+            if func_type is not None:
+                agg_var = CodeGenerator.aggregate_variable(agg_func)
+                aggregate_binds[agg_var] = (f"    {agg_var} = lookup('{func_type}')"
+                                            + (".instance()\n" if lookup(func_type).instanced else "\n"))
+                struct_init_code += f"""        {agg_func} = {agg_var}.finalize({agg_var}.init())\n"""
+                state_init_code += f"""            self.{agg_func}_state = {agg_var}.init()\n"""
             else:
                 struct_init_code += f"""        {agg_func} = ""\n"""
+
+        if state_init_code:
+            struct_init_code += f"""\n        def __init__(self):\n{state_init_code}"""
         
         struct_attr_list = struct_attr_list[:-2] + "]" if struct_attr_list.endswith(", ") else struct_attr_list + "]"
         struct_init_code = struct_init_code[len(INDENT):] if struct_init_code else ""
@@ -384,12 +864,21 @@ class CodeGenerator:
             for attr in struct_attr_list[1:-1].replace("'", '').split(", "):
                 local_vars += f"        {INDENT}{attr} = data[pos].{attr}\n"
         
+        snapshot_aggs = {}
+        collected_aggs = {}
+        ordered_keys = PredicateAnalyzer.ordered_keys(v, f, p)
+        summary_columns = PredicateAnalyzer.summary_columns(v, f, p)
+        gv_steps = {}
+        stream_finish = ""
+        # Grouping attributes every grouping variable equates with the same row column: hashing rows and
+        # groups on them keeps each group and every row that can reach it in one partition
+        partition_attrs = list(v)
         for agg_func in f:
             func_parts = agg_func.split("_")
             if len(func_parts) < 3:
                 continue
                 
-            func_type, gv_num, agg_attr = func_parts[0], func_parts[1], func_parts[2]
+            func_type, gv_num, agg_attr = aggregate_key(agg_func), func_parts[1], func_parts[2]
             
             try:
                 pred_idx = int(gv_num)
@@ -399,6 +888,21 @@ class CodeGenerator:
                     pred = "True"  # Default
             except (ValueError, IndexError):
                 pred = "True"  
+
+            if func_type is None:
+                continue
+            agg_var = CodeGenerator.aggregate_variable(agg_func)
+
+            analysis = PredicateAnalyzer.analyze(pred, gv_num, v)
+            partition_attrs = [attr for attr in partition_attrs if analysis["eq"].get(attr) == attr]
+            # Keyed aggregates are answered from the snapshot when one is loaded
+            aggregate = lookup(func_type)
+            is_keyed = PredicateAnalyzer.is_keyed(analysis, v)
+            if is_keyed and aggregate.summary:
+                snapshot_aggs.setdefault((gv_num, agg_attr), []).append(agg_func)
+            elif is_keyed:
+                collected_aggs.setdefault((gv_num, tuple(input_columns(agg_func))), []).append(agg_func)
+            scan_call = f"scan({analysis['row']})" if analysis["row"] else "scan()"
             
             pred = pred.replace(f"{gv_num}.", "row.get('")
             pred = pred.replace("==", "')==")
@@ -407,41 +911,116 @@ class CodeGenerator:
             pred = pred.replace("<", "')<")
             
             # agg
-            agg_code = ""
-            if func_type == "sum":
-                agg_code = f"data[pos].{agg_func} += row.get('{agg_attr}')"
-            elif func_type == "count":
-                agg_code = f"data[pos].{agg_func} += 1"
-            elif func_type == "min":
-                agg_code = f"if row.get('{agg_attr}') is not None:\n                    data[pos].{agg_func} = min(data[pos].{agg_func}, row.get('{agg_attr}'))"
-            elif func_type == "max":
-                agg_code = f"if row.get('{agg_attr}') is not None:\n                    data[pos].{agg_func} = max(data[pos].{agg_func}, row.get('{agg_attr}'))"
-            elif func_type == "avg":
-                # Average
-                sum_var = f"data[pos].{agg_func}_sum"
-                count_var = f"data[pos].{agg_func}_count"
-                agg_code = (f"{sum_var} += row.get('{agg_attr}')\n"
-                            f"            {INDENT}{count_var} += 1\n\n"
-                            f"            {INDENT}if {count_var} != 0:\n"
-                            f"            {INDENT}    data[pos].{agg_func} = {sum_var} / {count_var}\n"
-                            f"            {INDENT}else:\n"
-                            f"            {INDENT}    data[pos].{agg_func} = 'Infinity'")
+            state = f"data[pos].{agg_func}_state"
+            inputs = input_columns(agg_func)
+            value = ", ".join(f"row.get('{column}')" for column in inputs)
+            value = f"({value})" if len(inputs) > 1 else value
+            agg_code = f"{state} = {agg_var}.step({state}, {value})"
+            if summary_columns:
+                # Pre-aggregated rows carry a [total, count, low, high, values] run summary of the measure instead of a value
+                agg_code = f"{state} = {agg_var}.merge({state}, {agg_var}.from_summary(*{value}))"
+            finalize_code = (f"    for obj in data:\n"
+                             f"        obj.{agg_func} = {agg_var}.finalize(obj.{agg_func}_state)\n\n")
+
+            conditions = PredicateAnalyzer.conditions_code(analysis["row"], lambda column: f"row.get('{column}')")
+            stream_finish += f"        obj.{agg_func} = {agg_var}.finalize(obj.{agg_func}_state)\n"
+            # Keyed on the group's own attributes: one row steps one group, in the fused pass or the streaming plan
+            own_key = USE_EXTENDED_MODE and is_keyed and all(analysis["eq"][attr] == attr for attr in v)
+            if own_key:
+                gv_steps.setdefault(gv_num, {"row": analysis["row"], "lines": []})["lines"].append(
+                    agg_code.replace("data[pos].", "obj."))
             
             if USE_EXTENDED_MODE:
-                agg_loops += (f"    cur.scroll(0, mode='absolute')\n\n"
-                            f"    for row in cur:\n"
+                agg_loop = (f"    for row in {scan_call}:\n"
                             f"        for pos in range(len(data)):\n"
                             f"{local_vars}\n"
                             f"            if {pred}:\n"
                             f"                {agg_code}\n")
             else:
-                agg_loops += (f"    cur.scroll(0, mode='absolute')\n\n"
-                            f"    for row in cur:\n"
+                agg_loop = (f"    for row in {scan_call}:\n"
                             f"        key = {key_code}\n"
                             f"        pos = group_by_map.get(key)\n"
                             f"{local_vars}\n"
                             f"        if {pred}:\n"
                             f"            {agg_code}\n")
+
+            complement = (USE_EXTENDED_MODE and not analysis["theta"] and len(analysis["neq"]) == 1
+                          and set(analysis["eq"]) | set(analysis["neq"]) == set(v)
+                          and (aggregate.invertible or aggregate.selective))
+            # A single theta conjunct comparing a row column with a group value is a threshold lookup
+            threshold = None
+            if USE_EXTENDED_MODE and not summary_columns and not analysis["neq"] and len(analysis["theta"]) == 1:
+                match = re.match(rf"^{gv_num}\.(\w+)\s*(>=|<=|>|<)\s*(\w+)$", analysis["theta"][0])
+                if match and match.group(3) in list(v) + list(f) and aggregate.summary and inputs == [agg_attr] \
+                        and (match.group(1) == agg_attr or aggregate.invertible):
+                    threshold = match.groups()
+            if complement:
+                # One attribute differs, the rest are equal: the outer (equal attributes) state less the group's own
+                outer = [attr for attr in v if attr in analysis["eq"]]
+                (inner, inner_column), = analysis["neq"].items()
+                part = (f"{agg_var}.from_summary(*{value})" if summary_columns
+                        else f"{agg_var}.step({agg_var}.init(), {value})")
+                outer_row = "".join(f"row.get('{analysis['eq'][attr]}'), " for attr in outer).rstrip()
+                outer_obj = "".join(f"obj.{attr}, " for attr in outer).rstrip()
+                add_code = f"complement_{agg_func}.add(({outer_row}), row.get('{inner_column}'), {part})"
+                agg_loop = (f"    complement_{agg_func} = Complement({agg_var})\n"
+                            f"    for row in {scan_call}:\n"
+                            + (f"        if {conditions}:\n            {add_code}\n" if conditions else f"        {add_code}\n")
+                            + f"    complement_{agg_func}.finish()\n"
+                            f"    for obj in data:\n"
+                            f"        obj.{agg_func}_state = complement_{agg_func}.state(({outer_obj}), obj.{inner})\n")
+            elif threshold:
+                # Per key measure values sorted on the column with prefix sums, searched with each group's threshold
+                column, op, bound = threshold
+                outer = [attr for attr in v if attr in analysis["eq"]]
+                outer_row = "".join(f"row.get('{analysis['eq'][attr]}'), " for attr in outer).rstrip()
+                outer_obj = "".join(f"obj.{attr}, " for attr in outer).rstrip()
+                add_code = f"threshold_{agg_func}.add(({outer_row}), row.get('{column}'), {value})"
+                agg_loop = (f"    threshold_{agg_func} = ThresholdIndex()\n"
+                            f"    for row in {scan_call}:\n"
+                            + (f"        if {conditions}:\n            {add_code}\n" if conditions else f"        {add_code}\n")
+                            + f"    threshold_{agg_func}.finish()\n"
+                            f"    for obj in data:\n"
+                            f"        obj.{agg_func}_state = {agg_var}.from_summary("
+                            f"*threshold_{agg_func}.summary(({outer_obj}), '{op}', obj.{bound}))\n")
+            elif USE_EXTENDED_MODE and not is_keyed and not analysis["theta"] and not analysis["neq"]:
+                # Correlated on a strict subset of the grouping attributes: aggregated once per coarser key
+                # (from run summaries when a snapshot is loaded) and broadcast to the groups by lookup
+                outer = [attr for attr in v if attr in analysis["eq"]]
+                outer_columns = [analysis["eq"][attr] for attr in outer]
+                outer_row = "".join(f"row.get('{column}'), " for column in outer_columns).rstrip()
+                outer_obj = "".join(f"obj.{attr}, " for attr in outer).rstrip()
+                start = f"{agg_var}.init() if state is None else state"
+                step = (f"{agg_var}.merge({start}, {agg_var}.from_summary(*{value}))"
+                        if summary_columns else f"{agg_var}.step({start}, {value})")
+                step_code = (f"key = ({outer_row})\n"
+                             f"state = coarse_{agg_func}.get(key)\n"
+                             f"coarse_{agg_func}[key] = {step}\n")
+                scan_loop = (f"coarse_{agg_func} = {{}}\n"
+                             f"for row in {scan_call}:\n"
+                             + indent(f"if {conditions}:\n{indent(step_code, '    ')}" if conditions else step_code, "    "))
+                if aggregate.summary:
+                    scan_loop = (f"if snapshot is not None:\n"
+                                 f"    coarse_{agg_func} = {{key: {agg_var}.from_summary(*state) "
+                                 f"for key, state in snapshot.aggregate("
+                                 f"{outer_columns}, {analysis['row']}, '{agg_attr}', {list(aggregate.summary)}).items()}}\n"
+                                 f"else:\n{indent(scan_loop, '    ')}")
+                agg_loop = (indent(scan_loop, "    ")
+                            + f"    for obj in data:\n"
+                            f"        state = coarse_{agg_func}.get(({outer_obj}))\n"
+                            f"        obj.{agg_func}_state = {agg_var}.init() if state is None else state\n")
+            elif USE_EXTENDED_MODE and not is_keyed:
+                # Group-table slices of the pass can run in forked workers sharing the snapshot
+                agg_loop = agg_loop.replace("range(len(data))", "range(lo, hi)")
+                agg_loop = (f"    def pass_{agg_func}(lo, hi):\n{indent(agg_loop, '    ')}"
+                            f"    run_slices(pass_{agg_func}, data, ['{agg_func}_state'], emf_workers, snapshot)\n")
+
+            if not own_key:
+                agg_loops += f"    if snapshot is None:\n{indent(agg_loop, '    ')}" if is_keyed else agg_loop
+            agg_loops += finalize_code
+
+        snapshot_code = CodeGenerator.generate_snapshot_aggregates(snapshot_aggs, collected_aggs, p, v)
+        steps_code, fused_code = CodeGenerator.generate_dispatch(gv_steps, key_code)
         
         # Having
         having_code = ""
@@ -469,15 +1048,41 @@ class CodeGenerator:
             ops_dict[attr] = parse_arithmetic(attr)
         
         select_cols = list(ops_dict.keys())
-        
-        return f"""
-    class QueryStruct:
-    {struct_init_code}
-    data = []
+
+        stream_code = ""
+        # The streaming plan steps groups through dispatch, which only exists when some grouping variable has steps
+        if ordered_keys and gv_steps:
+            stream_insertion = "".join(f"                obj.{attr} = row.get('{attr}')\n" for attr in v)
+            stream_code = f"""    # Every grouping variable is keyed on the group: rows clustered on it are aggregated one group at a time
+    def finish(obj):
+{stream_finish}        return {having_condition if g else True}
+
+    def stream_groups(rows):
+        obj, current = None, None
+        for row in rows:
+            key = {key_code}
+            if obj is None or key != current:
+                if obj is not None and finish(obj):
+                    yield obj
+                obj, current = QueryStruct(), key
+{stream_insertion}            for step in dispatch(row):
+                step(obj, row)
+        if obj is not None and finish(obj):
+            yield obj
+
+    if ordered is not None:
+        data = stream_groups(ordered)
+    else:
+"""
+        grace_code = (f"    # Above MEMORY_BUDGET the group table is built one hash partition of the rows at a time\n"
+                      f"    data = grace_hash(evaluate, snapshot, scan, scan_groups, {partition_attrs}, {list(v)}, "
+                      f"QueryStruct(), memory_budget)\n")
+
+        evaluate_code = f"""    data = []
 
     group_by_map = dict()
 
-    for row in cur:
+    for row in scan_groups({list(v)}):
         key = {key_code}
         if (not group_by_map.get(key)) and (group_by_map.get(key) != 0):
             data.append(QueryStruct())
@@ -485,69 +1090,48 @@ class CodeGenerator:
 
         pos = group_by_map.get(key)
 {group_insertion}
+{snapshot_code}{fused_code}
 {agg_loops}
     # Apply HAVING clause if present
 {having_code}
+    return data
+"""
 
+        projection_code = PROJECTION_CODE
+        if order or limit is not None:
+            # Rows are produced lazily with their order values for heap top-K / (external) sort
+            for attr, _ in order:
+                if attr not in v and attr not in f:
+                    Logger.output(LOGGER_PREFIX, f"Order by attribute '{attr}' is not a grouping attribute or aggregate", True)
+                    exit(1)
+            order_values = "".join(f"obj.{attr}, " for attr, _ in order).rstrip()
+            projection_code = ("    def output_rows():\n"
+                               + indent(projection_code.replace("table.add_row(temp)", f"yield (({order_values}), temp)"), "    ")
+                               + f"\n    for temp in order_rows(output_rows(), {[desc for _, desc in order]}, {limit}, memory_budget):\n"
+                               f"        table.add_row(temp)\n")
+        
+        return f"""
+{"".join(aggregate_binds.values())}
+    class QueryStruct:
+    {struct_init_code}
+{steps_code}    def evaluate(snapshot, scan, scan_groups):
+{indent(evaluate_code, '    ')}
+{stream_code}{indent(grace_code, "    ") if stream_code else grace_code}
     operations_dict = {ops_dict}
     table = PrettyTable()
     table.field_names = {select_cols}
 
-    for obj in data:
-        temp = []
-
-        for j in table.field_names:
-            if not operations_dict[j]['found']:
-                temp.append(getattr(obj, j))
-            else:
-                if not (operations_dict[j]['operand1'].isnumeric() or operations_dict[j]['operand2'].isnumeric()):
-                    value = eval(f"{{getattr(obj, operations_dict[j]['operand1'])}} {{operations_dict[j]['operator']}} {{getattr(obj, operations_dict[j]['operand2'])}}") # Use the template string
-                    temp.append(value)
-                else:
-                    is_1_int = True if operations_dict[j]['operand1'].isnumeric() else False
-                    is_2_int = True if operations_dict[j]['operand2'].isnumeric() else False
-                    int_expr_str = f"{{operations_dict[j]['operand1']}} {{operations_dict[j]['operator']}} {{getattr(obj, operations_dict[j]['operand2'])}}" if is_1_int else f"{{getattr(obj, operations_dict[j]['operand1'])}} {{operations_dict[j]['operator']}} {{operations_dict[j]['operand2']}}"
-                    value = eval(int_expr_str) # Evaluate the constructed expression string
-                    temp.append(value)
-        table.add_row(temp)
-
+{projection_code}
     # Printing the table
     return table
 """
 
 
-class QueryProcessor:
     @staticmethod
-    def execute(input_path, execute_code=True):
-        """Generate and optionally execute query code with schema awareness"""
-        global INDENT
-        if not USE_EXTENDED_MODE:
-            INDENT = ""
-        
-        # db connect
-        db_params = {
-            'user': os.getenv('DB_USER', 'postgres'),
-            'password': os.getenv('DB_PASSWORD', '1234'),
-            'host': os.getenv('DB_HOST', 'localhost'),
-            'port': os.getenv('DB_PORT', '5432'),
-            'database': os.getenv('DB_NAME', 'sales')
-        }
-        
-        schema = SchemaManager.get_schema_info(db_params)
-        
-        params = InputParser.extract_parameters(f"{input_path}")
-        
-        # Check if this is a SQL query
-        if 'sql_query' in params:
-            code_body = SqlQueryGenerator.generate_sql_query_code(params['sql_query'])
-        else:
-            # Process as EMF query
-            predicates = PredicateManager.create_default_grouping_predicate(params)
-            code_body = CodeGenerator.generate_query_structure(
-                params['s'], params['n'], params["v"], params["f"], predicates, params["g"], schema
-            )
-        
-        generated_code = f"""
+    def generate_module(code_body, input_path=None, is_sql=False, columns=None, ordered_keys=None, summary_columns=None):
+        """Wrap a generated query body into a runnable module"""
+        if is_sql:
+            return f"""
 import os
 import psycopg2
 import psycopg2.extras
@@ -578,6 +1162,144 @@ def query():
 if "__main__" == __name__:
     print(query())
     """
+
+        summary_keys, summary_measures = summary_columns or (None, None)
+
+        # Generated code registers the same aggregate plugins it was generated with
+        plugins = os.getenv('AGGREGATE_PLUGINS', '').strip()
+        plugin_code = f"load_plugins({plugins!r})\n" if plugins else ""
+
+        return f"""
+import os
+import sys
+import psycopg2
+import psycopg2.extras
+from prettytable import PrettyTable
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from snapshot import Snapshot
+from fetch import fetch_snapshot, ordered_rows, stream_rows, summary_rows, STREAM_ITERSIZE
+from parallel import ParallelTable, run_slices
+from shards import ShardedTable, shard_dsns
+from aggregates import Complement, Dispatch, ThresholdIndex, load_plugins, lookup
+from ordering import order_rows
+from spill import grace_hash
+{plugin_code}
+# DO NOT EDIT THIS FILE, IT IS GENERATED BY generator.py
+
+
+def query():
+    load_dotenv()
+
+    user = os.getenv('DB_USER', 'postgres')
+    password = os.getenv('DB_PASSWORD', '1234')
+    dbname = os.getenv('DB_NAME', 'sales')
+
+    # A local columnar snapshot replaces the database scan when SNAPSHOT_DIR points at one
+    snapshot_dir = os.getenv('SNAPSHOT_DIR')
+    snapshot = Snapshot.open(snapshot_dir) if snapshot_dir and os.path.isdir(snapshot_dir) else None
+
+    conn = psycopg2.connect("dbname="+dbname+" user="+user+" password="+password,
+                            cursor_factory=psycopg2.extras.DictCursor, host='127.0.0.1', port='5432')
+    cur = conn.cursor()
+
+    # Otherwise the referenced columns are pulled once through binary COPY; SCAN_MODE=cursor keeps the row cursor
+    # and SCAN_MODE=stream re-runs every pass on a server-side cursor, fetching SCAN_ITERSIZE rows at a time
+    scan_mode = os.getenv('SCAN_MODE', 'copy')
+    itersize = int(os.getenv('SCAN_ITERSIZE', STREAM_ITERSIZE))
+
+    # DB_SHARDS lists databases (dbname or host:port/dbname) that each hold part of the sales table
+    shards = os.getenv('DB_SHARDS')
+    if snapshot is None and shards:
+        snapshot = ShardedTable(shard_dsns(shards, user, password), 'sales', {columns})
+
+    # Queries keyed on the whole group stream groups off rows clustered on it: a snapshot sorted that way or,
+    # when an index supports the order, a server-side cursor with ORDER BY in place of the fetch
+    ordered = ordered_rows(snapshot, conn, 'sales', {ordered_keys}, {columns}, scan_mode, itersize)
+
+    # Queries that only need run summaries of their measures scan GROUP BY <other referenced columns> rows instead
+    summaries = summary_rows(snapshot, conn, 'sales', {summary_keys}, {summary_measures})
+
+    # With SCAN_WORKERS > 1 keyed aggregates are split over block ranges, one process and connection per worker
+    workers = int(os.getenv('SCAN_WORKERS', '1'))
+    if snapshot is None and ordered is None and summaries is None and scan_mode == 'copy' and workers > 1:
+        dsn = "dbname="+dbname+" user="+user+" password="+password+" host=127.0.0.1 port=5432"
+        snapshot = ParallelTable(conn, dsn, 'sales', {columns}, workers)
+    if snapshot is None and ordered is None and summaries is None and scan_mode == 'copy':
+        snapshot = fetch_snapshot(conn, 'sales', {columns})
+    if snapshot is None and ordered is None and summaries is None and scan_mode != 'stream':
+        cur.execute("SELECT * FROM sales")
+
+    # EMF_WORKERS > 1 evaluates non-keyed EMF passes for disjoint slices of the group table in parallel
+    emf_workers = int(os.getenv('EMF_WORKERS', '1'))
+
+    # MEMORY_BUDGET (MB, 0 for unlimited) bounds the group table and the rows an ORDER BY sorts in memory;
+    # beyond it rows are spilled to temporary files
+    memory_budget = float(os.getenv('MEMORY_BUDGET', '0'))
+
+    def scan(conjuncts=()):
+        if summaries is not None:
+            return summaries
+        if snapshot is not None:
+            return snapshot.rows(conjuncts)
+        if scan_mode == 'stream':
+            return stream_rows(conn, 'sales', {columns}, conjuncts, itersize)
+        cur.scroll(0, mode='absolute')
+        return cur
+
+    def scan_groups(keys):
+        if snapshot is not None:
+            # Distinct group keys without reading whole rows, in order of first appearance in a local snapshot
+            return (dict(zip(keys, key)) for key in snapshot.count(keys, ()))
+        return scan()
+
+    _global = []
+    {code_body}
+
+if "__main__" == __name__:
+    print(query())
+"""
+
+
+class QueryProcessor:
+    @staticmethod
+    def execute(input_path, execute_code=True):
+        """Generate and optionally execute query code with schema awareness"""
+        global INDENT
+        if not USE_EXTENDED_MODE:
+            INDENT = ""
+        
+        # db connect
+        db_params = SchemaManager.get_db_params()
+        
+        schema = SchemaManager.get_schema_info(db_params)
+        
+        params = InputParser.extract_parameters(f"{input_path}")
+        
+        # Check if this is a SQL query
+        if 'sql_query' in params:
+            code_body = SqlQueryGenerator.generate_sql_query_code(params['sql_query'])
+        else:
+            # Process as EMF query
+            predicates = PredicateManager.create_default_grouping_predicate(params)
+            try:
+                code_body = CodeGenerator.generate_query_structure(
+                    params['s'], params['n'], params["v"], params["f"], predicates, params["g"], schema,
+                    params["o"], params["l"]
+                )
+            except ValueError as error:
+                # Bad aggregate parameters such as p150 are rejected here rather than when the query runs
+                Logger.output(LOGGER_PREFIX, f"Error generating query from '{input_path}': {error}", True)
+                exit(1)
+        
+        columns = None if 'sql_query' in params else PredicateAnalyzer.referenced_columns(params["v"], params["f"], predicates)
+        ordered_keys = None if 'sql_query' in params or not USE_EXTENDED_MODE else \
+            PredicateAnalyzer.ordered_keys(params["v"], params["f"], predicates)
+        summary_columns = None if 'sql_query' in params else \
+            PredicateAnalyzer.summary_columns(params["v"], params["f"], predicates)
+        generated_code = CodeGenerator.generate_module(code_body, input_path, 'sql_query' in params, columns,
+                                                       ordered_keys, summary_columns)
         
         # Determine output directory based on query type
         if 'sql_query' in params:
@@ -614,8 +1336,38 @@ class Application:
     def run():
         global USE_EXTENDED_MODE  
         
+        try:
+            load_plugins()
+        except Exception as error:
+            Logger.output(LOGGER_PREFIX, f"Error loading aggregate plugins: {error}", True)
+            exit(1)
+
+        if len(argv) > 1 and argv[1] == "snapshot":
+            path = argv[2] if len(argv) > 2 else os.getenv('SNAPSHOT_DIR', 'snapshot')
+            sort_by = InputParser.parse_columns(argv[3]) if len(argv) > 3 else []
+            block_size = InputParser.parse_block_size(argv[4]) if len(argv) > 4 else None
+            partition_by = InputParser.parse_columns(argv[5]) if len(argv) > 5 else []
+            SnapshotBuilder.build(SchemaManager.get_db_params(), path, sort_by, block_size, partition_by)
+            exit(0)
+
+        if len(argv) > 1 and argv[1] == "load":
+            if len(argv) < 3:
+                Logger.output(LOGGER_PREFIX, "Usage: python generator.py load input_file.sql|input_file.csv [snapshot_dir]", True)
+                exit(1)
+            DataLoader.load(SchemaManager.get_db_params(), argv[2], argv[3] if len(argv) > 3 else None)
+            exit(0)
+
+        if len(argv) > 1 and argv[1] == "index":
+            path = argv[2] if len(argv) > 2 else os.getenv('SNAPSHOT_DIR', 'snapshot')
+            names = InputParser.parse_columns(argv[3]) if len(argv) > 3 else ["state", "prod", "month", "year"]
+            SnapshotBuilder.index(path, names)
+            exit(0)
+
         if len(argv) == 1:
             Logger.output(LOGGER_PREFIX, "Usage: python generator.py input_file_path|user [dont-run?] [mf?]", True)
+            Logger.output(LOGGER_PREFIX, "       python generator.py snapshot [dir] [sort_columns] [block_size] [partition_columns]", True)
+            Logger.output(LOGGER_PREFIX, "       python generator.py index [dir] [columns]", True)
+            Logger.output(LOGGER_PREFIX, "       python generator.py load input_file.sql|input_file.csv [snapshot_dir]", True)
             Logger.output(LOGGER_PREFIX, "Input path or 'user' is required", True)
             exit(1)
         elif len(argv) == 2:
@@ -628,18 +1380,13 @@ class Application:
                 temp_file = "user_query.txt"
                 
                 # Process the user input
-                db_params = {
-                    'user': os.getenv('DB_USER', 'postgres'),
-                    'password': os.getenv('DB_PASSWORD', '1234'),
-                    'host': os.getenv('DB_HOST', 'localhost'),
-                    'port': os.getenv('DB_PORT', '5432'),
-                    'database': os.getenv('DB_NAME', 'sales')
-                }
+                db_params = SchemaManager.get_db_params()
                 
                 schema = SchemaManager.get_schema_info(db_params)
                 
                 code_body = CodeGenerator.generate_query_structure(
-                    params['s'], params['n'], params["v"], params["f"], predicates, params["g"], schema
+                    params['s'], params['n'], params["v"], params["f"], predicates, params["g"], schema,
+                    params["o"], params["l"]
                 )
                 
                 # Create the output directory if it doesn't exist
@@ -648,33 +1395,11 @@ class Application:
                     makedirs(output_dir)
                 
                 # Generate the Python code
-                generated_code = f"""
-import os
-import psycopg2
-import psycopg2.extras
-from prettytable import PrettyTable
-from dotenv import load_dotenv
-
-# DO NOT EDIT THIS FILE, IT IS GENERATED BY generator.py
-
-def query():
-    load_dotenv()
-
-    user = os.getenv('DB_USER', 'postgres')
-    password = os.getenv('DB_PASSWORD', '1234')
-    dbname = os.getenv('DB_NAME', 'sales')
-
-    conn = psycopg2.connect("dbname="+dbname+" user="+user+" password="+password,
-                            cursor_factory=psycopg2.extras.DictCursor, host='127.0.0.1', port='5432')
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM sales")
-
-    _global = []
-    {code_body}
-
-if "__main__" == __name__:
-    print(query())
-"""
+                columns = PredicateAnalyzer.referenced_columns(params["v"], params["f"], predicates)
+                ordered_keys = PredicateAnalyzer.ordered_keys(params["v"], params["f"], predicates)
+                summary_columns = PredicateAnalyzer.summary_columns(params["v"], params["f"], predicates)
+                generated_code = CodeGenerator.generate_module(code_body, columns=columns, ordered_keys=ordered_keys,
+                                                               summary_columns=summary_columns)
                 
                 # Write and execute the generated code
                 output_file = "user_query_generated.py"
@@ -0,0 +1,195 @@
+import csv
+import io
+import re
+from datetime import date
+from decimal import Decimal
+
+# Streaming bulk loader: parses INSERT scripts (like sales.sql) or CSV files
+# and loads them through COPY FROM STDIN in large batches instead of running
+# one statement per row.
+
+BATCH_ROWS = 100000
+
+INSERT_PATTERN = re.compile(r"\s*insert\s+into\s+([\w.\"]+)\s*(?:\(([^)]*)\))?\s*values\s*", re.IGNORECASE)
+# Quoted literal | paren | ::type cast suffix (dropped, COPY converts the text) | bare word
+TOKEN_PATTERN = re.compile(r"'([^']*(?:''[^']*)*)'|([()])|(::\s*[A-Za-z_][\w\" .]*(?:\([^)]*\))?(?:\[\])*)"
+                           r"|([^,()'\s;:]+)")
+COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+SPECIAL_PATTERN = re.compile(r"[\\\n\r]")
+
+TYPE_CONVERTERS = {
+    "integer": int, "smallint": int, "bigint": int,
+    "numeric": Decimal, "real": float, "double precision": float,
+    "date": date.fromisoformat,
+}
+
+
+class ScriptParser:
+    @staticmethod
+    def statements(file):
+        """Yield ';'-terminated statements line by line, keeping quoted semicolons intact"""
+        buffer = []
+        quotes = 0
+        for line in file:
+            stripped = line.strip()
+            if not buffer and (not stripped or stripped.startswith("--")):
+                continue
+            buffer.append(line)
+            quotes += line.count("'")
+            if quotes % 2 == 0 and stripped.endswith(";"):
+                yield "".join(buffer)
+                buffer = []
+                quotes = 0
+        if buffer and "".join(buffer).strip():
+            yield "".join(buffer)
+
+    @staticmethod
+    def parse_insert(statement):
+        """(table, columns or None, rows) for an INSERT ... VALUES statement, None for anything else"""
+        match = INSERT_PATTERN.match(statement)
+        if not match:
+            return None
+        return match.group(1), ScriptParser.parse_columns(match.group(2)), ScriptParser.parse_values(statement, match.end())
+
+    @staticmethod
+    def parse_columns(columns):
+        return [column.strip().strip('"') for column in columns.split(",")] if columns else None
+
+    @staticmethod
+    def parse_values(text, pos=0):
+        """Rows of a VALUES list; also accepts the VALUES lists of many statements joined together"""
+        rows = []
+        row = None
+        for quoted, paren, cast, bare in TOKEN_PATTERN.findall(text, pos):
+            if cast:
+                continue
+            if paren == "(":
+                row = []
+            elif paren == ")":
+                rows.append(row)
+            elif bare:
+                row.append(None if bare.upper() == "NULL" else bare)
+            else:
+                row.append(quoted.replace("''", "'") if "''" in quoted else quoted)
+        return rows
+
+
+class BulkLoader:
+    """Batches parsed rows per target table into COPY FROM STDIN calls"""
+
+    def __init__(self, connection, snapshot_table=None):
+        self.connection = connection
+        self.snapshot_table = snapshot_table
+        self.snapshot_names = None
+        self.snapshot_rows = []
+        self.loaded = 0
+        self._batches = {}
+        self._columns = {}
+
+    def table_columns(self, table):
+        """[(column, data_type)] in table order"""
+        if table not in self._columns:
+            schema, _, name = table.rpartition(".")
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT column_name, data_type FROM information_schema.columns "
+                           "WHERE table_name = %s AND table_schema = %s ORDER BY ordinal_position",
+                           (name.strip('"'), (schema or "public").strip('"')))
+            self._columns[table] = cursor.fetchall()
+            cursor.close()
+        return self._columns[table]
+
+    @staticmethod
+    def copy_line(row):
+        """COPY text format line; escaping is only paid for values that need it"""
+        if None not in row:
+            line = "\t".join(row)
+            if line.count("\t") == len(row) - 1 and not SPECIAL_PATTERN.search(line):
+                return line
+        return "\t".join("\\N" if value is None else value.translate(COPY_ESCAPES) for value in row)
+
+    def add(self, table, columns, rows):
+        key = (table, tuple(columns) if columns else None)
+        batch = self._batches.setdefault(key, [])
+        batch.extend(rows)
+        if len(batch) >= BATCH_ROWS:
+            self.flush(key)
+
+    def flush(self, key=None):
+        for batch_key in ([key] if key else list(self._batches)):
+            table, columns = batch_key
+            rows = self._batches.pop(batch_key, [])
+            if not rows:
+                continue
+            names = list(columns) if columns else [name for name, _ in self.table_columns(table)]
+            buffer = io.StringIO("\n".join(map(BulkLoader.copy_line, rows)) + "\n")
+            cursor = self.connection.cursor()
+            cursor.copy_expert(f"COPY {table} ({', '.join(names)}) FROM STDIN", buffer)
+            cursor.close()
+            self.loaded += len(rows)
+            if self.snapshot_table and table.rpartition(".")[2].strip('"') == self.snapshot_table:
+                self.keep_for_snapshot(table, names, rows)
+
+    def keep_for_snapshot(self, table, names, rows):
+        """Convert text values to the table's Python types, in table column order"""
+        types = dict(self.table_columns(table))
+        if self.snapshot_names is None:
+            self.snapshot_names = [name for name, _ in self.table_columns(table)]
+        positions = [names.index(name) if name in names else None for name in self.snapshot_names]
+        converters = [TYPE_CONVERTERS.get(types.get(name), str) for name in self.snapshot_names]
+        for row in rows:
+            self.snapshot_rows.append(tuple(
+                None if pos is None or row[pos] is None else convert(row[pos])
+                for pos, convert in zip(positions, converters)
+            ))
+
+    def execute(self, statement):
+        """Run a non-INSERT statement (DDL) in its own transaction"""
+        self.flush()
+        self.connection.commit()
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(statement)
+            self.connection.commit()
+            return None
+        except Exception as error:
+            self.connection.rollback()
+            return error
+        finally:
+            cursor.close()
+
+    def load_script(self, file):
+        """Stream an SQL script; yields errors from statements that failed"""
+        head, bodies = None, []
+        for statement in ScriptParser.statements(file):
+            match = INSERT_PATTERN.match(statement)
+            if match is not None and statement[:match.end()] == head and len(bodies) < BATCH_ROWS:
+                # Runs of INSERTs into the same target are tokenized together
+                bodies.append(statement[match.end():])
+                continue
+            if bodies:
+                self.add(*ScriptParser.parse_insert(head + "".join(bodies)))
+            head, bodies = None, []
+            if match is None:
+                error = self.execute(statement)
+                if error is not None:
+                    yield statement.strip().splitlines()[0], error
+            else:
+                head, bodies = statement[:match.end()], [statement[match.end():]]
+        if bodies:
+            self.add(*ScriptParser.parse_insert(head + "".join(bodies)))
+
+    def load_csv(self, file, table):
+        """Stream a CSV file with a header row naming the columns"""
+        reader = csv.reader(file)
+        columns = [name.strip() for name in next(reader)]
+        batch = []
+        for record in reader:
+            batch.append([value if value != "" else None for value in record])
+            if len(batch) >= BATCH_ROWS:
+                self.add(table, columns, batch)
+                batch = []
+        self.add(table, columns, batch)
+
+    def finish(self):
+        self.flush()
+        self.connection.commit()
@@ -0,0 +1,73 @@
+import heapq
+import sys
+from itertools import chain, islice
+
+from spill import MEGABYTE, read_spilled, spill
+
+# ORDER BY / LIMIT over result rows. A LIMIT keeps only the best K rows in a
+# heap; a full ORDER BY sorts in memory unless the rows exceed the memory
+# budget, in which case sorted runs are spilled to temporary files and merged.
+
+
+class Descending:
+    """Sort key wrapper that reverses the order of the wrapped value"""
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def sort_key(descending):
+    """Key over a tuple of order values; NULLs sort last ascending and first descending, as in PostgreSQL"""
+    def key(values):
+        return tuple(Descending((value is None, value)) if desc else (value is None, value)
+                     for value, desc in zip(values, descending))
+    return key
+
+
+def row_size(row):
+    """Rough in-memory size of a (order values, output row) pair in bytes"""
+    values, output = row
+    return (sys.getsizeof(row) + sys.getsizeof(values) + sys.getsizeof(output)
+            + sum(sys.getsizeof(value) for value in values) + sum(sys.getsizeof(value) for value in output))
+
+
+def external_sort(rows, key, run_rows):
+    """Sorted rows; input longer than run_rows is sorted in runs spilled to disk and merged"""
+    rows = iter(rows)
+    runs = []
+    while True:
+        run = list(islice(rows, run_rows))
+        run.sort(key=key)
+        if not runs and len(run) < run_rows:
+            return iter(run)  # everything fit in one run
+        if run:
+            runs.append(spill(run))
+        if len(run) < run_rows:
+            break
+    return heapq.merge(*(read_spilled(file) for file in runs), key=key)
+
+
+def order_rows(rows, descending, limit=None, memory_budget=0):
+    """Output rows of (order values, output row) pairs, ordered and limited; memory_budget in MB, 0 for none"""
+    rows = iter(rows)
+    if not descending:
+        return (output for _, output in islice(rows, limit))
+    key = sort_key(descending)
+    row_key = lambda row: key(row[0])
+    if limit is not None:
+        return (output for _, output in heapq.nsmallest(limit, rows, key=row_key))
+    if not memory_budget:
+        return (output for _, output in sorted(rows, key=row_key))
+
+    first = next(rows, None)
+    if first is None:
+        return iter(())
+    run_rows = max(1, int(memory_budget * MEGABYTE // row_size(first)))
+    return (output for _, output in external_sort(chain([first], rows), row_key, run_rows))
@@ -0,0 +1,208 @@
+import atexit
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+
+import psycopg2
+
+from fetch import fetch_snapshot, where_clause
+from snapshot import merge_aggregates
+
+# Partition-wise parallel aggregation: the table is split into disjoint ctid
+# block ranges, every worker process fetches and aggregates its ranges over its
+# own connection, and the partial [total, count, low, high, values] run summaries
+# are merged.
+
+RANGES_PER_WORKER = 4  # more ranges than workers evens out skewed blocks
+SLOT_INT, SLOT_FLOAT, SLOT_OTHER = 0, 1, 2
+
+_connection = None
+
+
+def _connect(dsn):
+    global _connection
+    _connection = psycopg2.connect(dsn)
+
+
+def _aggregate_range(task):
+    """Partial aggregate of one block range, in a worker"""
+    table, columns, condition, keys, measure = task
+    snapshot = fetch_snapshot(_connection, table, columns, condition)
+    if measure is None:
+        return {key: [0, count, None, None, 0] for key, count in snapshot.count(keys, ()).items()}
+    return snapshot.aggregate(keys, (), measure)
+
+
+class ParallelTable:
+    """Database table whose keyed aggregates run across worker processes; other scans use one COPY fetch"""
+
+    def __init__(self, connection, dsn, table, columns, workers):
+        self.connection = connection
+        self.dsn = dsn
+        self.table = table
+        self.columns = columns
+        self.workers = workers
+        self._local = None
+        self._pool = None
+
+    def block_ranges(self):
+        """Disjoint ctid conditions covering the table; the last range is open ended"""
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT pg_relation_size(%s) / current_setting('block_size')::bigint", (self.table,))
+        pages = cursor.fetchone()[0]
+        cursor.close()
+        count = max(1, min(self.workers * RANGES_PER_WORKER, pages))
+        bounds = [pages * i // count for i in range(count)]
+        ranges = []
+        for i, low in enumerate(bounds):
+            condition = f"ctid >= '({low},0)'::tid"
+            if i + 1 < count:
+                condition += f" AND ctid < '({bounds[i + 1]},0)'::tid"
+            ranges.append(condition)
+        return ranges
+
+    def pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.workers, initializer=_connect, initargs=(self.dsn,))
+            atexit.register(self.close)
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def local(self):
+        if self._local is None:
+            self._local = fetch_snapshot(self.connection, self.table, self.columns)
+        return self._local
+
+    def rows(self, conjuncts=(), names=None):
+        return self.local().rows(conjuncts, names)
+
+    def collect(self, keys, conjuncts, names):
+        return self.local().collect(keys, conjuncts, names)
+
+    def aggregate(self, keys, conjuncts, measure, slots=None):
+        where = where_clause(self.connection, conjuncts)
+        columns = list(keys) + ([measure] if measure else [])
+        tasks = [(self.table, columns, f"{condition} AND {where}" if where else condition, list(keys), measure)
+                 for condition in self.block_ranges()]
+        result = {}
+        for partial in self.pool().imap_unordered(_aggregate_range, tasks):
+            merge_aggregates(result, partial)
+        return result
+
+    def count(self, keys, conjuncts):
+        return {key: state[1] for key, state in self.aggregate(keys, conjuncts, None).items()}
+
+
+# Group-sliced EMF passes: forked workers share the parent's snapshot pages
+# (copy-on-write, nothing is pickled) and each one evaluates a pass for a
+# disjoint slice of the group table against all rows. Scalar accumulators (int
+# and float states) come back through typed shared-memory slots; tuples,
+# sketches and heaps (avg, var, median, countd, topk states) are piped back
+# pickled.
+
+class SharedAccumulators:
+    """Shared-memory slots for fields x groups, each an int64 or a float64 tagged by type"""
+
+    def __init__(self, groups, fields):
+        self.fields = fields
+        self.size = max(1, groups * len(fields))
+        self.memory = SharedMemory(create=True, size=self.size * 9)
+        self.ints = self.memory.buf[:self.size * 8].cast("q")
+        self.floats = self.memory.buf[:self.size * 8].cast("d")
+        self.tags = self.memory.buf[self.size * 8:]
+
+    def store(self, data, lo, hi):
+        """Write the fields of data[lo:hi]; returns {(pos, field): value} that need pickling"""
+        overflow = {}
+        width = len(self.fields)
+        for pos in range(lo, hi):
+            for i, field in enumerate(self.fields):
+                value = getattr(data[pos], field)
+                slot = pos * width + i
+                if type(value) is int and -2 ** 63 <= value < 2 ** 63:
+                    self.ints[slot], self.tags[slot] = value, SLOT_INT
+                elif type(value) is float:
+                    self.floats[slot], self.tags[slot] = value, SLOT_FLOAT
+                else:
+                    self.tags[slot] = SLOT_OTHER
+                    overflow[(pos, field)] = value
+        return overflow
+
+    def load(self, data, lo, hi):
+        width = len(self.fields)
+        for pos in range(lo, hi):
+            for i, field in enumerate(self.fields):
+                slot = pos * width + i
+                if self.tags[slot] == SLOT_INT:
+                    setattr(data[pos], field, self.ints[slot])
+                elif self.tags[slot] == SLOT_FLOAT:
+                    setattr(data[pos], field, self.floats[slot])
+
+    def release(self):
+        self.ints.release()
+        self.floats.release()
+        self.tags.release()
+        self.memory.close()
+        self.memory.unlink()
+
+
+def _run_slice(body, data, slots, lo, hi, sender):
+    try:
+        body(lo, hi)
+        sender.send((slots.store(data, lo, hi), None))
+    except Exception as error:
+        sender.send(({}, repr(error)))
+    finally:
+        sender.close()
+
+
+def run_slices(body, data, fields, workers, source=None):
+    """Run body(lo, hi) for disjoint slices of the group table, in forked workers when workers > 1 and the rows come
+    from a snapshot source. Sources reading over database connections (ParallelTable, ShardedTable) are fetched
+    into memory first: forked workers must not use the parent's connections"""
+    workers = min(workers, len(data)) if source is not None else 1
+    if workers <= 1:
+        body(0, len(data))
+        return
+    if hasattr(source, "local"):
+        source.local()
+
+    context = multiprocessing.get_context("fork")
+    slots = SharedAccumulators(len(data), fields)
+    bounds = [len(data) * i // workers for i in range(workers + 1)]
+    slices = list(zip(bounds, bounds[1:]))
+    # One pipe per worker: a worker that dies without reporting shows up as EOF instead of a hang
+    pipes = [context.Pipe(duplex=False) for _ in slices]
+    processes = [context.Process(target=_run_slice, args=(body, data, slots, lo, hi, sender))
+                 for (lo, hi), (_, sender) in zip(slices, pipes)]
+    try:
+        for process, (_, sender) in zip(processes, pipes):
+            process.start()
+            sender.close()
+        errors = []
+        for (lo, hi), (receiver, _), process in zip(slices, pipes, processes):
+            try:
+                overflow, error = receiver.recv()
+            except EOFError:
+                process.join()
+                overflow, error = {}, f"worker exited with code {process.exitcode}"
+            if error is not None:
+                errors.append(error)
+                continue
+            slots.load(data, lo, hi)
+            for (pos, field), value in overflow.items():
+                setattr(data[pos], field, value)
+        if errors:
+            raise RuntimeError(f"EMF worker failed: {errors[0]}")
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            if process.pid is not None:
+                process.join()
+        for receiver, _ in pipes:
+            receiver.close()
+        slots.release()
@@ -0,0 +1,79 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+
+from fetch import fetch_snapshot, summary_states, table_columns, where_clause
+from snapshot import merge_aggregates, merge_collected
+
+# Scale-out over several databases holding disjoint parts of the same table.
+# Keyed aggregates are pushed down as GROUP BY queries returning mergeable
+# [total, count, low, high, values] run summaries; only passes that need rows
+# fetch columns.
+
+
+def shard_dsns(spec, user, password, host="127.0.0.1", port="5432"):
+    """Connection strings for a comma separated list of dbname or host:port/dbname entries"""
+    dsns = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        address, _, dbname = entry.rpartition("/")
+        shard_host, _, shard_port = address.partition(":") if address else (host, "", port)
+        dsns.append(f"dbname={dbname} user={user} password={password} host={shard_host} port={shard_port or port}")
+    return dsns
+
+
+class ShardedTable:
+    """Table split over several databases; every shard computes partial aggregates that are merged here"""
+
+    def __init__(self, dsns, table, columns=None):
+        self.table = table
+        self.columns = columns
+        self.connections = [psycopg2.connect(dsn) for dsn in dsns]
+        self.available = dict(table_columns(self.connections[0], table))
+        self._local = None
+
+    def each(self, function):
+        """function(connection) on every shard concurrently, results in shard order"""
+        with ThreadPoolExecutor(len(self.connections)) as executor:
+            return list(executor.map(function, self.connections))
+
+    def partial_aggregate(self, connection, keys, conjuncts, measure, slots):
+        where = where_clause(connection, conjuncts)
+        states = summary_states(measure, self.available[measure], slots) if measure in self.available else \
+            "0, count(*), NULL, NULL, 0"
+        key_list = ", ".join(keys)
+        cursor = connection.cursor()
+        cursor.execute(f"SELECT {key_list + ', ' if keys else ''}{states} FROM {self.table}"
+                       + (f" WHERE {where}" if where else "") + (f" GROUP BY {key_list}" if keys else ""))
+        width = len(keys)
+        result = {tuple(row[:width]): list(row[width:]) for row in cursor if row[width + 1]}
+        cursor.close()
+        return result
+
+    def aggregate(self, keys, conjuncts, measure, slots=None):
+        result = {}
+        for partial in self.each(lambda connection: self.partial_aggregate(connection, keys, conjuncts, measure,
+                                                                           slots)):
+            merge_aggregates(result, partial)
+        return result
+
+    def count(self, keys, conjuncts):
+        return {key: state[1] for key, state in self.aggregate(keys, conjuncts, None).items()}
+
+    def local(self):
+        """Snapshots of the referenced columns of every shard, for passes that are not decomposable"""
+        if self._local is None:
+            self._local = self.each(lambda connection: fetch_snapshot(connection, self.table, self.columns))
+        return self._local
+
+    def rows(self, conjuncts=(), names=None):
+        for snapshot in self.local():
+            yield from snapshot.rows(conjuncts, names)
+
+    def collect(self, keys, conjuncts, names):
+        result = {}
+        for snapshot in self.local():
+            merge_collected(result, snapshot.collect(keys, conjuncts, names))
+        return result
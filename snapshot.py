@@ -0,0 +1,1063 @@
+import json
+import operator
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date
+from decimal import Decimal
+from itertools import accumulate
+from os import makedirs
+from os.path import join
+from sys import byteorder
+
+# Local columnar snapshot of the sales table. Every column is stored encoded
+# (dictionary, run-length, delta or bit-packed) and predicates/aggregates are
+# evaluated on runs and codes instead of decoded rows wherever possible.
+
+META_FILE = "meta.json"
+RLE_MIN_RUN = 4  # average run length that makes run-length encoding worthwhile
+BLOCK_SIZE = 1024  # rows per zone map block
+BITMAP_MAX_CARDINALITY = 4096  # bitmap indexes are only built on low-cardinality columns
+NUMBERS = (int, float, Decimal)  # plain column values that are summed
+# Value types a plain column can persist, by type name, and how each is read back
+PLAIN_TYPES = {"bool": bool, "int": int, "float": float, "str": str, "date": date.fromisoformat, "Decimal": Decimal}
+
+OPERATORS = {
+    "==": operator.eq, "!=": operator.ne,
+    "<": operator.lt, "<=": operator.le,
+    ">": operator.gt, ">=": operator.ge,
+}
+
+
+class PackedInts:
+    """Frame-of-reference bit packing: (value - base) stored in width bits"""
+    encoding = "bitpack"
+
+    def __init__(self, base, width, count, words):
+        self.base = base
+        self.width = width
+        self.count = count
+        self.words = words
+        self._ints = None
+        self._runs = None
+
+    @staticmethod
+    def pack(values):
+        base = min(values) if values else 0
+        width = max(1, (max(values) - base).bit_length()) if values else 1
+        per_word = 64 // width
+        words = array('Q')
+        for i in range(0, len(values), per_word):
+            word = 0
+            for j, value in enumerate(values[i:i + per_word]):
+                word |= (value - base) << (j * width)
+            words.append(word)
+        return PackedInts(base, width, len(values), words)
+
+    def __len__(self):
+        return self.count
+
+    def ints(self):
+        if self._ints is None:
+            width, base = self.width, self.base
+            mask = (1 << width) - 1
+            shifts = range(0, (64 // width) * width, width)
+            out = array('q')
+            for word in self.words:
+                out.extend([((word >> shift) & mask) + base for shift in shifts])
+            del out[self.count:]
+            self._ints = out
+        return self._ints
+
+    def ints_range(self, start, stop):
+        """Decode only the words covering [start, stop)"""
+        if self._ints is not None:
+            return self._ints[start:stop]
+        per_word = 64 // self.width
+        mask = (1 << self.width) - 1
+        shifts = range(0, per_word * self.width, self.width)
+        first = start // per_word
+        out = array('q')
+        for word in self.words[first:(stop - 1) // per_word + 1]:
+            out.extend([((word >> shift) & mask) + self.base for shift in shifts])
+        offset = start - first * per_word
+        return out[offset:offset + stop - start]
+
+    def runs(self):
+        if self._runs is None:
+            self._runs = runs_of(self.ints())
+        return self._runs
+
+    def select(self, test, within):
+        return select_runs(self.runs(), test, within)
+
+    def to_parts(self):
+        return {"base": self.base, "width": self.width, "count": self.count}, [self.words]
+
+    @staticmethod
+    def from_parts(header, arrays):
+        return PackedInts(header["base"], header["width"], header["count"], arrays[0])
+
+
+class DeltaInts(PackedInts):
+    """Sorted integers stored as bit-packed gaps from the previous value"""
+    encoding = "delta"
+
+    def __init__(self, first, gaps):
+        self.first = first
+        self.gaps = gaps
+        self.count = 0 if first is None else len(gaps) + 1
+        self._ints = None
+        self._runs = None
+
+    @staticmethod
+    def pack(values):
+        gaps = [b - a for a, b in zip(values, values[1:])]
+        return DeltaInts(values[0] if values else None, PackedInts.pack(gaps))
+
+    def ints(self):
+        if self._ints is None:
+            self._ints = array('q', accumulate(self.gaps.ints(), initial=self.first)) if self.count else array('q')
+        return self._ints
+
+    def ints_range(self, start, stop):
+        return self.ints()[start:stop]
+
+    def select_op(self, op, value, within):
+        """Sorted data: every comparison is one or two contiguous ranges"""
+        ints = self.ints()
+        lo, hi = bisect_left(ints, value), bisect_right(ints, value)
+        if op == "==":
+            ranges = [[lo, hi]]
+        elif op == "!=":
+            ranges = [[0, lo], [hi, self.count]]
+        else:
+            ranges = [list({"<": (0, lo), "<=": (0, hi), ">": (hi, self.count), ">=": (lo, self.count)}[op])]
+        return intersect_ranges([r for r in ranges if r[0] < r[1]], within)
+
+    def to_parts(self):
+        header, arrays = self.gaps.to_parts()
+        return {"first": self.first, "gaps": header}, arrays
+
+    @staticmethod
+    def from_parts(header, arrays):
+        return DeltaInts(header["first"], PackedInts.from_parts(header["gaps"], arrays))
+
+
+class RleInts:
+    """Run-length encoding: run values plus cumulative run ends"""
+    encoding = "rle"
+
+    def __init__(self, ends, values):
+        self.ends = ends
+        self.values = values
+        self._ints = None
+
+    @staticmethod
+    def pack(values):
+        ends, run_values = runs_of(values)
+        return RleInts(ends, run_values)
+
+    def __len__(self):
+        return self.ends[-1] if self.ends else 0
+
+    def ints(self):
+        if self._ints is None:
+            out = array('q')
+            start = 0
+            for end, value in zip(self.ends, self.values):
+                out.extend([value] * (end - start))
+                start = end
+            self._ints = out
+        return self._ints
+
+    def ints_range(self, start, stop):
+        if self._ints is not None:
+            return self._ints[start:stop]
+        out = array('q')
+        i = bisect_right(self.ends, start)
+        while start < stop:
+            end = min(self.ends[i], stop)
+            out.extend([self.values[i]] * (end - start))
+            start = end
+            i += 1
+        return out
+
+    def runs(self):
+        return self.ends, self.values
+
+    def select(self, test, within):
+        return select_runs(self.runs(), test, within)
+
+    def sum_range(self, start, stop):
+        """Sum over a row range as value x overlap length per run"""
+        total = 0
+        i = bisect_right(self.ends, start)
+        ends, values = self.ends, self.values
+        while start < stop:
+            end = min(ends[i], stop)
+            total += values[i] * (end - start)
+            start = end
+            i += 1
+        return total
+
+    def min_range(self, start, stop):
+        return min(self.values[bisect_right(self.ends, start):bisect_left(self.ends, stop) + 1])
+
+    def max_range(self, start, stop):
+        return max(self.values[bisect_right(self.ends, start):bisect_left(self.ends, stop) + 1])
+
+    def to_parts(self):
+        return {}, [self.ends, self.values]
+
+    @staticmethod
+    def from_parts(header, arrays):
+        return RleInts(arrays[0], arrays[1])
+
+
+class PlainInts:
+    """Unencoded int buffer, for snapshots built in memory for a single run"""
+    encoding = "array"
+
+    def __init__(self, ints):
+        self._ints = ints
+        self._runs = None
+
+    def __len__(self):
+        return len(self._ints)
+
+    def ints(self):
+        return self._ints
+
+    def ints_range(self, start, stop):
+        return self._ints[start:stop]
+
+    def runs(self):
+        if self._runs is None:
+            self._runs = runs_of(self._ints)
+        return self._runs
+
+    def select(self, test, within):
+        return select_runs(self.runs(), test, within)
+
+    def to_parts(self):
+        return {}, [self._ints]
+
+    @staticmethod
+    def from_parts(header, arrays):
+        return PlainInts(arrays[0])
+
+
+INT_CONTAINERS = {cls.encoding: cls for cls in (PackedInts, DeltaInts, RleInts, PlainInts)}
+
+
+def runs_of(ints):
+    """Collapse equal neighbours into (cumulative ends, run values)"""
+    ends, values = array('q'), array('q')
+    for i, value in enumerate(ints):
+        if values and values[-1] == value:
+            ends[-1] = i + 1
+        else:
+            ends.append(i + 1)
+            values.append(value)
+    return ends, values
+
+
+def select_runs(runs, test, within):
+    """Row ranges inside within whose run value passes test, evaluated once per distinct value"""
+    ends, values = runs
+    ranges = []
+    cache = {}
+    for start, stop in within:
+        i = bisect_right(ends, start)
+        while start < stop:
+            end = min(ends[i], stop)
+            hit = cache.get(values[i])
+            if hit is None:
+                hit = cache[values[i]] = test(values[i])
+            if hit:
+                if ranges and ranges[-1][1] == start:
+                    ranges[-1][1] = end
+                else:
+                    ranges.append([start, end])
+            start = end
+            i += 1
+    return ranges
+
+
+def zone_map(values, block_size):
+    """Per-block (min, max, null count); min/max are None where a block is all null or unordered"""
+    if isinstance(values, array):
+        blocks = [values[start:start + block_size] for start in range(0, len(values), block_size)]
+        return {"min": list(map(min, blocks)), "max": list(map(max, blocks)), "nulls": [0] * len(blocks),
+                "size": block_size}
+    mins, maxs, nulls = [], [], []
+    for start in range(0, len(values), block_size):
+        block = values[start:start + block_size]
+        present = [value for value in block if value is not None]
+        try:
+            low, high = (min(present), max(present)) if present else (None, None)
+        except TypeError:
+            low = high = None
+        mins.append(low)
+        maxs.append(high)
+        nulls.append(len(block) - len(present))
+    return {"min": mins, "max": maxs, "nulls": nulls, "size": block_size}
+
+
+def zone_may_match(low, high, op, value):
+    """Can any value in [low, high] satisfy 'value op constant'"""
+    try:
+        if op == "==":
+            return low <= value <= high
+        if op == "!=":
+            return not (low == high == value)
+        if op in ("<", "<="):
+            return low < value or (op == "<=" and low == value)
+        return high > value or (op == ">=" and high == value)
+    except TypeError:
+        return True
+
+
+def intersect_ranges(left, right):
+    """Intersection of two sorted lists of disjoint [start, stop) ranges"""
+    out = []
+    i = j = 0
+    while i < len(left) and j < len(right):
+        start = max(left[i][0], right[j][0])
+        stop = min(left[i][1], right[j][1])
+        if start < stop:
+            out.append([start, stop])
+        if left[i][1] < right[j][1]:
+            i += 1
+        else:
+            j += 1
+    return out
+
+
+def choose_container(ints):
+    """Pick the smallest-scanning integer encoding for a column of codes/values"""
+    if not ints:
+        return PackedInts.pack(ints)
+    run_count = len(runs_of(ints)[0])
+    if len(ints) >= RLE_MIN_RUN * run_count:
+        return RleInts.pack(ints)
+    if all(a <= b for a, b in zip(ints, ints[1:])):
+        return DeltaInts.pack(ints)
+    if (max(ints) - min(ints)).bit_length() > 64:
+        return None
+    return PackedInts.pack(ints)
+
+
+class Bitmap:
+    """Roaring-style row bitmap: 2^16-row chunks held as sorted arrays when sparse, int bitsets when dense"""
+    ARRAY_LIMIT = 4096
+    CHUNK_BYTES = 8192
+    FULL = (1 << 0x10000) - 1  # bitset of a chunk holding every row
+
+    def __init__(self, containers=None):
+        self.containers = containers if containers is not None else {}
+
+    @staticmethod
+    def from_positions(positions):
+        """Build from ascending row positions"""
+        chunks = {}
+        for pos in positions:
+            low = chunks.get(pos >> 16)
+            if low is None:
+                low = chunks[pos >> 16] = array('H')
+            low.append(pos & 0xFFFF)
+        return Bitmap({high: Bitmap._shrink(low) for high, low in chunks.items()})
+
+    @staticmethod
+    def _shrink(container):
+        """Dense containers above ARRAY_LIMIT become bitsets, sparse ones sorted arrays"""
+        if isinstance(container, int):
+            if container.bit_count() > Bitmap.ARRAY_LIMIT:
+                return container
+            return array('H', Bitmap._bits(container))
+        if len(container) > Bitmap.ARRAY_LIMIT:
+            return Bitmap._as_int(container)
+        return container
+
+    @staticmethod
+    def _as_int(container):
+        if isinstance(container, int):
+            return container
+        bits = bytearray(Bitmap.CHUNK_BYTES)
+        for low in container:
+            bits[low >> 3] |= 1 << (low & 7)
+        return int.from_bytes(bits, "little")
+
+    @staticmethod
+    def _bits(bitset):
+        for i, byte in enumerate(bitset.to_bytes(Bitmap.CHUNK_BYTES, "little")):
+            if byte:
+                for j in range(8):
+                    if byte >> j & 1:
+                        yield (i << 3) | j
+
+    def __and__(self, other):
+        out = {}
+        for high in self.containers.keys() & other.containers.keys():
+            left, right = self.containers[high], other.containers[high]
+            if isinstance(left, int) and isinstance(right, int):
+                both = left & right
+            elif isinstance(left, int) or isinstance(right, int):
+                bitset, sparse = (left, right) if isinstance(left, int) else (right, left)
+                both = array('H', [low for low in sparse if bitset >> low & 1])
+            else:
+                both = array('H', sorted(set(left).intersection(right)))
+            if both:
+                out[high] = Bitmap._shrink(both)
+        return Bitmap(out)
+
+    def __or__(self, other):
+        out = dict(self.containers)
+        for high, right in other.containers.items():
+            left = out.get(high)
+            if left is None:
+                out[high] = right
+            elif isinstance(left, int) or isinstance(right, int) or len(left) + len(right) > Bitmap.ARRAY_LIMIT:
+                out[high] = Bitmap._shrink(Bitmap._as_int(left) | Bitmap._as_int(right))
+            else:
+                out[high] = array('H', sorted(set(left).union(right)))
+        return Bitmap(out)
+
+    def __len__(self):
+        """Popcount"""
+        return sum(c.bit_count() if isinstance(c, int) else len(c) for c in self.containers.values())
+
+    def first(self):
+        """Lowest row position, None when empty"""
+        if not self.containers:
+            return None
+        high = min(self.containers)
+        container = self.containers[high]
+        low = (container & -container).bit_length() - 1 if isinstance(container, int) else container[0]
+        return high << 16 | low
+
+    def positions(self):
+        for high in sorted(self.containers):
+            container = self.containers[high]
+            lows = Bitmap._bits(container) if isinstance(container, int) else container
+            base = high << 16
+            for low in lows:
+                yield base | low
+
+    def ranges(self):
+        """Contiguous [start, stop) row ranges, built per container rather than per position"""
+        ranges = []
+
+        def add(start, stop):
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = stop
+            else:
+                ranges.append([start, stop])
+
+        for high in sorted(self.containers):
+            container = self.containers[high]
+            base = high << 16
+            if isinstance(container, int):
+                Bitmap._bitset_ranges(container, base, add)
+            elif container[-1] - container[0] + 1 == len(container):
+                # A sorted array without gaps is a single run
+                add(base | container[0], (base | container[-1]) + 1)
+            else:
+                for low in container:
+                    add(base | low, (base | low) + 1)
+        return ranges
+
+    @staticmethod
+    def _bitset_ranges(bitset, base, add):
+        """Runs of set bits, a 64-bit word at a time: empty words are skipped and full ones taken whole"""
+        if bitset == Bitmap.FULL:
+            add(base, base + 0x10000)
+            return
+        words = array('Q', bitset.to_bytes(Bitmap.CHUNK_BYTES, "little"))
+        if byteorder == "big":
+            words.byteswap()
+        for i, word in enumerate(words):
+            offset = base + (i << 6)
+            while word:
+                start = (word & -word).bit_length() - 1
+                rest = word >> start
+                length = (~rest & (rest + 1)).bit_length() - 1
+                add(offset + start, offset + start + length)
+                word = rest >> length << (start + length)
+
+    def to_parts(self):
+        header, chunks = [], []
+        for high, container in sorted(self.containers.items()):
+            if isinstance(container, int):
+                header.append([high, "bitset"])
+                chunks.append(container.to_bytes(Bitmap.CHUNK_BYTES, "little"))
+            else:
+                header.append([high, len(container)])
+                chunks.append(container.tobytes())
+        return header, chunks
+
+    @staticmethod
+    def from_parts(header, file):
+        containers = {}
+        for high, kind in header:
+            if kind == "bitset":
+                containers[high] = int.from_bytes(file.read(Bitmap.CHUNK_BYTES), "little")
+            else:
+                containers[high] = array('H')
+                containers[high].fromfile(file, kind)
+        return Bitmap(containers)
+
+
+class Column:
+    """Encoded column: str values go through a sorted dictionary, dates through ordinals"""
+
+    def __init__(self, name, kind, data, dictionary=None, zones=None):
+        self.name = name
+        self.kind = kind
+        self.data = data
+        self.dictionary = dictionary
+        self.zones = zones
+        self._values = None
+
+    @staticmethod
+    def encode(name, values):
+        kinds = {type(value) for value in values}
+        if kinds == {str}:
+            dictionary = sorted(set(values))
+            lookup = {value: code for code, value in enumerate(dictionary)}
+            data = choose_container([lookup[value] for value in values])
+            return Column(name, "str", data, dictionary)
+        if kinds == {int}:
+            data = choose_container(list(values))
+            if data is not None:
+                return Column(name, "int", data)
+        if kinds == {date}:
+            return Column(name, "date", choose_container([value.toordinal() for value in values]))
+        return PlainColumn(name, list(values))
+
+    @property
+    def encoding(self):
+        prefix = "dict+" if self.dictionary is not None else ""
+        return prefix + self.data.encoding
+
+    def __len__(self):
+        return len(self.data)
+
+    def decode(self, code):
+        if self.kind == "str":
+            return self.dictionary[code]
+        if self.kind == "date":
+            return date.fromordinal(code)
+        return code
+
+    def values(self):
+        if self._values is None:
+            ints = self.data.ints()
+            if self.kind == "str":
+                dictionary = self.dictionary
+                self._values = [dictionary[code] for code in ints]
+            elif self.kind == "date":
+                self._values = [date.fromordinal(code) for code in ints]
+            else:
+                self._values = ints
+        return self._values
+
+    def values_range(self, start, stop):
+        """Decoded values of one row range, decoding only the blocks it covers"""
+        if self._values is not None:
+            return self._values[start:stop]
+        ints = self.data.ints_range(start, stop)
+        if self.kind == "str":
+            dictionary = self.dictionary
+            return [dictionary[code] for code in ints]
+        if self.kind == "date":
+            return [date.fromordinal(code) for code in ints]
+        return ints
+
+    def build_zones(self, block_size):
+        self.zones = zone_map(self.data.ints(), block_size)
+
+    def block_may_match(self, block, op, value):
+        """Zone map test on codes; dictionary codes are order preserving"""
+        low, high = self.zones["min"][block], self.zones["max"][block]
+        if low is None:
+            return False
+        if self.kind == "str":
+            low, high = self.dictionary[low], self.dictionary[high]
+        else:
+            value = self.to_code(value)
+        return zone_may_match(low, high, op, value)
+
+    def to_code(self, value):
+        if self.kind == "date" and isinstance(value, str):
+            value = date.fromisoformat(value)
+        if self.kind == "date" and isinstance(value, date):
+            return value.toordinal()
+        return value
+
+    def code_matcher(self, op, value):
+        """Test on codes for 'column op value'; str constants are resolved against the dictionary once"""
+        compare = OPERATORS[op]
+        if self.kind == "str":
+            return {code for code, entry in enumerate(self.dictionary) if _safe(compare, entry, value)}.__contains__
+        value = self.to_code(value)
+        return lambda code: _safe(compare, code, value)
+
+    def select(self, op, value, within):
+        """Ranges inside within satisfying 'column op value', evaluated on codes/runs"""
+        code = self.to_code(value)
+        if self.kind != "str" and isinstance(self.data, DeltaInts) and isinstance(code, (int, float)):
+            return self.data.select_op(op, code, within)
+        return self.data.select(self.code_matcher(op, value), within)
+
+    def build_bitmaps(self):
+        """One bitmap of row positions per distinct code"""
+        positions = {}
+        for pos, code in enumerate(self.data.ints()):
+            rows = positions.get(code)
+            if rows is None:
+                rows = positions[code] = []
+            rows.append(pos)
+        return {code: Bitmap.from_positions(rows) for code, rows in positions.items()}
+
+    def segment(self, pos):
+        """Decoded value at pos and the end of the run that contains it"""
+        if isinstance(self.data, RleInts):
+            i = bisect_right(self.data.ends, pos)
+            return self.decode(self.data.values[i]), self.data.ends[i]
+        ends, values = self.data.runs()
+        i = bisect_right(ends, pos)
+        return self.decode(values[i]), ends[i]
+
+    def stats(self, start, stop):
+        """(sum, min, max, non-null count) of the raw codes over a row range; only int columns are summed"""
+        if isinstance(self.data, RleInts):
+            return (self.data.sum_range(start, stop) if self.kind == "int" else 0, self.data.min_range(start, stop),
+                    self.data.max_range(start, stop), stop - start)
+        chunk = self.data.ints()[start:stop]
+        return sum(chunk) if self.kind == "int" else 0, min(chunk), max(chunk), stop - start
+
+    def to_parts(self):
+        header, arrays = self.data.to_parts()
+        header = {"name": self.name, "kind": self.kind, "encoding": self.data.encoding, "data": header,
+                  "zones": self.zones}
+        if self.dictionary is not None:
+            header["dictionary"] = self.dictionary
+        return header, arrays
+
+    @staticmethod
+    def from_parts(header, arrays):
+        data = INT_CONTAINERS[header["encoding"]].from_parts(header["data"], arrays)
+        return Column(header["name"], header["kind"], data, header.get("dictionary"), header.get("zones"))
+
+
+class PlainColumn:
+    """Unencoded fallback for mixed, nullable or non-integer columns"""
+    kind = "plain"
+    encoding = "plain"
+
+    def __init__(self, name, values, zones=None):
+        self.name = name
+        self.zones = zones
+        self._values = values
+
+    def __len__(self):
+        return len(self._values)
+
+    def values(self):
+        return self._values
+
+    def values_range(self, start, stop):
+        return self._values[start:stop]
+
+    def build_zones(self, block_size):
+        self.zones = zone_map(self._values, block_size)
+
+    def block_may_match(self, block, op, value):
+        low, high = self.zones["min"][block], self.zones["max"][block]
+        if low is None:
+            # all-null blocks never match; blocks of unorderable values cannot be pruned
+            size = self.zones["size"]
+            return self.zones["nulls"][block] < min(size, len(self._values) - block * size)
+        return zone_may_match(low, high, op, value)
+
+    def select(self, op, value, within):
+        compare = OPERATORS[op]
+        ranges = []
+        for start, stop in within:
+            for i in range(start, stop):
+                if _safe(compare, self._values[i], value):
+                    if ranges and ranges[-1][1] == i:
+                        ranges[-1][1] = i + 1
+                    else:
+                        ranges.append([i, i + 1])
+        return ranges
+
+    def segment(self, pos):
+        return self._values[pos], pos + 1
+
+    def stats(self, start, stop):
+        """(sum of the numeric values, min, max, non-null count); min and max are None for unorderable values"""
+        chunk = [value for value in self._values[start:stop] if value is not None]
+        if not chunk:
+            return 0, None, None, 0
+        try:
+            low, high = min(chunk), max(chunk)
+        except TypeError:
+            low = high = None
+        return sum(value for value in chunk if isinstance(value, NUMBERS)), low, high, len(chunk)
+
+    def decode(self, value):
+        return value
+
+    def to_parts(self):
+        return {"name": self.name, "kind": "plain", "encoding": "plain", "zones": None,
+                "values": [_tagged(value) for value in self._values]}, []
+
+    @staticmethod
+    def from_parts(header, arrays):
+        return PlainColumn(header["name"], [_untagged(item) for item in header["values"]])
+
+
+def _tagged(value):
+    """JSON form of a plain column value: None or [type name, value], dates and decimals as text"""
+    if value is None:
+        return None
+    kind = type(value).__name__
+    if kind not in PLAIN_TYPES:
+        raise TypeError(f"Cannot store {kind} values in a snapshot")
+    return [kind, str(value) if kind in ("date", "Decimal") else value]
+
+
+def _untagged(item):
+    if item is None:
+        return None
+    kind, value = item
+    return PLAIN_TYPES[kind](value)
+
+
+def _safe(compare, left, right):
+    """Comparison with SQL semantics: NULL matches nothing, not even !=, as in zone map pruning and the database"""
+    if left is None:
+        return False
+    try:
+        return compare(left, right)
+    except TypeError:
+        return False
+
+
+class Snapshot:
+    """In-memory or on-disk set of encoded columns sharing one row order"""
+
+    def __init__(self, columns, row_count, sort_by=(), block_size=BLOCK_SIZE, bitmaps=None):
+        self.columns = {column.name: column for column in columns}
+        self.row_count = row_count
+        self.sort_by = list(sort_by)
+        self.block_size = block_size
+        self.bitmaps = bitmaps if bitmaps is not None else {}
+        for column in columns:
+            if column.zones is None:
+                column.build_zones(block_size)
+
+    @staticmethod
+    def from_rows(names, rows, sort_by=(), block_size=BLOCK_SIZE):
+        """Encode row tuples, optionally clustering them on sort_by first"""
+        rows = list(rows)
+        if sort_by:
+            positions = [names.index(name) for name in sort_by]
+            rows.sort(key=lambda row: tuple(row[i] for i in positions))
+        columns = [Column.encode(name, [row[i] for row in rows]) for i, name in enumerate(names)]
+        return Snapshot(columns, len(rows), sort_by, block_size)
+
+    def write(self, path):
+        makedirs(path, exist_ok=True)
+        meta = {"rows": self.row_count, "sort_by": self.sort_by, "block_size": self.block_size, "columns": []}
+        for column in self.columns.values():
+            header, arrays = column.to_parts()
+            header["arrays"] = [[data.typecode, len(data)] for data in arrays]
+            meta["columns"].append(header)
+            with open(join(path, f"{column.name}.col"), "wb") as file:
+                for data in arrays:
+                    data.tofile(file)
+        meta["bitmaps"] = {}
+        for name, bitmaps in self.bitmaps.items():
+            meta["bitmaps"][name] = []
+            with open(join(path, f"{name}.bitmap"), "wb") as file:
+                for code, bitmap in bitmaps.items():
+                    header, chunks = bitmap.to_parts()
+                    meta["bitmaps"][name].append([code, header])
+                    for chunk in chunks:
+                        file.write(chunk)
+        with open(join(path, META_FILE), "w") as file:
+            json.dump(meta, file)
+
+    @staticmethod
+    def open(path):
+        with open(join(path, META_FILE), "r") as file:
+            meta = json.load(file)
+        if "partitions" in meta:
+            return PartitionedSnapshot(path, meta["partition_by"], meta["partitions"])
+        columns = []
+        for header in meta["columns"]:
+            arrays = []
+            with open(join(path, f"{header['name']}.col"), "rb") as file:
+                for typecode, length in header["arrays"]:
+                    data = array(typecode)
+                    data.fromfile(file, length)
+                    arrays.append(data)
+            cls = PlainColumn if header["encoding"] == "plain" else Column
+            columns.append(cls.from_parts(header, arrays))
+        bitmaps = {}
+        for name, entries in meta.get("bitmaps", {}).items():
+            with open(join(path, f"{name}.bitmap"), "rb") as file:
+                bitmaps[name] = {code: Bitmap.from_parts(header, file) for code, header in entries}
+        return Snapshot(columns, meta["rows"], meta.get("sort_by", []), meta.get("block_size", BLOCK_SIZE), bitmaps)
+
+    def build_bitmaps(self, names):
+        """Add bitmap indexes on the given low-cardinality encoded columns; returns the indexed names"""
+        indexed = []
+        for name in names:
+            column = self.columns.get(name)
+            if not isinstance(column, Column) or len(set(column.data.runs()[1])) > BITMAP_MAX_CARDINALITY:
+                continue
+            self.bitmaps[name] = column.build_bitmaps()
+            indexed.append(name)
+        return indexed
+
+    def match_bitmap(self, conjuncts):
+        """AND of per-conjunct bitmaps, each the OR of the value bitmaps that satisfy it"""
+        result = None
+        for name, op, value in conjuncts:
+            test = self.columns[name].code_matcher(op, value)
+            matched = Bitmap()
+            for code, bitmap in self.bitmaps[name].items():
+                if test(code):
+                    matched = matched | bitmap
+            result = matched if result is None else result & matched
+        return result
+
+    def prune(self, conjuncts):
+        """Ranges of consecutive blocks whose zone maps can satisfy every conjunct"""
+        ranges = []
+        for block in range(0, (self.row_count + self.block_size - 1) // self.block_size):
+            if all(name in self.columns and self.columns[name].block_may_match(block, op, value)
+                   for name, op, value in conjuncts):
+                start = block * self.block_size
+                stop = min(start + self.block_size, self.row_count)
+                if ranges and ranges[-1][1] == start:
+                    ranges[-1][1] = stop
+                else:
+                    ranges.append([start, stop])
+        return ranges
+
+    def select(self, conjuncts):
+        """Row ranges satisfying every (column, op, value) conjunct, skipping pruned blocks"""
+        indexed = [conjunct for conjunct in conjuncts if conjunct[0] in self.bitmaps]
+        scanned = [conjunct for conjunct in conjuncts if conjunct[0] not in self.bitmaps]
+        ranges = self.prune(scanned) if scanned else [[0, self.row_count]] if self.row_count else []
+        if indexed:
+            ranges = intersect_ranges(ranges, self.match_bitmap(indexed).ranges())
+        for name, op, value in scanned:
+            if not ranges:
+                break
+            ranges = self.columns[name].select(op, value, ranges)
+        return ranges
+
+    def count(self, keys, conjuncts):
+        """Per-key row counts in order of each key's first selected row, answered by bitmap popcounts when every
+        column involved is indexed"""
+        if not keys or not all(name in self.bitmaps for name in list(keys) + [conjunct[0] for conjunct in conjuncts]):
+            return {key: state[1] for key, state in self.aggregate(keys, conjuncts, None).items()}
+
+        found = []
+
+        def expand(prefix, selection, depth):
+            if depth == len(keys):
+                found.append((selection.first(), tuple(prefix), len(selection)))
+                return
+            column = self.columns[keys[depth]]
+            for code, bitmap in self.bitmaps[keys[depth]].items():
+                narrowed = bitmap if selection is None else selection & bitmap
+                if narrowed.containers:
+                    expand(prefix + [column.decode(code)], narrowed, depth + 1)
+
+        expand([], self.match_bitmap(conjuncts) if conjuncts else None, 0)
+        # The bitmaps are walked in dictionary code order; the scan path yields keys in row order
+        return {key: count for _, key, count in sorted(found, key=lambda item: item[0])}
+
+    def clustered_on(self, keys):
+        """True when rows with equal values of keys are adjacent, i.e. the sort order starts with them"""
+        return bool(keys) and set(self.sort_by[:len(keys)]) == set(keys)
+
+    def rows(self, conjuncts=(), names=None):
+        """Yield dict rows, touching only ranges that pass the row-only conjuncts"""
+        names = list(names or self.columns)
+        columns = [self.columns[name] for name in names]
+        for start, stop in self.select(conjuncts):
+            for values in zip(*[column.values_range(start, stop) for column in columns]):
+                yield dict(zip(names, values))
+
+    def key_runs(self, keys, conjuncts):
+        """(key, start, stop) for the selected row ranges, split wherever a key column changes run"""
+        key_columns = [self.columns[name] for name in keys]
+        for start, stop in self.select(conjuncts):
+            pos = start
+            while pos < stop:
+                end = stop
+                key = []
+                for column in key_columns:
+                    value, run_end = column.segment(pos)
+                    key.append(value)
+                    end = min(end, run_end)
+                yield tuple(key), pos, end
+                pos = end
+
+    def aggregate(self, keys, conjuncts, measure, slots=None):
+        """Per-key [total, count, low, high, values] run summary of measure, computed run by run; every slot is
+        filled whatever slots the caller reads"""
+        measure_column = self.columns.get(measure)
+        result = {}
+        for key, pos, end in self.key_runs(keys, conjuncts):
+            state = result.get(key)
+            if state is None:
+                state = result[key] = [0, 0, None, None, 0]
+            state[1] += end - pos
+            if measure_column is not None:
+                total, low, high, values = measure_column.stats(pos, end)
+                state[0] += total
+                state[4] += values
+                if low is not None:
+                    state[2] = low if state[2] is None or low < state[2] else state[2]
+                    state[3] = high if state[3] is None or high > state[3] else state[3]
+        if measure_column is not None and measure_column.kind in ("str", "date"):
+            for state in result.values():
+                if state[2] is not None:
+                    state[2], state[3] = measure_column.decode(state[2]), measure_column.decode(state[3])
+        return result
+
+    def collect(self, keys, conjuncts, names):
+        """Per-key lists of the values of names (tuples when there are several), gathered run by run"""
+        columns = [self.columns.get(name) for name in names]
+        result = {}
+        for key, pos, end in self.key_runs(keys, conjuncts):
+            chunks = [[None] * (end - pos) if column is None else column.values_range(pos, end) for column in columns]
+            values = result.get(key)
+            if values is None:
+                values = result[key] = []
+            values.extend(chunks[0] if len(chunks) == 1 else zip(*chunks))
+        return result
+
+
+def merge_collected(result, partial):
+    """Fold one {key: [values]} into another"""
+    for key, values in partial.items():
+        result.setdefault(key, []).extend(values)
+    return result
+
+
+def merge_aggregates(result, partial):
+    """Fold one {key: [total, count, low, high, values]} into another; low and high merge independently, since a
+    pushed-down summary leaves the extreme it was not asked for NULL"""
+    for key, state in partial.items():
+        current = result.get(key)
+        if current is None:
+            result[key] = list(state)
+            continue
+        current[0] += state[0]
+        current[1] += state[1]
+        current[4] += state[4]
+        if state[2] is not None:
+            current[2] = state[2] if current[2] is None or state[2] < current[2] else current[2]
+        if state[3] is not None:
+            current[3] = state[3] if current[3] is None or state[3] > current[3] else current[3]
+    return result
+
+
+class PartitionedSnapshot:
+    """Snapshot split into one sub-snapshot per distinct value of the partition columns"""
+
+    def __init__(self, path, partition_by, partitions, loaded=None):
+        self.path = path
+        self.partition_by = list(partition_by)
+        self.partitions = partitions
+        self.row_count = sum(partition["rows"] for partition in partitions)
+        self._loaded = loaded if loaded is not None else {}
+
+    @staticmethod
+    def from_rows(names, rows, partition_by, sort_by=(), block_size=BLOCK_SIZE):
+        positions = [names.index(name) for name in partition_by]
+        groups = {}
+        for row in rows:
+            values = tuple(row[i] for i in positions)
+            if not all(isinstance(value, (str, int)) for value in values):
+                raise ValueError(f"Partition columns must hold text or integers, got {values}")
+            group = groups.get(values)
+            if group is None:
+                group = groups[values] = []
+            group.append(row)
+        partitions, loaded = [], {}
+        for i, values in enumerate(sorted(groups)):
+            directory = f"part-{i:05d}"
+            partitions.append({"dir": directory, "values": list(values), "rows": len(groups[values])})
+            loaded[directory] = Snapshot.from_rows(names, groups[values], sort_by, block_size)
+        return PartitionedSnapshot(None, partition_by, partitions, loaded)
+
+    def write(self, path):
+        makedirs(path, exist_ok=True)
+        for partition in self.partitions:
+            self.partition(partition).write(join(path, partition["dir"]))
+        meta = {"rows": self.row_count, "partition_by": self.partition_by, "partitions": self.partitions}
+        with open(join(path, META_FILE), "w") as file:
+            json.dump(meta, file)
+        self.path = path
+
+    def partition(self, partition):
+        """Open a partition on first use"""
+        snapshot = self._loaded.get(partition["dir"])
+        if snapshot is None:
+            snapshot = self._loaded[partition["dir"]] = Snapshot.open(join(self.path, partition["dir"]))
+        return snapshot
+
+    def matching(self, conjuncts):
+        """Partitions whose values can satisfy the conjuncts, with the conjuncts still left to evaluate"""
+        residual = [conjunct for conjunct in conjuncts if conjunct[0] not in self.partition_by]
+        matched = []
+        for partition in self.partitions:
+            values = dict(zip(self.partition_by, partition["values"]))
+            if all(_safe(OPERATORS[op], values[name], value)
+                   for name, op, value in conjuncts if name in values):
+                matched.append(partition)
+        return matched, residual
+
+    def build_bitmaps(self, names):
+        indexed = set(names)
+        for partition in self.partitions:
+            indexed &= set(self.partition(partition).build_bitmaps(names))
+        return [name for name in names if name in indexed]
+
+    def rows(self, conjuncts=(), names=None):
+        matched, residual = self.matching(conjuncts)
+        for partition in matched:
+            yield from self.partition(partition).rows(residual, names)
+
+    def aggregate(self, keys, conjuncts, measure, slots=None):
+        matched, residual = self.matching(conjuncts)
+        result = {}
+        for partition in matched:
+            merge_aggregates(result, self.partition(partition).aggregate(keys, residual, measure, slots))
+        return result
+
+    def collect(self, keys, conjuncts, names):
+        matched, residual = self.matching(conjuncts)
+        result = {}
+        for partition in matched:
+            merge_collected(result, self.partition(partition).collect(keys, residual, names))
+        return result
+
+    def count(self, keys, conjuncts):
+        matched, residual = self.matching(conjuncts)
+        result = {}
+        for partition in matched:
+            for key, count in self.partition(partition).count(keys, residual).items():
+                result[key] = result.get(key, 0) + count
+        return result
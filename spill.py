@@ -0,0 +1,120 @@
+import pickle
+import sys
+import tempfile
+from math import ceil
+
+from aggregates import DistinctCount
+
+# Disk spilling for results that do not fit the memory budget: rows are pickled
+# one after another into anonymous temporary files and read back in order.
+
+MEGABYTE = 1024 * 1024
+MAX_PARTITIONS = 64  # temporary files one partitioning pass keeps open
+MAX_DEPTH = 8  # times a partition still over the memory budget is split again
+
+
+def spill(rows):
+    """Write rows to an anonymous temporary file, returned rewound"""
+    file = tempfile.TemporaryFile()
+    for row in rows:
+        pickle.dump(row, file, pickle.HIGHEST_PROTOCOL)
+    file.seek(0)
+    return file
+
+
+def read_spilled(file, close=True):
+    try:
+        while True:
+            yield pickle.load(file)
+    except EOFError:
+        if close:
+            file.close()
+
+
+def deep_size(value, seen=None):
+    """Approximate bytes held by value and the containers and objects it references"""
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(key, seen) + deep_size(item, seen) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in value)
+    elif hasattr(value, "__dict__"):
+        size += deep_size(vars(value), seen)
+    return size
+
+
+class HashPartitions:
+    """Rows split over temporary files by a hash of the partitioning attributes; each depth hashes differently"""
+
+    def __init__(self, attrs, count, depth=0):
+        self.attrs = attrs
+        self.depth = depth
+        self.files = [tempfile.TemporaryFile() for _ in range(count)]
+
+    def add(self, row):
+        partition = hash((self.depth, tuple(row[attr] for attr in self.attrs))) % len(self.files)
+        pickle.dump(row, self.files[partition], pickle.HIGHEST_PROTOCOL)
+
+    def rows(self, partition):
+        file = self.files[partition]
+        file.seek(0)
+        return read_spilled(file, close=False)
+
+    def close(self):
+        for file in self.files:
+            file.close()
+
+
+def partition_count(rows, attrs, keys, group_size, memory_budget):
+    """Hash partitions the groups of rows need to fit memory_budget (MB), at most one per distinct attrs value and
+    MAX_PARTITIONS; both counts are sketched, so the distinct keys are never held in memory"""
+    sketch = DistinctCount()
+    groups, values = sketch.init(), sketch.init()
+    for row in rows:
+        sketch.step(groups, tuple(row.get(key) for key in keys))
+        sketch.step(values, tuple(row.get(attr) for attr in attrs))
+    needed = ceil(sketch.finalize(groups) * group_size / (memory_budget * MEGABYTE))
+    return min(needed, sketch.finalize(values), MAX_PARTITIONS)
+
+
+def grace_hash(evaluate, snapshot, scan, scan_groups, attrs, keys, group, memory_budget):
+    """Groups of evaluate(snapshot, scan, scan_groups), one hash partition of the rows at a time when the
+    estimated group table exceeds memory_budget (MB) and every grouping variable is correlated on attrs"""
+    if not memory_budget or not attrs:
+        return evaluate(snapshot, scan, scan_groups)
+    group_size = deep_size(group)
+    count = partition_count(scan_groups(keys), attrs, keys, group_size, memory_budget)
+    if count <= 1:
+        return evaluate(snapshot, scan, scan_groups)
+    return evaluate_partitions(evaluate, split(scan(), attrs, count), keys, group_size, memory_budget)
+
+
+def split(rows, attrs, count, depth=0):
+    partitions = HashPartitions(attrs, count, depth)
+    for row in rows:
+        partitions.add(dict(row.items()))
+    return partitions
+
+
+def evaluate_partitions(evaluate, partitions, keys, group_size, memory_budget):
+    try:
+        for partition in range(len(partitions.files)):
+            # Every pass of the partition re-reads its file; no snapshot shortcuts apply to it
+            def scan(conjuncts=()):
+                return partitions.rows(partition)
+
+            count = 1
+            if partitions.depth < MAX_DEPTH:
+                count = partition_count(scan(), partitions.attrs, keys, group_size, memory_budget)
+            if count > 1:
+                # Skewed keys or a low first estimate: this partition alone is over budget, so split it again
+                subpartitions = split(scan(), partitions.attrs, count, partitions.depth + 1)
+                yield from evaluate_partitions(evaluate, subpartitions, keys, group_size, memory_budget)
+            else:
+                yield from evaluate(None, scan, lambda keys: scan())
+    finally:
+        partitions.close()
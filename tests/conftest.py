@@ -0,0 +1,56 @@
+import os
+import random
+import sys
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+NAMES = ["cust", "prod", "month", "quant", "day", "discount"]
+CUSTOMERS = ["Bloom", "Knuth", "Emily", "Helen", "Sam"]
+PRODUCTS = ["Apple", "Butter", "Cherry", "Dates"]
+TEST_TABLE = "emf_test_rows"
+FIRST_DAY = date(2020, 1, 1).toordinal()
+
+
+def make_rows(count=2000, seed=7):
+    """Sales-like rows; discount is NULL for about a third of them"""
+    rng = random.Random(seed)
+    return [(rng.choice(CUSTOMERS), rng.choice(PRODUCTS), rng.randint(1, 12), rng.randint(1, 1000),
+             date.fromordinal(FIRST_DAY + rng.randint(0, 365)),
+             None if rng.random() < 0.3 else rng.randint(0, 50))
+            for _ in range(count)]
+
+
+@pytest.fixture
+def rows():
+    return make_rows()
+
+
+@pytest.fixture(scope="session")
+def database():
+    """(connection, dsn, table, rows) for a table loaded with make_rows(); skipped without a PostgreSQL server"""
+    psycopg2 = pytest.importorskip("psycopg2")
+    dsn = (f"dbname={os.getenv('DB_NAME', 'sales')} user={os.getenv('DB_USER', 'postgres')} "
+           f"password={os.getenv('DB_PASSWORD', '1234')} host={os.getenv('DB_HOST', '127.0.0.1')} port=5432")
+    try:
+        connection = psycopg2.connect(dsn)
+    except psycopg2.OperationalError as error:
+        pytest.skip(f"no database: {error}")
+    data = make_rows(600, seed=11)
+    cursor = connection.cursor()
+    cursor.execute(f"DROP TABLE IF EXISTS {TEST_TABLE}")
+    cursor.execute(f"CREATE TABLE {TEST_TABLE} (cust varchar(20), prod varchar(20), month integer, "
+                   f"quant integer, day date, discount numeric(6, 2))")
+    cursor.executemany(f"INSERT INTO {TEST_TABLE} VALUES (%s, %s, %s, %s, %s, %s)",
+                       [row[:5] + (None if row[5] is None else Decimal(row[5]),) for row in data])
+    connection.commit()
+    cursor.close()
+    yield connection, dsn, TEST_TABLE, data
+    connection.rollback()
+    cursor = connection.cursor()
+    cursor.execute(f"DROP TABLE IF EXISTS {TEST_TABLE}")
+    connection.commit()
+    connection.close()
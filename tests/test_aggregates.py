@@ -0,0 +1,186 @@
+import math
+import random
+
+import pytest
+
+from aggregates import (AGGREGATES, Aggregate, Complement, ExactDistinctCount, ThresholdIndex, aggregate_key,
+                        exact_quantile, lookup, register)
+from snapshot import Snapshot
+
+PLAIN = ["sum", "count", "avg", "min", "max", "var", "stddev", "median", "p90", "countd", "countdx"]
+COMPANION = ["argmax", "argmin", "first", "last", "topk3"]
+
+
+def values_for(name, count=150, seed=5):
+    """Distinct values (so ties never decide a result), with NULLs mixed in for the plain aggregates"""
+    rng = random.Random(seed)
+    numbers = rng.sample(range(-5000, 5000), count)
+    if name in COMPANION:
+        return [(number, f"row{i}") for i, number in enumerate(numbers)]
+    return [None if i % 7 == 0 else number for i, number in enumerate(numbers)]
+
+
+def fold(aggregate, values):
+    state = aggregate.init()
+    for value in values:
+        state = aggregate.step(state, value)
+    return state
+
+
+def close(left, right):
+    if isinstance(left, float) or isinstance(right, float):
+        return math.isclose(left, right, rel_tol=1e-9, abs_tol=1e-9)
+    return left == right
+
+
+@pytest.mark.parametrize("name", PLAIN + COMPANION)
+def test_merge_is_associative_and_matches_one_pass(name):
+    aggregate = lookup(name)
+    values = values_for(name)
+    a, b, c = values[:40], values[40:90], values[90:]
+    one_pass = aggregate.finalize(fold(aggregate, values))
+    left = aggregate.merge(aggregate.merge(fold(aggregate, a), fold(aggregate, b)), fold(aggregate, c))
+    right = aggregate.merge(fold(aggregate, a), aggregate.merge(fold(aggregate, b), fold(aggregate, c)))
+    assert close(aggregate.finalize(left), one_pass)
+    assert close(aggregate.finalize(right), one_pass)
+    # Merging with an empty state changes nothing
+    assert close(aggregate.finalize(aggregate.merge(fold(aggregate, values), aggregate.init())), one_pass)
+
+
+@pytest.mark.parametrize("name", PLAIN + COMPANION)
+def test_step_many_matches_step(name):
+    aggregate = lookup(name)
+    values = values_for(name)
+    assert close(aggregate.finalize(aggregate.step_many(aggregate.init(), values)),
+                 aggregate.finalize(fold(aggregate, values)))
+
+
+@pytest.mark.parametrize("name", PLAIN + COMPANION)
+def test_serialize_round_trip(name):
+    aggregate = lookup(name)
+    state = fold(aggregate, values_for(name))
+    expected = aggregate.finalize(state)
+    assert close(aggregate.finalize(aggregate.deserialize(aggregate.serialize(state))), expected)
+
+
+def test_reported_values():
+    values = values_for("sum")
+    present = [value for value in values if value is not None]
+    assert lookup("sum").finalize(fold(lookup("sum"), values)) == sum(present)
+    assert lookup("count").finalize(fold(lookup("count"), values)) == len(values)
+    assert lookup("avg").finalize(fold(lookup("avg"), values)) == sum(present) / len(present)
+    assert lookup("median").finalize(fold(lookup("median"), values)) == exact_quantile(present, 0.5)
+    mean = sum(present) / len(present)
+    assert math.isclose(lookup("var").finalize(fold(lookup("var"), values)),
+                        sum((value - mean) ** 2 for value in present) / (len(present) - 1))
+    assert lookup("countdx").finalize(fold(lookup("countdx"), values)) == len(present)
+    pairs = values_for("topk3")
+    assert lookup("topk3").finalize(fold(lookup("topk3"), pairs)) == [row for _, row in sorted(pairs)[-3:][::-1]]
+    assert lookup("argmin").finalize(fold(lookup("argmin"), pairs)) == min(pairs)[1]
+
+
+def test_quantile_sketch_stays_close_on_large_inputs():
+    rng = random.Random(9)
+    values = [rng.random() for _ in range(20000)]
+    quantile = lookup("p90")
+    parts = [fold(quantile, values[i::4]) for i in range(4)]
+    merged = parts[0]
+    for part in parts[1:]:
+        merged = quantile.merge(merged, part)
+    rank = sum(value < quantile.finalize(merged) for value in values) / len(values)
+    assert abs(rank - 0.9) < 0.03
+
+
+def test_quantile_percent_must_be_in_range():
+    values = [3, 1, 4, 1, 5]
+    assert [lookup(name).finalize(fold(lookup(name), values)) for name in ("p0", "p100")] == [1, 5]
+    for name in ("p101", "p150"):
+        with pytest.raises(ValueError):
+            lookup(name)
+    with pytest.raises(ValueError):
+        aggregate_key("p150_1_quant")
+
+
+def test_hyperloglog_stays_close_on_large_inputs():
+    rng = random.Random(9)
+    distinct = lookup("countd")
+    estimate = distinct.finalize(fold(distinct, [rng.randint(0, 10 ** 9) for _ in range(20000)]))
+    assert abs(estimate - 20000) / 20000 < 0.05
+
+
+@pytest.mark.parametrize("name", ["sum", "count", "avg", "min", "max"])
+def test_complement_matches_brute_force(name):
+    aggregate = lookup(name)
+    rng = random.Random(2)
+    rows = [(rng.choice("xyz"), rng.choice("abcd"), rng.randint(1, 100)) for _ in range(300)]
+    complement = Complement(aggregate)
+    for outer, inner, value in rows:
+        complement.add(outer, inner, aggregate.step(aggregate.init(), value))
+    complement.finish()
+    for outer in "xyzw":
+        for inner in "abcde":
+            expected = fold(aggregate, [value for o, i, value in rows if o == outer and i != inner])
+            assert aggregate.finalize(complement.state(outer, inner)) == aggregate.finalize(expected)
+
+
+@pytest.mark.parametrize("op", [">", ">=", "<", "<="])
+def test_threshold_index_matches_brute_force(op):
+    rng = random.Random(4)
+    rows = [(rng.choice("xy"), rng.randint(1, 50)) for _ in range(200)] + [("x", None)]
+    index = ThresholdIndex()
+    for key, value in rows:
+        index.add(key, value, value)
+    index.finish()
+    compare = {">": lambda a, b: a > b, ">=": lambda a, b: a >= b, "<": lambda a, b: a < b, "<=": lambda a, b: a <= b}
+    for key in "xyz":
+        for threshold in (0, 1, 17, 50, 51):
+            matched = [value for k, value in rows if k == key and value is not None and compare[op](value, threshold)]
+            total, count, low, high, values = index.summary(key, op, threshold)
+            assert (total, count, values) == (sum(matched), len(matched), len(matched))
+            assert (low, high) == ((min(matched), max(matched)) if matched else (None, None))
+
+
+def test_countdx_codes_are_per_instance_and_bounded():
+    customers, states = lookup("countdx").instance(), lookup("countdx").instance()
+    fold(customers, ["a", "b", "c"])
+    fold(states, ["NY"])
+    assert customers.codes == {"a": 0, "b": 1, "c": 2}
+    assert states.codes == {"NY": 0}
+    with pytest.raises(ValueError):
+        fold(ExactDistinctCount(domain=2), ["a", "b", "c"])
+
+
+def test_run_summaries_match_step_on_nullable_measures():
+    rows = [("a", 1), ("a", None), ("a", 3), ("b", None), ("c", 5)]
+    snapshot = Snapshot.from_rows(["k", "q"], rows)
+    for key, state in snapshot.aggregate(["k"], (), "q").items():
+        values = [value for k, value in rows if k == key[0]]
+        for name in ("sum", "count", "avg", "min", "max"):
+            aggregate = lookup(name)
+            assert aggregate.finalize(aggregate.from_summary(*state)) == aggregate.finalize(fold(aggregate, values)), \
+                (key, name)
+
+
+def test_register_validates_and_plugs_in():
+    class Span(Aggregate):
+        def init(self):
+            return None
+
+        def step(self, state, value):
+            return (value, value) if state is None else (min(state[0], value), max(state[1], value))
+
+        def merge(self, state, other):
+            return state if other is None else self.step(self.step(state, other[0]), other[1])
+
+        def finalize(self, state):
+            return 0 if state is None else state[1] - state[0]
+
+    register("span", Span())
+    try:
+        assert lookup("span").finalize(fold(lookup("span"), [3, 9, 4])) == 6
+        with pytest.raises(ValueError):
+            register("bad_name", Span())
+        with pytest.raises(TypeError):
+            register("span", object())
+    finally:
+        AGGREGATES.pop("span", None)
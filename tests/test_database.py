@@ -0,0 +1,138 @@
+from decimal import Decimal
+
+import pytest
+
+from aggregates import lookup
+from conftest import NAMES
+from fetch import fetch_snapshot, index_order, ordered_rows, stream_rows, summary_rows
+
+pytest.importorskip("psycopg2")
+
+from parallel import ParallelTable  # noqa: E402
+from shards import ShardedTable  # noqa: E402
+from snapshot import Snapshot  # noqa: E402
+from test_parallel import run_theta  # noqa: E402
+
+
+def loaded(data):
+    """Inserted rows as the database returns them"""
+    return [row[:5] + (None if row[5] is None else Decimal(row[5]),) for row in data]
+
+
+def expected_summaries(data, keys, measure):
+    result = {}
+    for row in (dict(zip(NAMES, row)) for row in loaded(data)):
+        state = result.setdefault(tuple(row[key] for key in keys), [0, 0, None, None, 0])
+        state[1] += 1
+        value = row[measure]
+        if value is not None:
+            state[0] += value if not isinstance(value, str) else 0
+            state[2] = value if state[2] is None else min(state[2], value)
+            state[3] = value if state[3] is None else max(state[3], value)
+            state[4] += 1
+    return result
+
+
+def test_fetch_snapshot_matches_table(database):
+    connection, _, table, data = database
+    assert sorted(fetch_snapshot(connection, table).rows(), key=str) == \
+        sorted((dict(zip(NAMES, row)) for row in loaded(data)), key=str)
+
+
+def test_stream_rows_apply_conditions_on_the_server(database):
+    connection, _, table, data = database
+    streamed = stream_rows(connection, table, NAMES, [("quant", ">", 500), ("cust", "!=", "Sam")], itersize=50)
+    assert sorted(streamed, key=str) == sorted((row for row in loaded(data) if row[3] > 500 and row[0] != "Sam"),
+                                               key=str)
+
+
+def test_pushed_down_summaries_skip_sums_of_text(database):
+    connection, _, table, data = database
+    keys = ["prod", "month"]
+    measures = {"cust": ["count", "low"], "quant": ["total", "values"], "discount": ["total", "values"]}
+    result = summary_rows(None, connection, table, keys, measures)
+    assert len(result) == len(expected_summaries(data, keys, "quant"))
+    for row in result:
+        key = tuple(row[name] for name in keys)
+        for measure in ("quant", "discount"):
+            total, count, _, _, values = expected_summaries(data, keys, measure)[key]
+            assert (row[measure][0], row[measure][1], row[measure][4]) == (total, count, values), (key, measure)
+        assert row["cust"][0] == 0
+        assert row["cust"][2] == expected_summaries(data, keys, "cust")[key][2]
+    avg = lookup("avg")
+    for row in result:
+        discounts = [value for prod, month, value in ((r[1], r[2], r[5]) for r in loaded(data))
+                     if (prod, month) == (row["prod"], row["month"])]
+        assert avg.finalize(avg.from_summary(*row["discount"])) == avg.finalize(avg.step_many(avg.init(), discounts))
+
+
+def test_ordered_rows_follow_the_index_order(database):
+    connection, _, table, data = database
+    cursor = connection.cursor()
+    cursor.execute(f"CREATE INDEX emf_test_prod_cust ON {table} (prod, cust, month)")
+    connection.commit()
+    try:
+        assert index_order(connection, table, ["cust", "prod"]) == ["prod", "cust"]
+        assert index_order(connection, table, ["cust"]) is None
+        keys = [row[:2] for row in ordered_rows(None, connection, table, ["cust", "prod"], NAMES, "stream", 50)]
+        # The ORDER BY is the index's (prod, cust), which keeps every group's rows adjacent
+        assert keys == sorted(keys, key=lambda key: (key[1], key[0]))
+        assert len(keys) == len(data)
+        assert ordered_rows(None, connection, table, ["cust", "prod"], NAMES, "cursor") is None
+    finally:
+        cursor.execute("DROP INDEX emf_test_prod_cust")
+        connection.commit()
+        cursor.close()
+
+
+def test_parallel_table_aggregates_and_forks(database):
+    connection, dsn, table, data = database
+    source = ParallelTable(connection, dsn, table, NAMES, 3)
+    try:
+        for measure in ("quant", "discount"):
+            assert source.aggregate(["prod"], (), measure) == expected_summaries(data, ["prod"], measure)
+        assert source.count(["prod", "month"], ()) == \
+            {key: state[1] for key, state in expected_summaries(data, ["prod", "month"], "quant").items()}
+        # Rows are fetched before the EMF workers fork, so they never share the parent's connection
+        assert run_theta(source, loaded(data), 3) == run_theta(fetch_snapshot(connection, table), loaded(data), 1)
+    finally:
+        source.close()
+
+
+def test_sharded_table_merges_shards_and_forks(database):
+    connection, dsn, table, data = database
+    source = ShardedTable([dsn, dsn], table, NAMES)
+    try:
+        merged = source.aggregate(["prod"], (), "cust", ["low", "high", "count"])
+        for key, (_, count, low, high, _) in expected_summaries(data, ["prod"], "cust").items():
+            assert merged[key][1:4] == [2 * count, low, high]
+        doubled = loaded(data) * 2
+        assert run_theta(source, doubled, 3) == run_theta(Snapshot.from_rows(NAMES, doubled), doubled, 1)
+    finally:
+        for shard in source.connections:
+            shard.close()
+
+
+def test_sharded_extremes_merge_without_the_other_side(database):
+    connection, dsn, table, data = database
+    # Each shard is a schema holding a third of the rows, found first on its connection's search_path
+    cursor = connection.cursor()
+    for shard in range(3):
+        cursor.execute(f"DROP SCHEMA IF EXISTS emf_shard_{shard} CASCADE")
+        cursor.execute(f"CREATE SCHEMA emf_shard_{shard}")
+        cursor.execute(f"CREATE TABLE emf_shard_{shard}.{table} AS SELECT * FROM {table} "
+                       f"WHERE (quant + month) % 3 = {shard}")
+    connection.commit()
+    source = ShardedTable([f"{dsn} options='-c search_path=emf_shard_{shard}'" for shard in range(3)], table, NAMES)
+    try:
+        for slots in (["high", "count"], ["low", "count"]):
+            merged = source.aggregate(["prod"], (), "quant", slots)
+            for key, (_, count, low, high, _) in expected_summaries(data, ["prod"], "quant").items():
+                assert merged[key][1:4] == ([count, None, high] if "high" in slots else [count, low, None]), key
+    finally:
+        for shard in source.connections:
+            shard.close()
+        for shard in range(3):
+            cursor.execute(f"DROP SCHEMA emf_shard_{shard} CASCADE")
+        connection.commit()
+        cursor.close()
@@ -0,0 +1,205 @@
+import io
+
+import pytest
+
+import generator
+from aggregates import Dispatch
+from conftest import NAMES
+from generator import CodeGenerator, InputParser, PredicateAnalyzer, PredicateManager, SnapshotBuilder
+from snapshot import Snapshot
+
+# Stand-in for the module generate_module wraps a query body in: the scans read a snapshot or, without one, a list
+# of dict rows (as SCAN_MODE=cursor does)
+MODULE = """
+from aggregates import Complement, Dispatch, ThresholdIndex, lookup
+from ordering import order_rows
+from parallel import run_slices
+from prettytable import PrettyTable
+from spill import grace_hash
+
+
+def query(snapshot, rows, ordered=None):
+    summaries = None
+    emf_workers = 1
+    memory_budget = 0
+
+    def scan(conjuncts=()):
+        return snapshot.rows(conjuncts) if snapshot is not None else rows
+
+    def scan_groups(keys):
+        if snapshot is not None:
+            return (dict(zip(keys, key)) for key in snapshot.count(keys, ()))
+        return scan()
+
+    _global = []
+"""
+
+PARTIAL = """s:
+prod, month, sum_1_quant, sum_2_quant, max_2_quant, count_3_quant
+n:
+3
+v:
+prod, month
+f:
+sum_1_quant, sum_2_quant, max_2_quant, count_3_quant
+p:
+1.prod==prod and 1.month==month
+2.prod==prod
+3.month==month and 3.cust=='Bloom' and 3.quant>100
+g:
+"""
+
+EXCLUSIVE = """s:
+prod, month, sum_1_quant, count_2_quant, sum_3_quant
+n:
+3
+v:
+prod, month
+f:
+sum_1_quant, count_2_quant, sum_3_quant
+p:
+1.prod==prod and 1.month==month and 1.cust=='Bloom'
+2.prod==prod and 2.month==month and 2.cust=='Knuth'
+3.prod==prod and 3.month==month and 3.cust=='Sam' and 3.quant>500
+g:
+"""
+
+NESTED = """s:
+prod, month, sum_1_quant, count_2_quant, sum_3_quant
+n:
+3
+v:
+prod, month
+f:
+sum_1_quant, count_2_quant, sum_3_quant
+p:
+1.prod==prod and 1.month==month and 1.quant>500
+2.prod==prod and 2.month==month and 2.quant>900 and 2.cust=='Sam'
+3.prod==prod and 3.month==month and 3.quant>=900
+g:
+"""
+
+
+def generate(tmp_path, text):
+    path = tmp_path / "query.txt"
+    path.write_text(text)
+    params = InputParser.extract_parameters(str(path))
+    predicates = PredicateManager.create_default_grouping_predicate(params)
+    return CodeGenerator.generate_query_structure(params["s"], params["n"], params["v"], params["f"], predicates,
+                                                  params["g"], None, params["o"], params["l"])
+
+
+def run(body, snapshot=None, rows=None, ordered=None):
+    """Output rows of a generated query body, in a stable order"""
+    namespace = {}
+    exec(MODULE + body, namespace)
+    return sorted(map(tuple, namespace["query"](snapshot, rows, ordered).rows))
+
+
+def test_partially_correlated_variables_match_brute_force(rows, tmp_path):
+    body = generate(tmp_path, PARTIAL)
+    assert "coarse_sum_2_quant" in body and "coarse_count_3_quant" in body
+    expected = []
+    for prod, month in {(row[1], row[2]) for row in rows}:
+        group = [row[3] for row in rows if (row[1], row[2]) == (prod, month)]
+        same_prod = [row[3] for row in rows if row[1] == prod]
+        bloom = [row for row in rows if row[2] == month and row[0] == "Bloom" and row[3] > 100]
+        expected.append((prod, month, sum(group), sum(same_prod), max(same_prod), len(bloom)))
+    assert run(body, Snapshot.from_rows(NAMES, rows)) == sorted(expected)
+    assert run(body, rows=[dict(zip(NAMES, row)) for row in rows]) == sorted(expected)
+
+
+@pytest.mark.parametrize("aggregates", ["", "foo_1_quant"])
+def test_queries_without_row_aggregates_skip_the_streaming_plan(rows, tmp_path, aggregates):
+    text = f"s:\nprod, month\nn:\n1\nv:\nprod, month\nf:\n{aggregates}\np:\n1.prod==prod and 1.month==month\ng:\n"
+    assert PredicateAnalyzer.ordered_keys(["prod", "month"], [aggregates], ["True", "1.prod==prod and 1.month==month"]) \
+        is None
+    body = generate(tmp_path, text)
+    dicts = sorted((dict(zip(NAMES, row)) for row in rows), key=lambda row: (row["prod"], row["month"]))
+    expected = sorted({(row[1], row[2]) for row in rows})
+    assert run(body, rows=dicts, ordered=iter(dicts)) == expected
+
+
+def test_dispatch_routes_rows_by_column_value():
+    dispatch = Dispatch("cust", [(lambda value: value == "Bloom", "bloom"), (lambda value: value != "Sam", "not sam")])
+    assert dispatch({"cust": "Bloom"}) == ("bloom", "not sam")
+    assert dispatch({"cust": "Sam"}) == ()
+    assert dispatch.table == {"Bloom": ("bloom", "not sam"), "Sam": ()}
+    assert Dispatch(None, [(lambda value: False, "any")])({"cust": "Sam"}) == ("any",)
+    shared = [[("cust", "==", "Bloom")], [("cust", "==", "Knuth"), ("quant", ">", 5)]]
+    assert PredicateAnalyzer.dispatch_column(shared) == "cust"
+    assert PredicateAnalyzer.dispatch_column([[("cust", "==", "Bloom")], [("quant", ">", 5)]]) is None
+
+
+def test_exclusive_variables_share_a_dispatched_pass(rows, tmp_path):
+    body = generate(tmp_path, EXCLUSIVE)
+    assert "dispatch = Dispatch('cust'" in body
+    expected = []
+    for prod, month in {(row[1], row[2]) for row in rows}:
+        group = [row for row in rows if (row[1], row[2]) == (prod, month)]
+        expected.append((prod, month, sum(row[3] for row in group if row[0] == "Bloom"),
+                         sum(1 for row in group if row[0] == "Knuth"),
+                         sum(row[3] for row in group if row[0] == "Sam" and row[3] > 500)))
+    assert run(body, rows=[dict(zip(NAMES, row)) for row in rows]) == sorted(expected)
+    assert run(body, Snapshot.from_rows(NAMES, rows)) == sorted(expected)
+
+
+def test_row_conditions_never_match_nulls():
+    for conjuncts, passing in (([("v", "!=", 5)], 7), ([("v", ">=", 1), ("v", "<", 5)], 3), ([("v", "==", 5)], 5)):
+        code = PredicateAnalyzer.conditions_code(conjuncts, lambda column: "value")
+        test = eval(f"lambda value: {code}")
+        assert test(passing) and not test(None)
+    assert code == "value == 5"
+
+
+def test_conjunct_implication():
+    implies = PredicateAnalyzer.conjunct_implies
+    assert implies(("quant", ">", 900), ("quant", ">=", 500))
+    assert implies(("quant", ">", 900), ("quant", ">=", 900))
+    assert not implies(("quant", ">=", 900), ("quant", ">", 900))
+    assert implies(("cust", "==", "Sam"), ("cust", "!=", "Bloom"))
+    assert implies(("month", "<", 3), ("month", "!=", 3))
+    assert not implies(("month", "<=", 3), ("month", "!=", 3))
+    assert not implies(("month", "<", 3), ("quant", "<", 3))
+    assert not implies(("cust", "==", "Sam"), ("cust", ">", 3))
+
+
+def test_subsumption_nests_under_the_strongest_implied_conditions():
+    conjuncts = [[("quant", ">", 500)], [("quant", ">", 900), ("cust", "==", "Sam")], [("quant", ">=", 900)], []]
+    assert PredicateAnalyzer.subsumption_parents(conjuncts) == {1: 2, 2: 0}
+    assert PredicateAnalyzer.subsumption_parents([[("month", "<", 4)], [("month", "<=", 3)]]) == {1: 0}
+    # Equivalent conditions nest the later grouping variable under the earlier one
+    assert PredicateAnalyzer.subsumption_parents([[("month", "==", 3)], [("month", "==", 3)]]) == {1: 0}
+
+
+def test_nested_variables_match_brute_force(rows, tmp_path):
+    body = generate(tmp_path, NESTED)
+    # Only grouping variable 1 is routed; 3 is tested inside it and 2 inside 3
+    assert "def step_2" not in body and "def step_3" not in body
+    expected = []
+    for prod, month in {(row[1], row[2]) for row in rows}:
+        group = [row for row in rows if (row[1], row[2]) == (prod, month)]
+        expected.append((prod, month, sum(row[3] for row in group if row[3] > 500),
+                         sum(1 for row in group if row[3] > 900 and row[0] == "Sam"),
+                         sum(row[3] for row in group if row[3] >= 900)))
+    assert run(body, rows=[dict(zip(NAMES, row)) for row in rows]) == sorted(expected)
+    assert run(body, Snapshot.from_rows(NAMES, rows)) == sorted(expected)
+
+
+def test_snapshot_arguments_are_validated(monkeypatch):
+    errors = io.StringIO()
+    monkeypatch.setattr(generator, "stderr", errors)
+    assert InputParser.parse_columns("") == []
+    assert InputParser.parse_columns(" state, month,") == ["state", "month"]
+    assert InputParser.parse_block_size("") is None
+    assert InputParser.parse_block_size("256") == 256
+    for text in ("0", "-1", "big"):
+        with pytest.raises(SystemExit):
+            InputParser.parse_block_size(text)
+    SnapshotBuilder.check_columns(NAMES, ["month", "cust"], ["prod"])
+    with pytest.raises(SystemExit):
+        SnapshotBuilder.check_columns(NAMES, ["month", "year"], [])
+    assert "Unknown sort column(s) year" in errors.getvalue()
+    with pytest.raises(SystemExit):
+        SnapshotBuilder.check_columns(NAMES, [], ["state"])
+    assert "Unknown partition column(s) state" in errors.getvalue()
@@ -0,0 +1,33 @@
+import io
+
+import pytest
+
+from loader import BulkLoader, ScriptParser
+
+
+@pytest.mark.parametrize("statement, expected", [
+    ("INSERT INTO sales VALUES ('Bloom', 'Eggs', 1, 1, 2018, 'NY', 100, '2018-01-01');",
+     ("sales", None, [["Bloom", "Eggs", "1", "1", "2018", "NY", "100", "2018-01-01"]])),
+    ("insert into sales (cust, day) values ('O''Neil', '2018-01-01'::date), ('Sam', NULL)",
+     ("sales", ["cust", "day"], [["O'Neil", "2018-01-01"], ["Sam", None]])),
+    ("INSERT INTO t VALUES ('1.5'::numeric(10,2), 5::integer, '3'::double precision, '{a}'::text[], -4, '');",
+     ("t", None, [["1.5", "5", "3", "{a}", "-4", ""]])),
+    ("INSERT INTO t VALUES ('a;b', '(x, y)')", ("t", None, [["a;b", "(x, y)"]])),
+])
+def test_parse_insert(statement, expected):
+    assert ScriptParser.parse_insert(statement) == expected
+
+
+def test_parse_insert_ignores_other_statements():
+    assert ScriptParser.parse_insert("CREATE TABLE sales (cust varchar(20))") is None
+
+
+def test_statements_keep_quoted_semicolons():
+    script = "-- comment\nCREATE TABLE t (a text);\n\nINSERT INTO t VALUES ('x;\ny');\nINSERT INTO t VALUES ('z');"
+    assert [statement.strip() for statement in ScriptParser.statements(io.StringIO(script))] == [
+        "CREATE TABLE t (a text);", "INSERT INTO t VALUES ('x;\ny');", "INSERT INTO t VALUES ('z');"]
+
+
+def test_copy_line_escapes_only_when_needed():
+    assert BulkLoader.copy_line(["a", "b"]) == "a\tb"
+    assert BulkLoader.copy_line(["a\tb", None, "c\\d\ne"]) == "a\\tb\t\\N\tc\\\\d\\ne"
@@ -0,0 +1,89 @@
+import random
+
+import pytest
+
+from ordering import order_rows
+import spill as spill_module
+from spill import HashPartitions, grace_hash, read_spilled, spill
+
+
+def make_rows(count=500):
+    rng = random.Random(1)
+    return [((rng.choice([None, *range(20)]), rng.choice("abc")), f"row{i}") for i in range(count)]
+
+
+def reference(rows, descending):
+    """Stable multi-key sort, NULLs last ascending and first descending"""
+    rows = list(rows)
+    for position in reversed(range(len(descending))):
+        present = [row for row in rows if row[0][position] is not None]
+        nulls = [row for row in rows if row[0][position] is None]
+        present.sort(key=lambda row: row[0][position], reverse=descending[position])
+        rows = nulls + present if descending[position] else present + nulls
+    return [output for _, output in rows]
+
+
+@pytest.mark.parametrize("descending", [(False, False), (True, False), (False, True), (True, True)])
+@pytest.mark.parametrize("memory_budget", [0, 0.0005])
+def test_order_rows_matches_reference(descending, memory_budget):
+    rows = make_rows()
+    expected = reference(rows, descending)
+    assert list(order_rows(iter(rows), descending, memory_budget=memory_budget)) == expected
+
+
+@pytest.mark.parametrize("limit", [0, 1, 7, 499, 500, 800])
+def test_limit_keeps_the_first_rows(limit):
+    rows = make_rows()
+    assert list(order_rows(rows, (True, False), limit)) == reference(rows, (True, False))[:limit]
+    assert list(order_rows(rows, (), limit)) == [output for _, output in rows[:limit]]
+
+
+def test_empty_input():
+    assert list(order_rows([], (False,), memory_budget=0.001)) == []
+
+
+def test_spill_round_trip():
+    rows = [{"cust": "Bloom", "quant": i} for i in range(1000)]
+    assert list(read_spilled(spill(rows))) == rows
+
+
+def test_hash_partitions_keep_keys_together():
+    rows = [{"cust": random.choice("abcdefg"), "quant": i} for i in range(500)]
+    partitions = HashPartitions(["cust"], 4)
+    for row in rows:
+        partitions.add(row)
+    seen = {}
+    for partition in range(4):
+        for row in partitions.rows(partition):
+            assert seen.setdefault(row["cust"], partition) == partition
+    assert sorted((row["quant"] for partition in range(4) for row in partitions.rows(partition))) == list(range(500))
+    partitions.close()
+
+
+def test_grace_hash_caps_open_files_and_splits_oversize_partitions(monkeypatch):
+    rng = random.Random(3)
+    rows = [{"cust": rng.randrange(50), "prod": rng.randrange(10), "quant": i} for i in range(3000)]
+    created = []
+
+    class Recorded(HashPartitions):
+        def __init__(self, attrs, count, depth=0):
+            super().__init__(attrs, count, depth)
+            created.append((count, depth))
+
+    monkeypatch.setattr(spill_module, "HashPartitions", Recorded)
+    monkeypatch.setattr(spill_module, "MAX_PARTITIONS", 4)
+
+    def evaluate(snapshot, scan, scan_groups):
+        sums = {}
+        for row in scan():
+            sums[row["cust"], row["prod"]] = sums.get((row["cust"], row["prod"]), 0) + row["quant"]
+        return list(sums.items())
+
+    expected = sorted(evaluate(None, lambda: rows, None))
+    group = {"cust": 0, "prod": 0, "sum_1_quant": 0}
+    result = grace_hash(evaluate, None, lambda conjuncts=(): rows, lambda keys: rows, ["cust"], ["cust", "prod"],
+                        group, 0.001)
+    assert sorted(result) == expected
+    assert max(count for count, _ in created) <= 4
+    # Four partitions of the 50 customers are still over a 1 KB budget, so they are split again
+    assert max(depth for _, depth in created) > 0
@@ -0,0 +1,90 @@
+import glob
+import os
+
+import pytest
+
+from aggregates import lookup
+from conftest import NAMES
+from snapshot import Snapshot
+
+pytest.importorskip("psycopg2")
+
+from parallel import run_slices  # noqa: E402
+
+
+class Group:
+    def __init__(self, prod, month):
+        self.prod = prod
+        self.month = month
+        self.count_state = lookup("count").init()
+        self.avg_state = lookup("avg").init()
+        self.max_state = lookup("max").init()
+
+
+def groups(rows):
+    return [Group(prod, month) for prod, month in sorted({(row[1], row[2]) for row in rows})]
+
+
+def theta_pass(source, data):
+    """Body of a non-keyed pass: rows of the same prod from earlier months"""
+    count, avg, maximum = lookup("count"), lookup("avg"), lookup("max")
+
+    def body(lo, hi):
+        for row in source.rows():
+            for pos in range(lo, hi):
+                obj = data[pos]
+                if row["prod"] == obj.prod and row["month"] < obj.month:
+                    obj.count_state = count.step(obj.count_state, row["quant"])
+                    obj.avg_state = avg.step(obj.avg_state, row["discount"])
+                    obj.max_state = maximum.step(obj.max_state, row["quant"])
+    return body
+
+
+def states(data):
+    return [(obj.count_state, obj.avg_state, obj.max_state) for obj in data]
+
+
+def shared_segments():
+    return set(glob.glob("/dev/shm/psm_*"))
+
+
+def run_theta(source, rows, workers):
+    data = groups(rows)
+    run_slices(theta_pass(source, data), data, ["count_state", "avg_state", "max_state"], workers, source)
+    return states(data)
+
+
+@pytest.mark.parametrize("workers", [2, 3, 8])
+def test_forked_slices_match_one_process(rows, workers):
+    snapshot = Snapshot.from_rows(NAMES, rows)
+    before = shared_segments()
+    assert run_theta(snapshot, rows, workers) == run_theta(snapshot, rows, 1)
+    assert shared_segments() == before
+
+
+def test_without_source_runs_in_process(rows):
+    data = groups(rows)
+    pid = os.getpid()
+    seen = []
+    run_slices(lambda lo, hi: seen.append((os.getpid(), lo, hi)), data, ["count_state"], 4)
+    assert seen == [(pid, 0, len(data))]
+
+
+def test_worker_failures_are_reported_and_cleaned_up(rows):
+    data = groups(rows)
+    snapshot = Snapshot.from_rows(NAMES, rows)
+    before = shared_segments()
+
+    def failing(lo, hi):
+        if lo == 0:
+            raise KeyError("boom")
+
+    def dying(lo, hi):
+        if lo == 0:
+            os._exit(3)
+
+    with pytest.raises(RuntimeError, match="boom"):
+        run_slices(failing, data, ["count_state"], 3, snapshot)
+    with pytest.raises(RuntimeError, match="exited with code 3"):
+        run_slices(dying, data, ["count_state"], 3, snapshot)
+    assert shared_segments() == before
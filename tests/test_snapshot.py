@@ -0,0 +1,239 @@
+import operator
+import random
+from array import array
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+from conftest import NAMES
+from fetch import ordered_rows
+from snapshot import (Bitmap, Column, DeltaInts, PackedInts, PartitionedSnapshot, PlainColumn, RleInts, Snapshot,
+                      choose_container)
+
+OPS = {"==": operator.eq, "!=": operator.ne, "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge}
+CONJUNCTS = [(), (("month", ">=", 4),), (("cust", "==", "Bloom"), ("quant", "<", 500)),
+             (("prod", "!=", "Apple"), ("day", ">", date(2020, 6, 1))), (("month", ">", 12),)]
+
+
+def samples():
+    rng = random.Random(3)
+    return {
+        "empty": [],
+        "single": [42],
+        "negative": [rng.randint(-10 ** 6, 10 ** 6) for _ in range(500)],
+        "wide": [rng.randint(0, 2 ** 62) for _ in range(200)],
+        "sorted": sorted(rng.randint(0, 10 ** 5) for _ in range(700)),
+        "runs": [value for value in range(20) for _ in range(rng.randint(1, 40))],
+    }
+
+
+@pytest.mark.parametrize("codec", [PackedInts, DeltaInts, RleInts])
+@pytest.mark.parametrize("name", list(samples()))
+def test_int_codecs_round_trip(codec, name):
+    values = samples()[name]
+    if codec is DeltaInts and values != sorted(values):
+        pytest.skip("delta encoding is only used for sorted values")
+    data = codec.pack(values)
+    assert len(data) == len(values)
+    assert list(data.ints()) == values
+    for start, stop in [(0, len(values)), (len(values) // 3, len(values) // 2), (len(values), len(values))]:
+        assert list(data.ints_range(start, stop)) == values[start:stop]
+    header, arrays = data.to_parts()
+    assert list(codec.from_parts(header, [array(part.typecode, part) for part in arrays]).ints()) == values
+
+
+def test_rle_range_statistics():
+    values = samples()["runs"]
+    data = RleInts.pack(values)
+    for start, stop in [(0, len(values)), (5, 17), (33, 34), (10, len(values) - 3)]:
+        chunk = values[start:stop]
+        assert (data.sum_range(start, stop), data.min_range(start, stop), data.max_range(start, stop)) == \
+            (sum(chunk), min(chunk), max(chunk))
+
+
+def test_choose_container_picks_by_shape():
+    assert choose_container(samples()["runs"]).encoding == "rle"
+    assert choose_container(samples()["sorted"]).encoding == "delta"
+    assert choose_container(samples()["negative"]).encoding == "bitpack"
+
+
+@pytest.mark.parametrize("values", [["b", "a", "c", "a"] * 10, [date(2020, 1, day) for day in range(1, 29)],
+                                    [1, None, 3], [1.5, 2.5], ["x", 1]])
+def test_column_encode_round_trip(values):
+    column = Column.encode("c", values)
+    assert column.values() == values
+    assert column.values_range(2, 5) == values[2:5]
+    if isinstance(column, Column):
+        header, arrays = column.to_parts()
+        assert Column.from_parts(header, arrays).values() == values
+    else:
+        assert isinstance(column, PlainColumn)
+
+
+def test_bitmap_round_trip_and_set_operations(tmp_path):
+    left = Bitmap.from_positions(range(0, 200000, 3))
+    right = Bitmap.from_positions(list(range(0, 1000)) + list(range(70000, 140000)))
+    assert list((left & right).positions()) == sorted(set(range(0, 200000, 3)) & set(right.positions()))
+    assert len(left | right) == len(set(left.positions()) | set(right.positions()))
+    header, chunks = left.to_parts()
+    path = tmp_path / "bitmap"
+    path.write_bytes(b"".join(chunks))
+    with open(path, "rb") as file:
+        assert list(Bitmap.from_parts(header, file).positions()) == list(left.positions())
+
+
+def test_bitmap_ranges_match_positions():
+    def by_position(bitmap):
+        ranges = []
+        for pos in bitmap.positions():
+            if ranges and ranges[-1][1] == pos:
+                ranges[-1][1] = pos + 1
+            else:
+                ranges.append([pos, pos + 1])
+        return ranges
+
+    full = Bitmap.from_positions(range(0, 3 << 16))
+    assert full.ranges() == [[0, 3 << 16]]
+    runs = Bitmap.from_positions([p for p in range(200000) if p % 1000 < 600 or p % 97 == 0])
+    sparse = Bitmap.from_positions(list(range(10, 50)) + list(range(70000, 70003)) + [70005, 140000])
+    for bitmap in (full, runs, sparse, runs & sparse, Bitmap()):
+        assert bitmap.ranges() == by_position(bitmap)
+
+
+def test_bitmap_counts_keep_first_appearance_order(rows):
+    plain = Snapshot.from_rows(NAMES, rows)
+    indexed = Snapshot.from_rows(NAMES, rows)
+    assert indexed.build_bitmaps(["cust", "prod", "month"]) == ["cust", "prod", "month"]
+    for keys, conjuncts in [(["prod"], ()), (["month", "cust"], ()), (["cust"], (("month", ">=", 11),)), ([], ())]:
+        assert list(indexed.count(keys, conjuncts).items()) == list(plain.count(keys, conjuncts).items())
+    assert Bitmap().first() is None
+    assert Bitmap.from_positions(range(70000, 140000)).first() == 70000
+
+
+def row_path(rows, conjuncts):
+    """Rows as dicts passing the conjuncts, evaluated one row at a time"""
+    dicts = [dict(zip(NAMES, row)) for row in rows]
+    return [row for row in dicts if all(OPS[op](row[name], value) for name, op, value in conjuncts)]
+
+
+def row_summaries(rows, keys, conjuncts, measure):
+    result = {}
+    for row in row_path(rows, conjuncts):
+        state = result.setdefault(tuple(row[key] for key in keys), [0, 0, None, None, 0])
+        state[1] += 1
+        value = row[measure]
+        if value is not None:
+            state[0] += value
+            state[2] = value if state[2] is None else min(state[2], value)
+            state[3] = value if state[3] is None else max(state[3], value)
+            state[4] += 1
+    return result
+
+
+def snapshots(rows, tmp_path):
+    indexed = Snapshot.from_rows(NAMES, rows, block_size=64)
+    indexed.build_bitmaps(["cust", "prod", "month"])
+    indexed.write(str(tmp_path / "indexed"))
+    partitioned = PartitionedSnapshot.from_rows(NAMES, rows, ["prod"], ["month"], block_size=64)
+    partitioned.write(str(tmp_path / "partitioned"))
+    return {
+        "plain": Snapshot.from_rows(NAMES, rows),
+        "sorted": Snapshot.from_rows(NAMES, rows, ["prod", "cust"], block_size=64),
+        "indexed": Snapshot.open(str(tmp_path / "indexed")),
+        "partitioned": Snapshot.open(str(tmp_path / "partitioned")),
+    }
+
+
+@pytest.mark.parametrize("conjuncts", CONJUNCTS)
+def test_snapshot_results_match_row_path(rows, tmp_path, conjuncts):
+    expected_rows = sorted(tuple(row.values()) for row in row_path(rows, conjuncts))
+    for name, snapshot in snapshots(rows, tmp_path).items():
+        assert sorted(tuple(row.values()) for row in snapshot.rows(conjuncts)) == expected_rows, name
+        for keys in (["prod"], ["cust", "prod"], ["month"]):
+            for measure in ("quant", "discount", "month"):
+                assert snapshot.aggregate(keys, conjuncts, measure) == row_summaries(rows, keys, conjuncts, measure), \
+                    (name, keys, measure)
+            assert snapshot.count(keys, conjuncts) == \
+                {key: state[1] for key, state in row_summaries(rows, keys, conjuncts, "quant").items()}, (name, keys)
+            collected = {key: sorted(values) for key, values in snapshot.collect(keys, conjuncts, ["quant", "day"]).items()}
+            expected = {}
+            for row in row_path(rows, conjuncts):
+                expected.setdefault(tuple(row[key] for key in keys), []).append((row["quant"], row["day"]))
+            assert collected == {key: sorted(values) for key, values in expected.items()}, (name, keys)
+
+
+def test_text_measure_extremes_decode(rows):
+    snapshot = Snapshot.from_rows(NAMES, rows)
+    for key, state in snapshot.aggregate(["prod"], (), "cust").items():
+        customers = [row[0] for row in rows if row[1] == key[0]]
+        assert (state[1], state[2], state[3], state[4]) == (len(customers), min(customers), max(customers),
+                                                            len(customers))
+
+
+
+def test_zone_maps_skip_blocks(rows):
+    snapshot = Snapshot.from_rows(NAMES, rows, ["month"], block_size=64)
+    months = snapshot.columns["month"].values()
+    for start, stop in snapshot.prune([("month", "==", 3)]):
+        assert 3 in months[start:stop]
+    # Only the blocks at either end of the month 3 rows hold other months
+    kept = sum(stop - start for start, stop in snapshot.prune([("month", "==", 3)]))
+    assert months.count(3) <= kept < months.count(3) + 2 * 64
+    assert snapshot.prune([("month", ">", 12)]) == []
+
+
+def test_partition_pruning(rows):
+    snapshot = PartitionedSnapshot.from_rows(NAMES, rows, ["prod", "month"])
+    matched, residual = snapshot.matching([("prod", "==", "Apple"), ("month", "<=", 3), ("quant", ">", 10)])
+    assert [partition["values"] for partition in matched] == [["Apple", 1], ["Apple", 2], ["Apple", 3]]
+    assert residual == [("quant", ">", 10)]
+    with pytest.raises(ValueError):
+        PartitionedSnapshot.from_rows(NAMES, rows, ["day"])
+
+
+def test_clustered_on():
+    snapshot = Snapshot.from_rows(NAMES, [], ["prod", "cust"])
+    assert snapshot.clustered_on(["cust", "prod"])
+    assert not snapshot.clustered_on(["cust"])
+    assert not snapshot.clustered_on([])
+
+
+def test_ordered_rows_need_a_clustered_snapshot(rows):
+    clustered = Snapshot.from_rows(NAMES, rows, ["prod", "cust"])
+    keys = [(row["cust"], row["prod"]) for row in ordered_rows(clustered, None, "sales", ["cust", "prod"], NAMES, "copy")]
+    # Each group's rows are adjacent, so a group is complete when its key changes
+    assert len(set(keys)) == sum(1 for i in range(len(keys)) if i == 0 or keys[i] != keys[i - 1])
+    assert ordered_rows(Snapshot.from_rows(NAMES, rows), None, "sales", ["cust", "prod"], NAMES, "copy") is None
+
+
+def test_plain_columns_survive_write_and_open(tmp_path):
+    # Every column is nullable or mixed, so all of them are stored plain
+    rows = [(None if day == 4 else date(2020, 1, day), Decimal(day) / 4 if day % 3 else None,
+             "x" if day % 2 else None, day if day % 5 else "v") for day in range(1, 29)]
+    Snapshot.from_rows(["day", "price", "note", "mixed"], rows, block_size=8).write(str(tmp_path / "plain"))
+    reopened = Snapshot.open(str(tmp_path / "plain"))
+    assert all(isinstance(column, PlainColumn) for column in reopened.columns.values())
+    assert [tuple(row.values()) for row in reopened.rows()] == rows
+    assert len(list(reopened.rows([("day", ">", date(2020, 1, 20))]))) == 8
+
+
+def test_plain_column_summaries_sum_numbers_only():
+    snapshot = Snapshot.from_rows(["k", "note", "mixed"], [("a", "x", 1), ("a", None, "v"), ("a", "y", 2)])
+    assert snapshot.aggregate(["k"], (), "note") == {("a",): [0, 3, "x", "y", 2]}
+    assert snapshot.aggregate(["k"], (), "mixed") == {("a",): [3, 3, None, None, 3]}
+
+
+def test_unordered_blocks_with_nulls_are_not_pruned():
+    snapshot = Snapshot.from_rows(["mixed"], [("v",), (1,), (None,), (None,), (None,)], block_size=3)
+    assert list(snapshot.rows([("mixed", "==", 1)])) == [{"mixed": 1}]
+    # The second block only holds NULLs
+    assert snapshot.prune([("mixed", "==", 1)]) == [[0, 3]]
+
+
+def test_comparisons_never_match_nulls_at_any_block_size():
+    rows = [("a", None), ("b", 7), ("c", None), ("d", None)]
+    for block_size in (1, 2, 3, 1024):
+        snapshot = Snapshot.from_rows(["name", "value"], rows, block_size=block_size)
+        for conjunct in (("value", "!=", 5), ("value", ">", 5), ("value", "<=", 7)):
+            assert [row["name"] for row in snapshot.rows([conjunct])] == ["b"], (block_size, conjunct)